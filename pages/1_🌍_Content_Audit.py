@@ -5,8 +5,7 @@ from pathlib import Path
 import os
 import json
 from dotenv import load_dotenv
-from utils.content_moderation import content_moderation_image
-from utils.content_moderation import content_moderation_text
+from utils.page_cache import moderate_image, moderate_text, save_upload, text_moderation_report
 from PIL import Image
 
 import logging
@@ -27,17 +26,14 @@ def main():
         result = st.button("提交", key="image_submit")
         if result:
             if File is not None:
-                save_folder = os.getenv("save_folder")
-                print(save_folder)
                 print('filename:' + File.name)
 
-                save_path = Path(save_folder, File.name)
-                with open(save_path, mode='wb') as w:
-                    w.write(File.getvalue())
+                # written once per content, the verdict is cached by the image digest
+                save_path, digest = save_upload(File)
 
                 if save_path.exists():
                     file_name = save_path
-                    output = content_moderation_image(file_name)
+                    output = moderate_image(file_name, digest)
 
                     # 2. 显示图片功能
                     st.subheader("上传的图片")
@@ -73,7 +69,7 @@ def main():
             
             if result:
                 if text:
-                    output = content_moderation_text(text)
+                    output = moderate_text(text)
 
                     st.subheader("文本审核结果")
                     data = json.loads(output[0]['text'])
@@ -85,6 +81,13 @@ def main():
                     st.write('结构化输出')
                     st.write(data)
 
+                    # texts of all sessions since the server started, repeated texts are served by the page cache
+                    report = text_moderation_report()
+                    st.caption(f"分层审核: 共 {report['texts']} 条, 本地放行 {report['cleared']} 条, "
+                               f"本地拦截 {report['flagged']} 条, 送模型 {report['escalated']} 条 "
+                               f"(升级率 {report['escalation_rate']:.1%}), 本地平均 {report['local_mean_us']} µs, "
+                               f"模型平均 {report['model_mean_s']} s")
+
                 else:
                     st.write('请输入要审核的文本内容')
 
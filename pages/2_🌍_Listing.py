@@ -1,12 +1,15 @@
 import base64
+import hashlib
 import string
 import streamlit as st
 from pathlib import Path
 import os
 import json
 from dotenv import load_dotenv
-from utils.listing_voc_prompt import gen_listing_prompt, bedrock_converse_api, bedrock_converse_api_with_image
-from utils.listing_voc_agents import create_listing
+from utils.listing_voc_prompt import bedrock_converse_stream_api, bedrock_converse_stream_api_with_image, ListingSectionParser
+from utils.bestseller_crawler import list_corpora, load_reference_corpus
+from utils.page_cache import list_asins, product as cached_product, reference_listings, listing_prompt, response_cache, save_upload
+from utils.page_jobs import submit_job, show_job
 
 from PIL import Image
 
@@ -28,6 +31,15 @@ def main():
     st.set_page_config(page_title="AI Listing", )
     language_options = ['English', 'Chinese']
     language_lable = st.sidebar.selectbox('Select Language', language_options)
+    # reference listings from a crawled bestseller category, or every product in the catalog
+    category_options = ['全部商品'] + list_corpora()
+    category_lable = st.sidebar.selectbox('热卖类目', category_options)
+    # the same inputs show the listing generated before instead of calling the model again
+    use_cache = st.sidebar.checkbox('使用已生成的结果', value=True)
+    # the reference product is fetched from Amazon through the scraper cache, repeated fetches are served cached
+    live = st.sidebar.checkbox('抓取最新商品数据', value=False)
+    # the listing is generated by a background job, it keeps running through reruns and page switches
+    background = st.sidebar.checkbox('后台生成', value=False)
     
     mode_lable = 'PE'
     # default listing container that houses the image upload field
@@ -35,103 +47,142 @@ def main():
         # header that is shown on the web UI
         st.subheader('Listing写作')
 
-        File = st.file_uploader('商品图片', type=["webp", "png", "jpg", "jpeg"], key="new")
+        # all photos of the product are sent in one request
+        Files = st.file_uploader('商品图片', type=["webp", "png", "jpg", "jpeg"], key="new", accept_multiple_files=True)
         brand = st.text_input("品牌", '')
         features = st.text_input("商品关键词", '')
 
         st.divider()
 
-        asin_label = ['B0BZYCJK89', 'B0BGYWPWNC', 'B0CX23V2ZK']
-        asin = st.selectbox('请选择参考的热卖商品', asin_label)
-
-        filename = './data/' + 'asin_' + asin + '_product.json'
-        with open(filename, 'r', encoding='utf-8') as file:
-            product_data = file.read()
-            
-        product_results = json.loads(product_data)
-        
-        as_title = product_results['results'][0]['content']['title']
-        as_bullet = product_results['results'][0]['content']['bullet_points']
-        as_des = product_results['results'][0]['content']['description']
-
-        expander = st.expander('详细信息')
-        expander.write('Title:')
-        expander.write(as_title)
-
-        expander.write('Bullet Points:')
-        expander.write(as_bullet)
-
-        expander.write('Description:')
-        expander.write(as_des)
+        if category_lable == category_options[0]:
+            asin_label = list_asins(with_product=True)
+        else:
+            asin_label = [listing['asin'] for listing in load_reference_corpus(category_lable)]
+        # the automatic option picks the listings most similar to the brand and keywords
+        auto_label = '自动匹配相似商品'
+        asin = st.selectbox('请选择参考的热卖商品', [auto_label] + asin_label)
+        if asin == auto_label:
+            asin = None
+            products = reference_listings(brand + ' ' + features)
+        else:
+            products = [cached_product(asin, live)]
+
+        for product in products:
+            expander = st.expander('详细信息 ' + product['asin'])
+            expander.write('Title:')
+            expander.write(product['title'])
+
+            expander.write('Bullet Points:')
+            expander.write(product['bullet_points'])
+
+            expander.write('Description:')
+            expander.write(product['description'])
 
         result = st.button("点击生成商品Listing")
 
         # if the button is pressed, the model is invoked, and the results are output to the front end
         if result:
             # if an image is uploaded, a file will be present, triggering the image_to_text function
-            if File is not None:
-
-                save_folder = os.getenv("save_folder")
-                print(save_folder)
-                print('filename:' + File.name)
+            if Files:
 
-                # create a posix path of save_folder and the file name
-                save_path = Path(save_folder, File.name)
-                # write the uploaded image file to the save_folder you specified
-                with open(save_path, mode='wb') as w:
-                    w.write(File.getvalue())
+                print('filenames:' + ', '.join(File.name for File in Files))
 
-                # once the save path exists...
-                if save_path.exists():
+                # the uploaded images are written to the save_folder once per content
+                uploads = [save_upload(File) for File in Files]
+                file_names = [save_path for save_path, _ in uploads]
+                # one digest for the set of images, the cached listing is reused for the same photos
+                digest = hashlib.sha256(''.join(upload_digest for _, upload_digest in uploads).encode()).hexdigest()
 
-                    file_name = save_path
+                # once the save paths exist...
+                if all(save_path.exists() for save_path in file_names):
 
                     if mode_lable == 'PE':
-                        user_prompt = gen_listing_prompt(asin, 'com', brand, features, language_lable)
+                        user_prompt = listing_prompt(asin, 'com', brand, features, language_lable, live)
                         print('user_prompt:' + user_prompt)
-                        
-                        llm_output = bedrock_converse_api_with_image(model_Id_multi_modal, file_name, user_prompt)
+
+                        render_listing(model_Id_multi_modal, user_prompt, use_cache, file_names, digest, background)
                         #st.write(output)
                     elif mode_lable == 'Agent':
-                        response = create_listing(asin, file_name, brand, features)
+                        # LangChain, Tavily and the agent LLM are only loaded when the agent mode is used
+                        from utils.listing_voc_agents import create_listing
+
+                        response = create_listing(asin, file_names[0], brand, features)
                         print(response)
                         rslist = str(response['output']).rsplit('>')
                         output = rslist[-1]
-
-                    print("output:" + llm_output)
-
-                    title, bullets, description = parse_listing_xml_response(llm_output)
-
-                    st.write("Title:\n")
-                    st.write(title)
-
-                    st.write("Bullet Points:\n")
-                    st.write(bullets)
-
-                    st.write("Description:\n")
-                    st.write(description)
     
-                    # removing the image file that was temporarily saved to perform the question and answer task
-                    os.remove(save_path)
             else:
                 if mode_lable == 'PE':
-                    user_prompt = gen_listing_prompt(asin, 'com', brand, features, language_lable)
+                    user_prompt = listing_prompt(asin, 'com', brand, features, language_lable, live)
                     print('user_prompt:' + user_prompt)
-                        
-                    llm_output = bedrock_converse_api(model_Id, user_prompt)
-                    print(llm_output)
-
-                    title, bullets, description = parse_listing_xml_response(llm_output)
 
-                    st.write("Title:\n")
-                    st.write(title)
+                    render_listing(model_Id, user_prompt, use_cache, background=background)
+
+        if background:
+            show_job('listing_job', render_listing_text, render_listing_text)
+
+def render_listing(model_id, user_prompt, use_cache, image_file=None, image_digest=None, background=False):
+    """
+    render a listing from the response cache, or stream it from the model and cache the finished text
+
+    image_file is an image path or a list of image paths, sent in one request
+    with background the listing is generated by a job instead, the page shows it through show_job
+    """
+    key = (model_id, user_prompt, image_digest)
+    cached = response_cache().get(key) if use_cache else None
+    if cached is not None:
+        render_listing_stream([cached], {})
+        st.caption("已生成的结果")
+        return
+
+    if background:
+        if isinstance(image_file, list):
+            image_file = [str(path) for path in image_file]
+        elif image_file is not None:
+            image_file = str(image_file)
+        submit_job('listing_job', 'listing', {'model_id': model_id, 'prompt': user_prompt, 'image_file': image_file})
+        return
+
+    metrics = {}
+    if image_file is None:
+        stream = bedrock_converse_stream_api(model_id, user_prompt, metrics)
+    else:
+        stream = bedrock_converse_stream_api_with_image(model_id, image_file, user_prompt, metrics)
+    text = render_listing_stream(stream, metrics)
+    if text:
+        response_cache().put(key, text)
+
+def render_listing_text(text):
+    """
+    render the listing text of a background job, finished or so far
+    """
+    render_listing_stream([text], {})
+
+def render_listing_stream(stream, metrics):
+    """
+    render the streamed listing, each section is shown as soon as its closing tag arrives
+    """
+    placeholders = {}
+    for tag, label in [("title", "Title:\n"), ("bullets", "Bullet Points:\n"), ("description", "Description:\n")]:
+        st.write(label)
+        placeholders[tag] = st.empty()
+        placeholders[tag].caption("生成中...")
+
+    parser = ListingSectionParser()
+    for delta in stream:
+        for tag, content in parser.feed(delta):
+            placeholders[tag].write(content)
+    print("output:" + parser.text)
+
+    # sections the model didn't close properly
+    for tag, placeholder in placeholders.items():
+        if tag not in parser.sections:
+            placeholder.empty()
+
+    if 'time_to_first_token' in metrics:
+        st.caption(f"首字耗时 {metrics['time_to_first_token']:.1f}s, 总耗时 {metrics['total_time']:.1f}s")
+    return parser.text
 
-                    st.write("Bullet Points:\n")
-                    st.write(bullets)
-
-                    st.write("Description:\n")
-                    st.write(description)
-    
 def parse_listing_xml_response(xml_string):
     try:
         # 将XML字符串包装在根元素中
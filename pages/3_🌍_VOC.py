@@ -5,8 +5,10 @@ from pathlib import Path
 import os
 import json
 from dotenv import load_dotenv
-from utils.listing_voc_prompt import gen_listing_prompt, gen_voc_prompt, bedrock_converse_api
-from utils.listing_voc_agents import create_listing
+from utils.listing_voc_prompt import bedrock_converse_stream_api
+from utils.page_cache import list_asins, reviews as cached_reviews, voc_prompt, incremental_voc_prompt, response_cache
+from utils.page_jobs import submit_job, show_job
+from utils.voc_engine import VocMapError
 
 from PIL import Image
 
@@ -23,35 +25,67 @@ st.set_page_config(page_title="VoC客户之声", page_icon="🎨", layout="wide"
 def main():
     language_options = ['English', 'Chinese']
     language_lable = st.sidebar.selectbox('Select Language', language_options)
+    # only reviews not analyzed in previous runs are sent to the model
+    incremental = st.sidebar.checkbox('增量分析(仅分析新评论)', value=False)
+    # the same prompt shows the report generated before instead of calling the model again
+    use_cache = st.sidebar.checkbox('使用已生成的结果', value=True)
+    # the reviews are fetched from Amazon through the scraper cache, repeated fetches are served cached
+    live = st.sidebar.checkbox('抓取最新评论', value=False)
+    # the report is generated by a background job, it keeps running through reruns and page switches
+    background = st.sidebar.checkbox('后台生成', value=False)
 
     with st.container():
         #asin = st.text_input("Amazon ASIN", 'B0BZYCJK89')
         st.subheader('VOC 客户之声')
 
-        asin_label = ['B0BZYCJK89', 'B0BGYWPWNC', 'B0CX23V2ZK']
+        asin_label = list_asins(with_reviews=True)
         asin = st.selectbox('请选择 Amazon ASIN', asin_label)
 
-        reviews = ''
-        filename = './data/' + 'asin_' + asin + '_reviews.json'
-        with open(filename, 'r', encoding='utf-8') as file:
-            reviews = file.read()
-
-        st.text('用户评论信息')
-        st.json(json.loads(reviews)['results'][0]['content'])
+        # only a preview is rendered, an ASIN can have thousands of reviews
+        reviews = cached_reviews(asin, live)
+        st.text(f'用户评论信息 (共 {len(reviews)} 条)')
+        st.json(reviews[:50])
 
         result = st.button("点击生成报告")
 
-        if result:
+        if result and background:
+            submit_job('voc_job', 'voc_report',
+                       {'model_id': model_Id, 'asin': asin, 'language': language_lable, 'incremental': incremental})
+        elif result:
             domain = "com"
-            user_prompt  = gen_voc_prompt(asin, domain, language_lable)
+            # large review sets are summarized chunk by chunk before the report is generated
+            with st.spinner('正在分析评论...'):
+                try:
+                    if incremental:
+                        user_prompt = incremental_voc_prompt(model_Id, asin, language_lable)
+                    else:
+                        user_prompt = voc_prompt(model_Id, asin, language_lable, len(reviews))
+                except VocMapError as e:
+                    # no report from part of the reviews, the prompt isn't cached and the next click retries
+                    st.error(f'{e.failed}/{e.total} 组评论分析失败, 请重试')
+                    return
 
             # print("user_prompt:" + user_prompt)
 
             # output = text_to_text(system_prompt, user_prompt)
 
-            output = bedrock_converse_api(model_Id, user_prompt)
-
-            st.write(output)
+            # render the report as it is generated
+            key = (model_Id, user_prompt, None)
+            cached = response_cache().get(key) if use_cache else None
+            if cached is not None:
+                st.write(cached)
+                st.caption("已生成的结果")
+                return
+
+            metrics = {}
+            report = st.write_stream(bedrock_converse_stream_api(model_Id, user_prompt, metrics))
+            if isinstance(report, str) and report:
+                response_cache().put(key, report)
+            if 'time_to_first_token' in metrics:
+                st.caption(f"首字耗时 {metrics['time_to_first_token']:.1f}s, 总耗时 {metrics['total_time']:.1f}s")
+
+        if background:
+            show_job('voc_job', st.write, st.write)
 
 if __name__ == '__main__':
     main()
@@ -5,8 +5,9 @@ from pathlib import Path
 import os
 import json
 from dotenv import load_dotenv
-from utils.image_generation import generate_prompt_from_image
 from utils.image_generation import generate_or_vary_image
+from utils.page_cache import prompt_from_image, save_upload
+from utils.page_jobs import submit_job, show_job
 from PIL import Image
 
 import logging
@@ -41,26 +42,14 @@ def main():
     
         st.info("👆 在上方输入描述并选择模型，然后点击生成按钮")
     
-        # 处理图片生成
+        # 处理图片生成, 在后台任务中运行, 页面刷新或切换不会中断生成
         if result:
             if text:
-                with st.spinner('正在生成图片...'):
-                    status, image_result = generate_or_vary_image(model_id=selected_model, positive_prompt=text, task_type='image generation')
-                    if status == 0:
-                        st.success("图片生成成功!")
-                        display_and_resize_image(image_result, target_size=768)
-                        
-                        # 下载按钮
-                        st.download_button(
-                            label="下载图片",
-                            data=image_result,
-                            file_name="generated_image.png",
-                            mime="image/png"
-                        )
-                    else:
-                        st.error(f'遇到执行错误: {image_result}')
+                submit_job('image_gen_job', 'image_generation',
+                           {'model_id': selected_model, 'positive_prompt': text, 'task_type': 'image generation'})
             else:
                 st.warning("请输入图片描述!")
+        show_job('image_gen_job', show_generated_image)
     
     
     with image_variation_sdxl:
@@ -79,11 +68,8 @@ def main():
         
         def process_uploaded_image():
             File = st.session_state.uploaded_file
-            save_folder = os.getenv("save_folder")
-            save_path = Path(save_folder, File.name)
-            
-            with open(save_path, mode='wb') as w:
-                w.write(File.getvalue())
+            # written once per content, not on every rerun
+            save_path, digest = save_upload(File)
     
             if save_path.exists():
                 file_name = save_path
@@ -92,7 +78,7 @@ def main():
                 def on_style_change():
                     new_style = st.session_state.style_selector
                     with st.spinner('正在生成提示词...'):
-                        st.session_state.pre_prompts = generate_prompt_from_image(file_name, style=new_style)
+                        st.session_state.pre_prompts = prompt_from_image(file_name, digest, new_style)
     
                 # 风格选择
                 selected_style = st.selectbox(
@@ -107,7 +93,7 @@ def main():
                 # 生成并编辑提示词
                 if 'pre_prompts' not in st.session_state or st.session_state.pre_prompts == "":
                     with st.spinner('正在生成提示词...'):
-                        st.session_state.pre_prompts = generate_prompt_from_image(file_name, style=selected_style)
+                        st.session_state.pre_prompts = prompt_from_image(file_name, digest, selected_style)
                 
                 pre_prompts = st.text_area("提示词,可自由编辑:", value=st.session_state.pre_prompts, key="prompt_area_sdxl")
                 st.session_state.pre_prompts = pre_prompts
@@ -167,11 +153,7 @@ def main():
         
         def process_uploaded_image_titan():
             File = st.session_state.uploaded_file
-            save_folder = os.getenv("save_folder")
-            save_path = Path(save_folder, File.name)
-            
-            with open(save_path, mode='wb') as w:
-                w.write(File.getvalue())
+            save_path, digest = save_upload(File)
     
             if save_path.exists():
                 file_name = save_path
@@ -247,12 +229,8 @@ def main():
         if result:
             if file is not None:
                 with st.spinner('正在处理图片...'):
-                    save_folder = os.getenv("save_folder")
-                    save_path = Path(save_folder, file.name)
-                    
                     # 保存上传的文件
-                    with open(save_path, mode='wb') as w:
-                        w.write(file.getvalue())
+                    save_path, digest = save_upload(file)
     
                     if save_path.exists():
                         # 处理图片
@@ -292,6 +270,23 @@ def main():
     st.markdown("由 AI 驱动 | 创建于 2024")
 
 
+def show_generated_image(job_result):
+    status, image_result = job_result
+    if status == 0:
+        st.success("图片生成成功!")
+        display_and_resize_image(image_result, target_size=768)
+
+        # 下载按钮
+        st.download_button(
+            label="下载图片",
+            data=image_result,
+            file_name="generated_image.png",
+            mime="image/png"
+        )
+    else:
+        st.error(f'遇到执行错误: {image_result}')
+
+
 def display_and_resize_image(file_name, target_size=512):
     """
     打开图片文件，根据需要调整大小并显示。
@@ -1,33 +1,50 @@
-import base64
-import string
-import streamlit as st
-from pathlib import Path
-import os
 import json
+import streamlit as st
 from dotenv import load_dotenv
-from utils.listing_voc_prompt import image_to_text, text_to_text, gen_listing_prompt, gen_voc_prompt
-from utils.listing_voc_agents import create_listing
-
-from PIL import Image
+from utils.page_cache import save_upload
+from utils.page_jobs import submit_job, show_job
 
 import logging
 logger = logging.getLogger(__name__)
 
-def main():
-    language_options = ['English', 'Chinese']
-    language_lable = st.sidebar.selectbox('Select Language', language_options)
-
-    with st.container():
-        asin = st.text_input("Amazon ASIN", 'B0BZYCJK89')
+st.set_page_config(page_title="发票信息提取", page_icon="🧾", layout="wide")
 
-        result = st.button("Submit")
+def main():
+    # load environment variables
+    load_dotenv()
 
-        if result:
-            domain = "com"
-            system_prompt, user_prompt  = gen_voc_prompt(asin, domain, language_lable)
-            output = text_to_text(system_prompt, user_prompt)
+    # a multi-page pdf takes minutes, the background job keeps running through reruns and page switches
+    background = st.sidebar.checkbox('后台提取', value=True)
 
-            st.write(output)
+    with st.container():
+        st.subheader('发票信息提取')
+
+        File = st.file_uploader('发票文件', type=["pdf", "png", "jpg", "jpeg", "webp", "tif", "tiff"])
+
+        result = st.button("点击提取")
+
+        if result and File:
+            # the invoice is written to the save_folder once per content, the job reads it from there
+            save_path, _ = save_upload(File)
+            if background:
+                submit_job('invoice_job', 'invoice_extraction', {'file_path': str(save_path)})
+            else:
+                # the pdf / image stack is only loaded when an invoice is extracted in the page
+                from utils.invoice_extract import create_extractor
+
+                with st.spinner('正在提取...'):
+                    render_invoices(create_extractor(str(save_path)).extract())
+        elif result:
+            st.warning("请上传发票文件!")
+
+        if background:
+            show_job('invoice_job', render_invoices)
+
+def render_invoices(records_json):
+    """
+    render the invoice records json array of the extractor
+    """
+    st.json(json.loads(records_json))
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,66 @@
+import pytest
+
+from utils.moderation_prefilter import CLEAR, ESCALATE, FLAG, TextPrefilter
+
+# listing copy and reviews that must never be flagged without the model
+LISTING_SENTENCES = [
+    "Waterproof GORE-TEX membrane keeps your feet dry on muddy trails",
+    "Gore-Tex lined hiking boots with Vibram outsole",
+    "Long-lasting matte lipstick in a nude shade for everyday wear",
+    "Classic pointed-toe pumps in nude patent leather",
+    "Seamless t-shirt bra, nude color, invisible under light tops",
+    "Available in sizes Small to XXX-Large",
+    "Men's XXXL hoodie with kangaroo pocket",
+    "Die-cast metal model car with opening doors",
+    "Universal kill switch for motorcycles, easy to install",
+    "Dead pedal cover for the left foot rest",
+    "Heat gun for shrink wrap and paint removal",
+    "Great knife, but I cut myself on the edge the first day",
+    "Portable white power bank with dual USB ports",
+    "Blood pressure monitor with a large backlit display",
+    "Bloody Mary mix, spicy and ready to pour",
+    "防水GORE-TEX面料, 裸色设计, 适合日常穿着",
+    "汽车杀菌除味喷雾, 无死角清洁",
+]
+
+
+@pytest.mark.parametrize("sentence", LISTING_SENTENCES)
+def test_listing_sentences_are_not_flagged_locally(sentence):
+    assert TextPrefilter().check(sentence).decision != FLAG
+
+
+@pytest.mark.parametrize("sentence", [
+    "Waterproof GORE-TEX membrane keeps your feet dry on muddy trails",
+    "Long-lasting matte lipstick in a nude shade for everyday wear",
+    "Available in sizes Small to XXX-Large",
+])
+def test_allow_terms_clear_catalog_words(sentence):
+    assert TextPrefilter(clear_unmatched=True).check(sentence).decision == CLEAR
+
+
+@pytest.mark.parametrize("sentence", [
+    "I will find where you live and hurt you",
+    "Buy cocaine here, fast delivery",
+    "You’re worthless and everyone knows it",
+    "Watch your back tomorrow",
+])
+def test_threats_and_drugs_are_escalated(sentence):
+    assert TextPrefilter(clear_unmatched=True).check(sentence).decision == ESCALATE
+
+
+def test_texts_without_terms_are_escalated_by_default():
+    assert TextPrefilter().check("Meet me after school, bring the money").decision == ESCALATE
+    assert TextPrefilter(clear_unmatched=True).check("Insulated stainless steel water bottle").decision == CLEAR
+
+
+@pytest.mark.parametrize("sentence, decision", [
+    ("gore", ESCALATE),
+    ("nude", ESCALATE),
+    ("xxx", ESCALATE),
+    ("porn", ESCALATE),
+    ("click for free porn videos", FLAG),
+    ("send nudes", FLAG),
+    ("how to make a pipe bomb at home", FLAG),
+])
+def test_single_words_escalate_phrases_flag(sentence, decision):
+    assert TextPrefilter().check(sentence).decision == decision
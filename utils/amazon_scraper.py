@@ -1,89 +1,202 @@
 import os
-import csv
-import json
-import sys
-
-from datetime import datetime
-import boto3
+import time
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
-from pprint import pprint
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+OXYLABS_URL = 'https://realtime.oxylabs.io/v1/queries'
+# (connect, read) timeout in seconds, realtime queries can take a while to render
+DEFAULT_TIMEOUT = (10, 180)
+DEFAULT_MAX_RETRIES = 3
+DEFAULT_POOL_SIZE = 32
+
+
+class AmazonScraperClient:
+    """
+    Oxylabs client with a pooled keep-alive session, timeouts and retry with backoff.
+    """
+
+    def __init__(self, auth=None, url=OXYLABS_URL, timeout=DEFAULT_TIMEOUT, max_retries=DEFAULT_MAX_RETRIES,
+                 backoff_factor=1.0, pool_size=DEFAULT_POOL_SIZE):
+        self.url = url
+        self.timeout = timeout
+        if auth is None:
+            auth = (os.getenv('oxylabs_username'), os.getenv('oxylabs_password'))
+            if not all(auth):
+                raise ValueError('oxylabs_username and oxylabs_password must be set in the environment')
+        self.session = requests.Session()
+        self.session.auth = auth
+        retry = Retry(
+            total=max_retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=(429, 500, 502, 503, 504),
+            # queries are idempotent, so POST can be retried
+            allowed_methods=frozenset(['POST']),
+            respect_retry_after_header=True,
+        )
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def query(self, payload):
+        response = self.session.post(self.url, json=payload, timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()
+
+    def get_product(self, asin, do):
+        # Structure payload.
+        payload = {
+            'source': 'amazon_product',
+            'domain': do,
+            'query': asin,
+            'parse': True,
+            'context': [
+                {
+                    'key': 'autoselect_variant', 'value': True
+                },
+            ],
+        }
+        return self.query(payload)
+
+    def get_reviews(self, asin, do, start_page=1, pages=1):
+        # Structure payload.
+        payload = {
+            'source': 'amazon_reviews',
+            'domain': do,
+            'query': asin,
+            'start_page': start_page,
+            'pages': pages,
+            'parse': True,
+        }
+        return self.query(payload)
+
+    def get_bestsellers(self, categoryid, do='com', start_page=1, department='automotive'):
+        # Structure payload.
+        payload = {
+            'source': 'amazon_bestsellers',
+            'domain': do,
+            'query': department,
+            'start_page': start_page,
+            'parse': True,
+            'context': [
+                {'key': 'category_id', 'value': categoryid},
+            ],
+        }
+        return self.query(payload)
+
+    def close(self):
+        self.session.close()
+
+
+class AsyncRateLimiter:
+    """
+    Global rate limit shared by all tasks, requests are spaced at least 1 / rate seconds apart.
+    """
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self._next = 0.0
+        self._lock = asyncio.Lock()
+
+    async def wait(self):
+        async with self._lock:
+            now = time.monotonic()
+            delay = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+class AsyncAmazonScraperClient:
+    """
+    asyncio client, blocking queries run on a thread pool over the pooled session,
+    bounded by max_concurrency and a global requests per second rate.
+    """
+
+    def __init__(self, client=None, max_concurrency=16, rate=10.0):
+        # a client passed in is shared, only the client created here is closed by close()
+        self._owns_client = client is None
+        self.client = client or AmazonScraperClient(pool_size=max_concurrency)
+        self.max_concurrency = max_concurrency
+        self.rate = rate
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency)
+        # created on first use, inside the running event loop
+        self._semaphore = None
+        self._limiter = None
+
+    async def _run(self, method, *args):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+            self._limiter = AsyncRateLimiter(self.rate)
+        async with self._semaphore:
+            await self._limiter.wait()
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor, method, *args)
+
+    async def query(self, payload):
+        return await self._run(self.client.query, payload)
+
+    async def get_product(self, asin, do):
+        return await self._run(self.client.get_product, asin, do)
+
+    async def get_reviews(self, asin, do, start_page=1, pages=1):
+        return await self._run(self.client.get_reviews, asin, do, start_page, pages)
+
+    async def get_bestsellers(self, categoryid, do='com', start_page=1, department='automotive'):
+        return await self._run(self.client.get_bestsellers, categoryid, do, start_page, department)
+
+    async def fetch_many(self, asins, do, reviews=True):
+        """
+        Fetch product and reviews of many ASINs concurrently.
+
+        :return: {asin: {'product': <response or exception>, 'reviews': <response or exception>}}
+        """
+        tasks = {}
+        for asin in asins:
+            tasks[(asin, 'product')] = self.get_product(asin, do)
+            if reviews:
+                tasks[(asin, 'reviews')] = self.get_reviews(asin, do)
+        responses = await asyncio.gather(*tasks.values(), return_exceptions=True)
+
+        results = {}
+        for (asin, kind), response in zip(tasks, responses):
+            results.setdefault(asin, {})[kind] = response
+        return results
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+        if self._owns_client:
+            self.client.close()
+
+
+_default_client = None
+_default_client_lock = threading.Lock()
+
+
+def get_client():
+    """
+    The client shared by the module level functions.
+    """
+    global _default_client
+    with _default_client_lock:
+        if _default_client is None:
+            _default_client = AmazonScraperClient()
+        return _default_client
+
 
 def get_product(asin, do):
     print(asin, do)
-    # Structure payload.
-    payload = {
-        'source': 'amazon_product',
-        'domain': do,
-        'query': asin,
-        'parse': True,
-        'context': [
-            {
-                'key': 'autoselect_variant', 'value': True
-            },
-        ],
-    }
-
-    # Get response.
-    response = requests.request(
-        'POST',
-        'https://realtime.oxylabs.io/v1/queries',
-        #auth=('awslab_KkvGd', 'awsLAB_10248376'),
-        auth=('myaws_9PGDk', 'retail_AWS_123'),
-        json=payload,
-    )
-
-    return response.json()
-
-
-def get_reviews(asin, do):
-    # Structure payload.
-    payload = {
-        'source': 'amazon_reviews',
-        'domain': do,
-        'query': asin,
-        'parse': True,
-    }
-
-
-    # Get response.
-    response = requests.request(
-        'POST',
-        'https://realtime.oxylabs.io/v1/queries',
-        # auth=('awslab_KkvGd', 'awsLAB_10248376'),
-        auth=('myaws_9PGDk', 'retail_AWS_123'),
-        json=payload,
-    )
-
-    # Print prettified response to stdout.
-    # pprint("reponse message:" + str(response.status_code))
-    # pprint(response.json())
-    
-    return response.json()
-
-def get_bestsellers(categoryid):
-    # Structure payload.
-    payload = {
-        'source': 'amazon_bestsellers',
-        'domain': 'com',
-        'query': 'automotive',
-        'start_page': 1,
-        'parse': True,
-        'context': [
-            {'key': 'category_id', 'value': categoryid},
-        ],
-    }
-
-    # Get response.
-    response = requests.request(
-        'POST',
-        'https://realtime.oxylabs.io/v1/queries',
-        # auth=('awslab_KkvGd', 'awsLAB_10248376'),
-        auth=('myaws_9PGDk', 'retail_AWS_123'),
-        json=payload,
-    )
-
-    # Print prettified response to stdout.
-    # pprint(response.json())
+    return get_client().get_product(asin, do)
+
+
+def get_reviews(asin, do, start_page=1, pages=1):
+    return get_client().get_reviews(asin, do, start_page, pages)
+
+
+def get_bestsellers(categoryid, do='com', start_page=1, department='automotive'):
     # return response.json()['results'][0]['content']
-    return response.json()
\ No newline at end of file
+    return get_client().get_bestsellers(categoryid, do, start_page, department)
@@ -0,0 +1,66 @@
+"""
+Registry of the boto3 clients shared by all modules.
+
+A client is built on first use and cached by (service, region, retries). boto3 clients are thread safe, so one
+client and its connection pool serve every thread instead of a new client per call.
+
+Callers with a backoff loop of their own (the batch jobs, see utils.bedrock_throttle) take a client without
+botocore retries, otherwise every attempt of their loop would be up to MAX_ATTEMPTS requests.
+
+usage:
+    get_bedrock_runtime('us-west-2').converse(...)
+    get_bedrock_runtime('us-west-2', retries=False).converse(...)
+"""
+import os
+import threading
+
+DEFAULT_REGION = 'us-east-1'
+# should cover the concurrency of the batch jobs sharing a client
+MAX_POOL_CONNECTIONS = 32
+CONNECT_TIMEOUT = 10
+# image generation and long reports can take minutes
+READ_TIMEOUT = 300
+MAX_ATTEMPTS = 8
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def client_config(retries=True):
+    from botocore.config import Config
+
+    return Config(
+        max_pool_connections=MAX_POOL_CONNECTIONS,
+        connect_timeout=CONNECT_TIMEOUT,
+        read_timeout=READ_TIMEOUT,
+        # adaptive mode adds client side rate limiting on top of the retries when throttled,
+        # a single attempt leaves throttling and retries to the caller
+        retries={'mode': 'adaptive', 'max_attempts': MAX_ATTEMPTS} if retries
+        else {'mode': 'standard', 'max_attempts': 1},
+        tcp_keepalive=True,
+    )
+
+
+def get_aws_client(service, region=None, retries=True):
+    """
+    The shared client of a service in a region, default to env aws_region or us-east-1.
+
+    :param retries: False for a client making a single attempt per call, for callers retrying themselves
+    """
+    key = (service, region or os.getenv('aws_region', DEFAULT_REGION), retries)
+    client = _clients.get(key)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(key)
+            if client is None:
+                # boto3 is imported with the first client, importing a module that may call bedrock stays cheap
+                import boto3
+
+                # the default session isn't thread safe to create clients from, the lock covers it
+                client = boto3.client(key[0], region_name=key[1], config=client_config(retries))
+                _clients[key] = client
+    return client
+
+
+def get_bedrock_runtime(region=None, retries=True):
+    return get_aws_client('bedrock-runtime', region, retries)
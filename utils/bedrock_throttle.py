@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+throttling aware bedrock calls shared by the batch modules
+
+an adaptive concurrency limit and retries with full jitter backoff when bedrock throttles, and a bounded
+submission of batch items to a thread pool.
+"""
+
+import logging
+import random
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Executor, wait
+from typing import Callable, Final, Iterable, Iterator, Optional, TypeVar
+
+from botocore.exceptions import ClientError
+
+logger = logging.getLogger(__name__)
+
+# backoff after a throttled call: min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt) with full jitter
+BACKOFF_BASE: Final[float] = 1.0
+BACKOFF_CAP: Final[float] = 30.0
+
+T = TypeVar("T")
+
+
+class AdaptiveLimiter:
+    """
+    concurrency limit with additive increase / multiplicative decrease
+
+    the limit is halved on every throttled call and grows back by about one slot
+    per round of successful calls, never above max_concurrency.
+    """
+
+    def __init__(self, max_concurrency: int):
+        self._max = max(1, max_concurrency)
+        self._limit = float(self._max)
+        self._active = 0
+        self._cond = threading.Condition()
+
+    @property
+    def limit(self) -> int:
+        return int(self._limit)
+
+    def __enter__(self):
+        with self._cond:
+            while self._active >= int(self._limit):
+                self._cond.wait()
+            self._active += 1
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        with self._cond:
+            self._active -= 1
+            self._cond.notify_all()
+
+    def on_success(self):
+        with self._cond:
+            if self._limit < self._max:
+                self._limit = min(self._max, self._limit + 1 / self._limit)
+                self._cond.notify_all()
+
+    def on_throttle(self):
+        with self._cond:
+            self._limit = max(1.0, self._limit / 2)
+
+
+def is_throttling(err: ClientError) -> bool:
+    return err.response.get("Error", {}).get("Code") in ("ThrottlingException", "TooManyRequestsException")
+
+
+def call_with_backoff(call: Callable[[], T], limiter: AdaptiveLimiter, max_attempts: int, label: str = "",
+                      on_attempt: Optional[Callable[[], None]] = None) -> T:
+    """
+    run a bedrock call inside the limiter, throttled calls shrink the limit and are retried after a backoff
+
+    :param on_attempt: called before every attempt, e.g. to count attempts
+    """
+    for attempt in range(max_attempts):
+        if on_attempt:
+            on_attempt()
+        try:
+            with limiter:
+                result = call()
+            limiter.on_success()
+            return result
+        except ClientError as err:
+            if not is_throttling(err) or attempt == max_attempts - 1:
+                raise
+            limiter.on_throttle()
+            delay = random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+            logger.warning("%s throttled, limit=%d, retry in %.1fs", label, limiter.limit, delay)
+            time.sleep(delay)
+
+
+# end of the items of bounded_map, None may be an item
+_END = object()
+
+
+def bounded_map(executor: Executor, fn: Callable[..., T], items: Iterable, max_pending: int) -> Iterator[T]:
+    """
+    fn(item) of every item in completion order, with at most max_pending items submitted at a time,
+    so a huge iterable isn't read and turned into futures up front
+    """
+    items = iter(items)
+    pending = set()
+    exhausted = False
+    while True:
+        while not exhausted and len(pending) < max_pending:
+            item = next(items, _END)
+            if item is _END:
+                exhausted = True
+            else:
+                pending.add(executor.submit(fn, item))
+        if not pending:
+            return
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            yield future.result()
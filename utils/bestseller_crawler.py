@@ -0,0 +1,206 @@
+"""
+Crawl the bestsellers of a category and build a reference corpus of their listings.
+
+All bestseller pages of the category are fetched, the ASINs are enriched with product and review data
+by a bounded pool of workers, and each enriched product is written as one compact jsonl line as soon as
+it is done. Products and reviews are ingested into the catalog as well, so the Listing page can pick them
+as reference listings.
+
+usage:
+    python -m utils.bestseller_crawler 15706941 com automotive
+"""
+import os
+import json
+import asyncio
+import logging
+
+from utils.catalog_store import get_catalog
+from utils.reviews import iter_raw_reviews, slim_review
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_WORKERS = 8
+# reviews kept per product in the corpus, the full reviews are in the catalog
+CORPUS_REVIEWS = 3
+
+
+def corpus_folder():
+    return os.getenv('corpus_folder', './data/corpus')
+
+
+def corpus_path(categoryid, folder=None):
+    return os.path.join(folder or corpus_folder(), 'bestsellers_' + str(categoryid) + '.jsonl')
+
+
+def compact_listing(item, product, reviews):
+    """
+    The reference fields of an enriched bestseller.
+    """
+    return {
+        'asin': item['asin'],
+        'rank': item['rank'],
+        'title': product.get('title'),
+        'bullet_points': product.get('bullet_points'),
+        'description': product.get('description'),
+        'brand': product.get('brand'),
+        'price': product.get('price', item.get('price')),
+        'rating': product.get('rating', item.get('rating')),
+        'reviews_count': product.get('reviews_count'),
+        'top_reviews': [slim_review(review) for review in reviews[:CORPUS_REVIEWS]],
+    }
+
+
+class BestsellerCrawler:
+
+    def __init__(self, client=None, workers=DEFAULT_WORKERS, max_pages=None, reviews=True, catalog=None):
+        """
+        :param client: AsyncAmazonScraperClient, a new one if None
+        :param workers: ASINs enriched concurrently
+        :param max_pages: bestseller pages crawled, all pages if None
+        :param reviews: also fetch the first review page of each ASIN
+        :param catalog: CatalogStore the results are ingested into, the shared one if None
+        """
+        # a client passed in is the caller's to close
+        self._owns_client = client is None
+        if client is None:
+            # the scraper stack is loaded by crawls only, the Listing page just reads the corpora
+            from utils.amazon_scraper import AsyncAmazonScraperClient
+
+            client = AsyncAmazonScraperClient(max_concurrency=workers)
+        self.client = client
+        self.workers = workers
+        self.max_pages = max_pages
+        self.reviews = reviews
+        self.catalog = catalog or get_catalog()
+
+    def close(self):
+        if self._owns_client:
+            self.client.close()
+
+    async def _fetch_page(self, categoryid, do, page, department):
+        response = await self.client.get_bestsellers(categoryid, do, page, department)
+        content = response['results'][0]['content']
+        return content.get('results') or [], content.get('pages') or 1
+
+    async def crawl_category(self, categoryid, do='com', department='automotive'):
+        """
+        Bestseller ASINs of all pages of a category, in rank order.
+
+        :return: [{'asin': .., 'rank': .., 'title': .., 'price': .., 'rating': ..}]
+        """
+        items, pages = await self._fetch_page(categoryid, do, 1, department)
+        if self.max_pages:
+            pages = min(pages, self.max_pages)
+        responses = await asyncio.gather(
+            *(self._fetch_page(categoryid, do, page, department) for page in range(2, pages + 1)),
+            return_exceptions=True)
+        for page, response in enumerate(responses, start=2):
+            if isinstance(response, Exception):
+                logger.warning(f"bestseller page {page} of {categoryid} failed: {response}")
+                continue
+            items.extend(response[0])
+
+        ranked = {}
+        for i, item in enumerate(items):
+            if item.get('asin') and item['asin'] not in ranked:
+                ranked[item['asin']] = {
+                    'asin': item['asin'],
+                    'rank': item.get('pos') or i + 1,
+                    'title': item.get('title'),
+                    'price': item.get('price'),
+                    'rating': item.get('rating'),
+                }
+        return sorted(ranked.values(), key=lambda item: item['rank'])
+
+    async def _enrich_one(self, item, do):
+        product_response = await self.client.get_product(item['asin'], do)
+        product = product_response['results'][0]['content']
+        if not product.get('title'):
+            raise ValueError('no product data')
+        self.catalog.ingest_product(product, do)
+
+        reviews = []
+        if self.reviews:
+            reviews_response = await self.client.get_reviews(item['asin'], do)
+            reviews = list(iter_raw_reviews(reviews_response))
+            self.catalog.ingest_reviews(item['asin'], reviews)
+        return compact_listing(item, product, reviews)
+
+    async def crawl(self, categoryid, do='com', department='automotive', folder=None):
+        """
+        Crawl a category and write its reference corpus.
+
+        :return: {'asins': n, 'enriched': n, 'failed': [asin, ..], 'path': corpus file}
+        """
+        items = await self.crawl_category(categoryid, do, department)
+        path = corpus_path(categoryid, folder)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        stats = {'asins': len(items), 'enriched': 0, 'failed': [], 'path': path}
+
+        queue = asyncio.Queue()
+        for item in items:
+            queue.put_nowait(item)
+
+        # rewritten from scratch, the corpus is a snapshot of the current bestsellers
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as file:
+
+            async def worker():
+                while not queue.empty():
+                    item = queue.get_nowait()
+                    try:
+                        listing = await self._enrich_one(item, do)
+                    except Exception as e:
+                        logger.warning(f"enriching {item['asin']} failed: {e}")
+                        stats['failed'].append(item['asin'])
+                        continue
+                    file.write(json.dumps(listing, ensure_ascii=False) + '\n')
+                    stats['enriched'] += 1
+
+            await asyncio.gather(*(worker() for _ in range(self.workers)))
+        os.replace(tmp_path, path)
+
+        logger.info(f"bestsellers of {categoryid}: {stats}")
+        return stats
+
+
+def crawl_bestsellers(categoryid, do='com', department='automotive', folder=None, **kwargs):
+    """
+    Blocking wrapper of BestsellerCrawler.crawl.
+    """
+    crawler = BestsellerCrawler(**kwargs)
+    try:
+        return asyncio.run(crawler.crawl(categoryid, do, department, folder))
+    finally:
+        crawler.close()
+
+
+def list_corpora(folder=None):
+    """
+    Category ids of the reference corpora written so far.
+    """
+    folder = folder or corpus_folder()
+    if not os.path.isdir(folder):
+        return []
+    return sorted(name[len('bestsellers_'):-len('.jsonl')] for name in os.listdir(folder)
+                  if name.startswith('bestsellers_') and name.endswith('.jsonl'))
+
+
+def load_reference_corpus(categoryid, folder=None):
+    """
+    Reference listings of a category in rank order, empty if it wasn't crawled.
+    """
+    path = corpus_path(categoryid, folder)
+    if not os.path.exists(path):
+        return []
+    with open(path, 'r', encoding='utf-8') as file:
+        listings = [json.loads(line) for line in file]
+    return sorted(listings, key=lambda listing: listing['rank'])
+
+
+if __name__ == '__main__':
+    import sys
+
+    logging.basicConfig(level=logging.INFO)
+    print(crawl_bestsellers(sys.argv[1], sys.argv[2] if len(sys.argv) > 2 else 'com',
+                            sys.argv[3] if len(sys.argv) > 3 else 'automotive'))
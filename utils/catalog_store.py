@@ -0,0 +1,290 @@
+"""
+Local SQLite catalog of the scraped products and reviews.
+
+Scraper responses, the saved ./data/asin_*.json files and the harvested review jsonl files are ingested once,
+pages then read products and reviews by ASIN from the indexed store instead of parsing the json files on every rerun.
+
+usage:
+    catalog = get_catalog()
+    catalog.list_asins()
+    catalog.get_product('B0BZYCJK89')['title']
+    for review in catalog.iter_reviews('B0BZYCJK89', since='2024-01-01'):
+        ...
+"""
+import os
+import re
+import json
+import time
+import sqlite3
+import logging
+import threading
+from collections import OrderedDict
+
+from utils.reviews import iter_raw_reviews, slim_review
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_DB_PATH = './data/catalog.db'
+PRODUCT_CACHE_SIZE = 256
+# seconds between two syncs of the source folders, files harvested meanwhile show up after at most this
+SYNC_INTERVAL = 30
+REVIEW_CACHE_SIZE = 16
+
+_SOURCE_FILE = re.compile(r"^asin_(?P<asin>[A-Z0-9]+)_(?P<kind>product|reviews)\.(?P<ext>jsonl?)$")
+
+SCHEMA = '''
+create table if not exists products (
+    asin text primary key,
+    domain text,
+    title text,
+    content text not null,
+    updated_at integer not null
+);
+create table if not exists reviews (
+    asin text not null,
+    id text not null,
+    rating integer,
+    title text,
+    content text,
+    verified integer,
+    helpful integer,
+    date text,
+    raw text not null,
+    primary key (asin, id)
+);
+create index if not exists reviews_asin_date on reviews (asin, date);
+create table if not exists sources (
+    path text primary key,
+    mtime real not null,
+    size integer not null
+);
+'''
+
+
+class LruCache:
+    """
+    Small thread-safe LRU map.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._items:
+                return None
+            self._items.move_to_end(key)
+            return self._items[key]
+
+    def put(self, key, value):
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def discard(self, match):
+        """
+        Drop the entries whose key matches.
+        """
+        with self._lock:
+            for key in [key for key in self._items if match(key)]:
+                del self._items[key]
+
+
+class CatalogStore:
+
+    def __init__(self, path=None):
+        """
+        :param path: database file, default to env catalog_db or ./data/catalog.db
+        """
+        self.path = path or os.getenv('catalog_db', DEFAULT_DB_PATH)
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        # sqlite connections can't be shared between threads, streamlit reruns run on different threads
+        self._local = threading.local()
+        self._products = LruCache(PRODUCT_CACHE_SIZE)
+        self._reviews = LruCache(REVIEW_CACHE_SIZE)
+        with self._connect() as conn:
+            conn.executescript(SCHEMA)
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute('pragma journal_mode=wal')
+            conn.execute('pragma synchronous=normal')
+            self._local.conn = conn
+        return conn
+
+    def ingest_product(self, content, domain='com'):
+        """
+        Store the parsed content of an amazon_product response.
+        """
+        asin = content['asin']
+        with self._connect() as conn:
+            conn.execute(
+                'insert or replace into products (asin, domain, title, content, updated_at) values (?, ?, ?, ?, ?)',
+                (asin, domain, content.get('title'), json.dumps(content, ensure_ascii=False), int(time.time())))
+        self._products.discard(lambda key: key == asin)
+
+    def ingest_reviews(self, asin, raw_reviews):
+        """
+        Store raw scraper reviews of an ASIN, reviews already stored are replaced.
+
+        :return: number of reviews written
+        """
+        rows = []
+        for review in raw_reviews:
+            if not review.get('id'):
+                continue
+            slim = slim_review(review)
+            rows.append((asin, slim['id'], slim['rating'], slim['title'], slim['content'], int(slim['verified']),
+                         slim['helpful'], slim['date'], json.dumps(review, ensure_ascii=False)))
+        with self._connect() as conn:
+            conn.executemany(
+                'insert or replace into reviews (asin, id, rating, title, content, verified, helpful, date, raw) '
+                'values (?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+        self._reviews.discard(lambda key: key[0] == asin)
+        return len(rows)
+
+    def ingest_response(self, response, domain='com'):
+        """
+        Store an amazon_product or amazon_reviews response of the scraper.
+        """
+        for result in response.get('results', []):
+            content = result.get('content') or {}
+            if 'reviews' in content:
+                self.ingest_reviews(content['asin'], content['reviews'] or [])
+            elif content.get('asin'):
+                self.ingest_product(content, domain)
+
+    def ingest_file(self, path):
+        """
+        Ingest a saved asin_<ASIN>_product.json / asin_<ASIN>_reviews.json or a harvested asin_<ASIN>_reviews.jsonl.
+        """
+        match = _SOURCE_FILE.match(os.path.basename(path))
+        if not match:
+            return
+        with open(path, 'r', encoding='utf-8') as file:
+            if match['ext'] == 'jsonl':
+                self.ingest_reviews(match['asin'], (json.loads(line) for line in file))
+            elif match['kind'] == 'reviews':
+                self.ingest_reviews(match['asin'], iter_raw_reviews(json.load(file)))
+            else:
+                self.ingest_response(json.load(file))
+
+    def sync_folder(self, folder):
+        """
+        Ingest the source files of a folder that are new or changed since the last sync.
+
+        :return: number of files ingested
+        """
+        if not os.path.isdir(folder):
+            return 0
+        conn = self._connect()
+        known = {path: (mtime, size) for path, mtime, size in conn.execute('select path, mtime, size from sources')}
+        ingested = 0
+        for name in sorted(os.listdir(folder)):
+            if not _SOURCE_FILE.match(name):
+                continue
+            path = os.path.abspath(os.path.join(folder, name))
+            stat = os.stat(path)
+            if known.get(path) == (stat.st_mtime, stat.st_size):
+                continue
+            self.ingest_file(path)
+            with conn:
+                conn.execute('insert or replace into sources (path, mtime, size) values (?, ?, ?)',
+                             (path, stat.st_mtime, stat.st_size))
+            ingested += 1
+        if ingested:
+            logger.info(f"catalog synced {ingested} files from {folder}")
+        return ingested
+
+    def list_asins(self, with_product=False, with_reviews=False):
+        """
+        ASINs in the catalog, optionally only those with a product page and / or reviews.
+        """
+        if with_product and with_reviews:
+            sql = 'select asin from products where asin in (select distinct asin from reviews) order by asin'
+        elif with_product:
+            sql = 'select asin from products order by asin'
+        elif with_reviews:
+            sql = 'select distinct asin from reviews order by asin'
+        else:
+            sql = 'select asin from products union select distinct asin from reviews order by asin'
+        return [row[0] for row in self._connect().execute(sql)]
+
+    def get_product(self, asin):
+        """
+        Parsed product content of an ASIN, None if it is not in the catalog.
+        """
+        product = self._products.get(asin)
+        if product is None:
+            row = self._connect().execute('select content from products where asin = ?', (asin,)).fetchone()
+            if row is None:
+                return None
+            product = json.loads(row[0])
+            self._products.put(asin, product)
+        return product
+
+    def iter_listings(self):
+        """
+        (asin, title, bullet_points, description) of every product, without parsing the whole product json.
+        """
+        return self._connect().execute(
+            "select asin, title, json_extract(content, '$.bullet_points'), json_extract(content, '$.description') "
+            "from products order by asin")
+
+    def products_version(self):
+        """
+        Changes whenever products are added or updated, for caches built from all products.
+        """
+        return tuple(self._connect().execute('select count(*), max(updated_at) from products').fetchone())
+
+    def iter_reviews(self, asin, since=None):
+        """
+        Slim reviews of an ASIN (see reviews.slim_review), only those dated on or after since ('YYYY-MM-DD') if given.
+        """
+        key = (asin, since)
+        reviews = self._reviews.get(key)
+        if reviews is None:
+            sql = 'select id, rating, title, content, verified, helpful, date from reviews where asin = ?'
+            params = [asin]
+            if since:
+                sql += ' and date >= ?'
+                params.append(since)
+            reviews = [
+                {'id': id, 'rating': rating, 'title': title, 'content': content, 'verified': bool(verified),
+                 'helpful': helpful, 'date': date}
+                for id, rating, title, content, verified, helpful, date in
+                self._connect().execute(sql + ' order by rowid', params)
+            ]
+            self._reviews.put(key, reviews)
+        return iter(reviews)
+
+    def count_reviews(self, asin):
+        return self._connect().execute('select count(*) from reviews where asin = ?', (asin,)).fetchone()[0]
+
+
+_catalog = None
+_catalog_synced_at = 0.0
+_catalog_lock = threading.Lock()
+
+
+def get_catalog():
+    """
+    The catalog shared by the pages. The data and harvested reviews folders are synced on first use and again
+    at most every SYNC_INTERVAL seconds, so reviews and products harvested later show up without a restart.
+    A sync only reads the files that are new or changed.
+    """
+    global _catalog, _catalog_synced_at
+    with _catalog_lock:
+        if _catalog is None:
+            _catalog = CatalogStore()
+        if time.time() - _catalog_synced_at >= SYNC_INTERVAL:
+            _catalog.sync_folder(os.getenv('data_folder') or './data/')
+            _catalog.sync_folder(os.getenv('reviews_folder', './data/reviews'))
+            _catalog_synced_at = time.time()
+        return _catalog
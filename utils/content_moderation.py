@@ -1,42 +1,14 @@
 import time
-import boto3
 import json
 import base64
-from PIL import Image
-import io
 
-bedrock_client = boto3.client(service_name = 'bedrock-runtime',region_name = 'us-west-2')
+from utils.aws_clients import get_bedrock_runtime
+from utils.image_prep import prepare_image
 
-def image_base64_encoder(image_path, max_size=1568):
-    with open(image_path, "rb") as f:
-        image_bytes = f.read()
+REGION = 'us-west-2'
+MODEL_ID = 'anthropic.claude-3-sonnet-20240229-v1:0'
 
-    img = Image.open(io.BytesIO(image_bytes))
-    width, height = img.size
-    img_format = img.format.lower()
-
-    if width > max_size or height > max_size:
-        if width > height:
-            new_width = max_size
-            new_height = int(height * (max_size / width))
-        else:
-            new_height = max_size
-            new_width = int(width * (max_size / height))
-
-        img = img.resize((new_width, new_height), resample=Image.Resampling.LANCZOS)
-
-    resized_bytes = io.BytesIO()
-    img.save(resized_bytes, format=img_format)
-    resized_bytes = resized_bytes.getvalue()
-
-    return resized_bytes, img_format
-
-
-def content_moderation_image(image_filename):
-
-    imagedata, image_type =image_base64_encoder(image_filename)
-
-    system_text='''
+IMAGE_SYSTEM_PROMPT = '''
 任务: 检测用户上传的图片是否对现有市场上的品牌、商标、版权作品等知识产权造成侵权。
 
 输入:
@@ -81,46 +53,8 @@ def content_moderation_image(image_filename):
 保持客观,给出基于事实的分析
 请根据上述要求,全面分析输入图片是否存在侵权风险,并生成详细的JSON格式输出。
 '''
-    system_prompts = [{"text" : system_text}]
-    text='判断用户上传的图片是否侵权，使用JSON格式返回，不要做任何多余解释。'
-
-    messages = [
-        {
-            "role": "user",
-            "content": [
-                {
-                    "text":text,
-                },
-                {    "image": {
-                        "format": image_type,
-                        "source": {
-                            "bytes": imagedata
-                        }
-                    }
-                }
-            ]
-        }
-    ]
-    #Base inference parameters to use.
-    inference_config = {"temperature": 0.1}
-    # Additional inference parameters to use.
-    additional_model_fields = {"top_k": 200}
-    response = bedrock_client.converse(
-        modelId='anthropic.claude-3-sonnet-20240229-v1:0',
-        messages=messages,
-        system=system_prompts,
-        inferenceConfig=inference_config,
-        additionalModelRequestFields=additional_model_fields,
-    )
-
-    return(response['output']['message']['content'])
 
-#content_result=content_moderation_image(image_data,image_type)
-#print(content_result)
-
-
-def content_moderation_text(text):
-    system_text='''
+TEXT_SYSTEM_PROMPT = '''
 Your task is to Identify and classify any inappropriate content in user given text, Identify inappropriate content in the provided categories in the <Categories>.
 
 </Categories>
@@ -153,7 +87,30 @@ self-harm/instructions: Content that encourages performing acts of self-harm, su
 </ResponseFormat>
 you should respond json only, no any other explanation.
 '''
-    system_prompts = [{"text" : system_text}]
+
+#Base inference parameters to use.
+INFERENCE_CONFIG = {"temperature": 0.1}
+# Additional inference parameters to use.
+ADDITIONAL_MODEL_FIELDS = {"top_k": 200}
+
+
+def parse_verdict(text):
+    """
+    first json object or array in the model output, code fences and surrounding prose are ignored
+    """
+    starts = [i for i in (text.find("{"), text.find("[")) if i >= 0]
+    if not starts:
+        raise ValueError(f"no json in model output: {text[:200]!r}")
+    value, _ = json.JSONDecoder().raw_decode(text[min(starts):])
+    return value
+
+
+def image_moderation_request(image_filename):
+    """
+    converse arguments of the moderation of one image, used by utils.moderation_batch as well
+    """
+    imagedata, image_type =prepare_image(image_filename)
+    text='判断用户上传的图片是否侵权，使用JSON格式返回，不要做任何多余解释。'
 
     messages = [
         {
@@ -161,22 +118,61 @@ you should respond json only, no any other explanation.
             "content": [
                 {
                     "text":text,
+                },
+                {    "image": {
+                        "format": image_type,
+                        "source": {
+                            "bytes": imagedata
+                        }
+                    }
                 }
             ]
         }
     ]
-    #Base inference parameters to use.
-    inference_config = {"temperature": 0.1}
-    # Additional inference parameters to use.
-    additional_model_fields = {"top_k": 200}
-    response = bedrock_client.converse(
-        modelId='anthropic.claude-3-sonnet-20240229-v1:0',
+    return dict(
+        modelId=MODEL_ID,
         messages=messages,
-        system=system_prompts,
-        inferenceConfig=inference_config,
-        additionalModelRequestFields=additional_model_fields,
+        system=[{"text" : IMAGE_SYSTEM_PROMPT}],
+        inferenceConfig=INFERENCE_CONFIG,
+        additionalModelRequestFields=ADDITIONAL_MODEL_FIELDS,
     )
 
+
+def content_moderation_image(image_filename):
+    response = get_bedrock_runtime(REGION).converse(**image_moderation_request(image_filename))
+
+    return(response['output']['message']['content'])
+
+#content_result=content_moderation_image(image_data,image_type)
+#print(content_result)
+
+
+def text_moderation_request(text, system_text=TEXT_SYSTEM_PROMPT):
+    """
+    converse arguments of the moderation of a text, used by utils.moderation_batch as well
+    """
+    messages = [
+        {
+            "role": "user",
+            "content": [
+                {
+                    "text":text,
+                }
+            ]
+        }
+    ]
+    return dict(
+        modelId=MODEL_ID,
+        messages=messages,
+        system=[{"text" : system_text}],
+        inferenceConfig=INFERENCE_CONFIG,
+        additionalModelRequestFields=ADDITIONAL_MODEL_FIELDS,
+    )
+
+
+def content_moderation_text(text):
+    response = get_bedrock_runtime(REGION).converse(**text_moderation_request(text))
+
     return(response['output']['message']['content'])
 
 text='I hate everyone.'
@@ -0,0 +1,128 @@
+"""
+Local fake of the Oxylabs realtime endpoint, serves the saved ./data/asin_*.json responses
+so the scraper clients can be tested offline.
+
+usage:
+    server, url = start_fake_server()
+    client = AmazonScraperClient(url=url)
+    ...
+    server.shutdown()
+
+or standalone:
+    python -m utils.fake_oxylabs 8765
+"""
+import os
+import json
+import time
+import random
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+data_folder = './data/'
+# synthetic bestseller lists
+BESTSELLER_PAGES = 2
+BESTSELLERS_PER_PAGE = 50
+
+
+def load_saved_response(source, asin):
+    kind = {'amazon_product': 'product', 'amazon_reviews': 'reviews'}.get(source)
+    filename = os.path.join(data_folder, f'asin_{asin}_{kind}.json')
+    if kind is None or not os.path.exists(filename):
+        return None
+    with open(filename, 'r', encoding='utf-8') as file:
+        return json.load(file)
+
+
+def fake_bestsellers(payload):
+    """
+    Bestseller pages led by the saved ASINs, the rest are synthetic ASINs without saved data.
+    """
+    page = payload.get('start_page', 1)
+    saved = sorted({name.split('_')[1] for name in os.listdir(data_folder) if name.startswith('asin_')})
+    results = []
+    for i in range(BESTSELLERS_PER_PAGE):
+        rank = (page - 1) * BESTSELLERS_PER_PAGE + i + 1
+        asin = saved[rank - 1] if rank <= len(saved) else f'B0FAKE{rank:04d}'
+        results.append({'asin': asin, 'pos': rank, 'title': f'Bestseller {rank}', 'price': 19.99, 'rating': 4.5,
+                        'ratings_count': 100, 'currency': 'USD'})
+    content = {'url': '', 'page': page, 'pages': BESTSELLER_PAGES, 'query': payload.get('query'),
+               'results': results if page <= BESTSELLER_PAGES else [], 'page_type': 'Bestsellers'}
+    return {'results': [{'content': content, 'status_code': 200}]}
+
+
+def fake_response(payload):
+    """
+    The saved response of the queried ASIN, or an empty parsed result shaped like Oxylabs output.
+    """
+    source = payload.get('source')
+    if source == 'amazon_bestsellers':
+        return fake_bestsellers(payload)
+    query = payload.get('query')
+    page = payload.get('start_page', 1)
+    response = load_saved_response(source, query)
+    if response is not None and source == 'amazon_reviews' and page > 1:
+        # later review pages repeat the saved first page with distinct review ids
+        for result in response['results']:
+            result['content']['page'] = page
+            for review in result['content'].get('reviews', []):
+                review['id'] = f"{review['id']}-{page}"
+    if response is None:
+        content = {'asin': query, 'page': page, 'pages': 1}
+        if source == 'amazon_reviews':
+            content['reviews'] = []
+        response = {'results': [{'content': content, 'status_code': 200}]}
+    return response
+
+
+class FakeOxylabsHandler(BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        payload = json.loads(self.rfile.read(length) or b'{}')
+        self.server.requests.append(payload)
+
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if random.random() < self.server.fail_rate:
+            self.send_response(503)
+            self.end_headers()
+            return
+
+        body = json.dumps(fake_response(payload)).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_fake_server(port=0, latency=0.0, fail_rate=0.0):
+    """
+    Start the fake endpoint in a background thread.
+
+    :param latency: seconds to wait before answering
+    :param fail_rate: share of requests answered with 503
+
+    :return: (server, url), server.requests lists the received payloads
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', port), FakeOxylabsHandler)
+    server.daemon_threads = True
+    server.latency = latency
+    server.fail_rate = fail_rate
+    server.requests = []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_address[1]}/v1/queries'
+
+
+if __name__ == '__main__':
+    import sys
+
+    server, url = start_fake_server(int(sys.argv[1]) if len(sys.argv) > 1 else 8765)
+    print(f'fake oxylabs endpoint on {url}')
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
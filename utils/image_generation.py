@@ -3,12 +3,16 @@ import io
 import os
 import json
 import logging
-import boto3
 from PIL import Image
 import time
 from enum import Enum, unique
 from botocore.exceptions import ClientError
 
+from utils.aws_clients import get_bedrock_runtime
+from utils.image_prep import prepare_image
+
+REGION = 'us-west-2'
+
 
 class ImageError(Exception):
     """
@@ -35,8 +39,7 @@ def generate_image_request(model_id, body):
     """
     logger.info(f"Generating image with model {model_id}")
     
-    bedrock = boto3.client(service_name="bedrock-runtime", region_name='us-west-2')
-    response = bedrock.invoke_model(body=body, modelId=model_id, accept="application/json", contentType="application/json")
+    response = get_bedrock_runtime(REGION).invoke_model(body=body, modelId=model_id, accept="application/json", contentType="application/json")
     response_body = json.loads(response.get("body").read())
     
     if model_id.startswith('stability'):
@@ -254,30 +257,10 @@ def generate_prompt_from_image(source_image, style):
 
     please give me text prompt only and no need any notes and explanation.
     '''
-    max_size=1568
     # source_image is a file name
-    with open(source_image, "rb") as f:
-        image_bytes = f.read()
-        img = Image.open(io.BytesIO(image_bytes))
-        width, height = img.size
-        img_format = img.format.lower()
-
-        if width > max_size or height > max_size:
-            if width > height:
-                new_width = max_size
-                new_height = int(height * (max_size / width))
-            else:
-                new_height = max_size
-                new_width = int(width * (max_size / height))
-
-            img = img.resize((new_width, new_height), Image.LANCZOS)
-
-        resized_bytes = io.BytesIO()
-        img.save(resized_bytes, format=img_format)
-        resized_bytes = resized_bytes.getvalue()
+    resized_bytes, img_format = prepare_image(source_image)
 
-    bedrock_client = boto3.client(service_name='bedrock-runtime', region_name='us-west-2')
-    response = bedrock_client.converse(
+    response = get_bedrock_runtime(REGION).converse(
         modelId='anthropic.claude-3-5-sonnet-20240620-v1:0',
         messages=[{"role": "user", "content": [{"text": user_text, }, {"image": {"format": img_format, "source": {"bytes": resized_bytes}}}]}],
         inferenceConfig={"temperature": 0.1},
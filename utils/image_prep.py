@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+image payloads for the bedrock converse api
+
+images within max_size in a format converse accepts are passed through as their original bytes, without
+decoding them. Larger images are downscaled, JPEGs through Image.draft so the decoder itself skips to 1/2, 1/4
+or 1/8 scale, other formats through Image.reduce before the final LANCZOS resize. Prepared payloads are
+memoized by content hash, so the same image sent again (reruns, moderation then listing) is prepared once.
+
+Several images of one request are prepared together by prepare_images: near duplicate photos are dropped
+and all images are downscaled by one factor so they fit a shared image token budget. A photo counts as a
+near duplicate if its gray hashes and its colours match, colour variants of one product are all sent.
+
+usage:
+    data, image_format = prepare_image("./data/upload/shoe.jpg")
+    content = [{"text": prompt}, image_block("./data/upload/shoe.jpg")]
+    content = [{"text": prompt}, *image_blocks(["./data/upload/shoe_1.jpg", "./data/upload/shoe_2.jpg"])]
+"""
+
+import hashlib
+import io
+import logging
+import math
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Final, Iterable
+
+from PIL import Image
+
+from utils.invoice_payload import MAX_IMAGES_PER_REQUEST, estimate_image_tokens, fit_image_size
+
+logger = logging.getLogger(__name__)
+
+# claude downscales images above a 1568 px long edge anyway
+DEFAULT_MAX_SIZE: Final[int] = 1568
+CONVERSE_FORMATS: Final[tuple] = ("png", "jpeg", "gif", "webp")
+JPEG_QUALITY: Final[int] = 85
+# modes PIL writes as png as they are, others are converted to RGB / RGBA first
+PNG_MODES: Final[tuple] = ("1", "L", "LA", "P", "RGB", "RGBA", "I;16")
+# prepared payloads kept in memory, by total bytes
+MEMO_MAX_BYTES: Final[int] = 64 * 1024 * 1024
+# pHash is taken from the 8x8 lowest frequencies of a 32x32 DCT, dHash from a 9x8 gradient
+PHASH_SIZE: Final[int] = 32
+HASH_SIZE: Final[int] = 8
+# image tokens of all images of one request, about five photos at full claude resolution
+DEFAULT_MAX_IMAGE_TOKENS: Final[int] = 8000
+# photos whose pHash and dHash are both within this Hamming distance count as the same shot
+DUPLICATE_DISTANCE: Final[int] = 4
+# and whose colours on a 4x4 grid differ by at most this mean per channel (0-255), so colour variants are kept
+COLOUR_GRID: Final[int] = 4
+COLOUR_DISTANCE: Final[float] = 12.0
+DEFAULT_WORKERS: Final[int] = 8
+
+
+class _PayloadMemo:
+    """
+    thread-safe LRU map bounded by the total size of the payloads
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._items: OrderedDict = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._items:
+                return None
+            self._items.move_to_end(key)
+            return self._items[key]
+
+    def put(self, key, value: tuple[bytes, str]):
+        with self._lock:
+            if key in self._items:
+                self._bytes -= len(self._items.pop(key)[0])
+            self._items[key] = value
+            self._bytes += len(value[0])
+            while self._bytes > self.max_bytes and len(self._items) > 1:
+                self._bytes -= len(self._items.popitem(last=False)[1][0])
+
+
+_memo = _PayloadMemo(MEMO_MAX_BYTES)
+
+
+def _target_size(width: int, height: int, max_size: int) -> tuple[int, int]:
+    scale = max_size / max(width, height)
+    return max(1, int(width * scale)), max(1, int(height * scale))
+
+
+def prepare_image_bytes(image_bytes: bytes, max_size: int = DEFAULT_MAX_SIZE) -> tuple[bytes, str]:
+    """
+    :return: (image bytes, converse format), the original bytes if no resize or conversion is needed
+    """
+    key = (hashlib.sha256(image_bytes).hexdigest(), max_size)
+    prepared = _memo.get(key)
+    if prepared is not None:
+        return prepared
+
+    # Image.open reads the header only, the pixels are decoded by resize / save
+    img = Image.open(io.BytesIO(image_bytes))
+    image_format = (img.format or "").lower()
+    width, height = img.size
+    if width <= max_size and height <= max_size and image_format in CONVERSE_FORMATS:
+        prepared = image_bytes, image_format
+    else:
+        # formats converse doesn't take (bmp, tiff, mpo, ..) are sent as png, or as jpeg for jpeg variants
+        if image_format not in CONVERSE_FORMATS:
+            image_format = "jpeg" if image_format == "mpo" else "png"
+        if width > max_size or height > max_size:
+            size = _target_size(width, height, max_size)
+            if img.format == "JPEG":
+                img.draft(img.mode, size)
+            img = img.resize(size, resample=Image.Resampling.LANCZOS, reducing_gap=3.0)
+        if image_format == "jpeg" and img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+        elif image_format == "png" and img.mode not in PNG_MODES:
+            # e.g. CMYK or YCbCr tiffs, png has no such modes
+            has_alpha = img.mode.endswith(("A", "a")) or "transparency" in img.info
+            img = img.convert("RGBA" if has_alpha else "RGB")
+        output = io.BytesIO()
+        if image_format == "jpeg":
+            img.save(output, format="jpeg", quality=JPEG_QUALITY)
+        else:
+            img.save(output, format=image_format)
+        prepared = output.getvalue(), image_format
+
+    _memo.put(key, prepared)
+    return prepared
+
+
+def prepare_image(image_path, max_size: int = DEFAULT_MAX_SIZE) -> tuple[bytes, str]:
+    """
+    prepare_image_bytes of an image file
+    """
+    with open(image_path, "rb") as f:
+        return prepare_image_bytes(f.read(), max_size)
+
+
+def image_block(image_path, max_size: int = DEFAULT_MAX_SIZE) -> dict:
+    """
+    converse content block of an image file
+    """
+    data, image_format = prepare_image(image_path, max_size)
+    return {"image": {"format": image_format, "source": {"bytes": data}}}
+
+
+def _dct_matrix(n: int):
+    import numpy as np
+
+    k = np.arange(n)[:, None]
+    matrix = np.cos(np.pi * (2 * np.arange(n)[None, :] + 1) * k / (2 * n)) * np.sqrt(2 / n)
+    matrix[0] /= np.sqrt(2)
+    return matrix
+
+
+def _bits_to_int(bits) -> int:
+    value = 0
+    for bit in bits.flatten():
+        value = (value << 1) | int(bit)
+    return value
+
+
+def _gray_hashes(gray: Image.Image) -> tuple[int, int]:
+    import numpy as np
+
+    small = np.asarray(gray.resize((PHASH_SIZE, PHASH_SIZE), Image.Resampling.LANCZOS), dtype=np.float64)
+    gradient = np.asarray(gray.resize((HASH_SIZE + 1, HASH_SIZE), Image.Resampling.LANCZOS), dtype=np.int16)
+
+    dct = _dct_matrix(PHASH_SIZE)
+    low = (dct @ small @ dct.T)[:HASH_SIZE, :HASH_SIZE]
+    # the DC term is left out of the median, it is the mean brightness only
+    phash = _bits_to_int(low > np.median(low.flatten()[1:]))
+    dhash = _bits_to_int(gradient[:, 1:] > gradient[:, :-1])
+    return phash, dhash
+
+
+def image_hashes(image) -> tuple[int, int]:
+    """
+    (pHash, dHash) of an image file or file object, 64 bit each
+
+    decoded at full size, the hashes are stored by the moderation cache and must not change
+    """
+    with Image.open(image) as img:
+        return _gray_hashes(img.convert("L"))
+
+
+def _hamming(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+
+def _inspect(image_path) -> tuple[bytes, tuple[int, int], tuple[int, int], tuple[int, ...]]:
+    """
+    (bytes, size, (pHash, dHash), colour signature) of an image file, the hashes of a draft decode, they are
+    only compared between the images of one request
+    """
+    with open(image_path, "rb") as f:
+        data = f.read()
+    with Image.open(io.BytesIO(data)) as img:
+        size = img.size
+        # JPEGs are decoded at 1/8 scale where possible
+        img.draft("RGB", (PHASH_SIZE * 4, PHASH_SIZE * 4))
+        rgb = img.convert("RGB")
+    colours = rgb.resize((COLOUR_GRID, COLOUR_GRID), Image.Resampling.BOX).tobytes()
+    return data, size, _gray_hashes(rgb.convert("L")), tuple(colours)
+
+
+def _same_shot(a: tuple, b: tuple, duplicate_distance: int) -> bool:
+    """
+    near duplicate hashes of the same colours, colour variants of one shot have about the same gray hashes
+    """
+    (phash_a, dhash_a), colours_a = a
+    (phash_b, dhash_b), colours_b = b
+    if _hamming(phash_a, phash_b) > duplicate_distance or _hamming(dhash_a, dhash_b) > duplicate_distance:
+        return False
+    return sum(abs(x - y) for x, y in zip(colours_a, colours_b)) / len(colours_a) <= COLOUR_DISTANCE
+
+
+def prepare_images(image_paths: Iterable, max_image_tokens: int = DEFAULT_MAX_IMAGE_TOKENS,
+                   max_images: int = MAX_IMAGES_PER_REQUEST, duplicate_distance: int = DUPLICATE_DISTANCE,
+                   workers: int = DEFAULT_WORKERS) -> list[tuple[bytes, str]]:
+    """
+    the images of one request, read, hashed and encoded in parallel threads
+
+    near duplicates of an earlier image are dropped, the rest keep their order and are downscaled by
+    one factor so their estimated image tokens fit max_image_tokens together
+
+    :return: [(image bytes, converse format)]
+    """
+    image_paths = list(image_paths)
+    if not image_paths:
+        return []
+    with ThreadPoolExecutor(max_workers=min(workers, len(image_paths))) as pool:
+        kept = []
+        for path, (data, size, hashes, colours) in zip(image_paths, pool.map(_inspect, image_paths)):
+            duplicate_of = next((other_path for other_path, _, _, other in kept
+                                 if _same_shot((hashes, colours), other, duplicate_distance)), None)
+            if duplicate_of is not None:
+                logger.info("%s dropped as a duplicate of %s", path, duplicate_of)
+                continue
+            kept.append((path, data, size, (hashes, colours)))
+        if len(kept) > max_images:
+            logger.info("%d images over the limit of %d dropped: %s", len(kept) - max_images, max_images,
+                        ", ".join(str(path) for path, _, _, _ in kept[max_images:]))
+        kept = kept[:max_images]
+
+        # the size claude would use, then one shared factor for the token budget
+        fitted = [fit_image_size(*size) for _, _, size, _ in kept]
+        tokens = sum(estimate_image_tokens(width, height) for width, height in fitted)
+        scale = min(1.0, math.sqrt(max_image_tokens / tokens))
+        max_sizes = [max(1, int(max(width, height) * scale)) for width, height in fitted]
+        return list(pool.map(prepare_image_bytes, [data for _, data, _, _ in kept], max_sizes))
+
+
+def image_blocks(image_paths: Iterable, **kwargs) -> list[dict]:
+    """
+    converse content blocks of the images of one request, see prepare_images
+    """
+    return [{"image": {"format": image_format, "source": {"bytes": data}}}
+            for data, image_format in prepare_images(image_paths, **kwargs)]
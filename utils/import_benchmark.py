@@ -0,0 +1,90 @@
+"""
+Measure the cold import time of the pages and utils modules.
+
+Each module is imported in a fresh interpreter with -X importtime, so nothing is shared between measurements,
+and the slowest imports it pulls in are listed. Modules whose dependencies are missing are reported as failed.
+
+usage:
+    python -m utils.import_benchmark
+    python -m utils.import_benchmark utils.voc_engine "pages/3_🌍_VOC.py" --repeat 5 --top 8
+"""
+import os
+import sys
+import glob
+import argparse
+import subprocess
+
+DEFAULT_TARGETS = sorted(
+    ['utils.' + os.path.basename(path)[:-3] for path in glob.glob('utils/*.py')
+     if not path.endswith(('__init__.py', 'import_benchmark.py'))]
+    + glob.glob('pages/*.py'))
+
+# the interpreter startup imports are logged before the marker, the elapsed time is logged last
+_BENCHMARK = '''
+import sys, time, importlib, importlib.util
+sys.stderr.write('--start--\\n')
+start = time.perf_counter()
+{code}
+sys.stderr.write('elapsed: %f\\n' % (time.perf_counter() - start))
+'''
+# pages are loaded as modules, not run, so their main() isn't called
+_IMPORT_PAGE = '''
+spec = importlib.util.spec_from_file_location('page', {path!r})
+spec.loader.exec_module(importlib.util.module_from_spec(spec))
+'''
+
+
+def _benchmark_code(target):
+    if target.endswith('.py'):
+        code = _IMPORT_PAGE.format(path=target)
+    else:
+        code = f'importlib.import_module({target!r})'
+    return _BENCHMARK.format(code=code)
+
+
+def measure(target):
+    """
+    Import a module or page in a fresh interpreter.
+
+    :return: (total ms, [(cumulative ms, imported module)] slowest first), total is None if the import failed
+    """
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', _benchmark_code(target)],
+                            capture_output=True, text=True)
+    if result.returncode != 0:
+        lines = result.stderr.strip().splitlines()
+        return None, lines[-1] if lines else f'exit code {result.returncode}'
+
+    imports = []
+    total = None
+    started = False
+    for line in result.stderr.splitlines():
+        if line == '--start--':
+            started = True
+        elif line.startswith('elapsed:'):
+            total = float(line.split()[1]) * 1000
+        elif started and line.startswith('import time:'):
+            fields = line[len('import time:'):].split('|')
+            imports.append((int(fields[1]) / 1000, fields[2].strip()))
+    return total, sorted(imports, reverse=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('targets', nargs='*', default=DEFAULT_TARGETS, help='modules or page files')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per target, the fastest is reported')
+    parser.add_argument('--top', type=int, default=5, help='slowest imports listed per target')
+    args = parser.parse_args()
+
+    for target in args.targets:
+        runs = [measure(target) for _ in range(args.repeat)]
+        if runs[0][0] is None:
+            print(f'{target}: failed, {runs[0][1]}')
+            continue
+        total, imports = min(runs, key=lambda run: run[0])
+        print(f'{target}: {total:.0f} ms')
+        for ms, name in [item for item in imports if item[1] != target][:args.top]:
+            print(f'    {ms:8.1f} ms  {name}')
+
+
+if __name__ == '__main__':
+    main()
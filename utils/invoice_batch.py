@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+batch invoice extraction
+
+invoices are preprocessed in a thread pool, bedrock calls share one pooled client and are
+bounded by an adaptive concurrency limit, results are streamed as they finish.
+
+usage:
+    python -m utils.invoice_batch ./data/invoice ./invoice_results.jsonl
+"""
+
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Final, Iterable, Iterator, Optional
+
+from utils.bedrock_throttle import AdaptiveLimiter, bounded_map, call_with_backoff
+from utils.invoice_cache import InvoiceCache
+from utils.invoice_extract import ImageInvoiceExtractor, create_extractor
+from utils.invoice_payload import PayloadBudget
+from utils.invoice_record import parse_invoice_records
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_CONCURRENCY: Final[int] = 8
+DEFAULT_MAX_ATTEMPTS: Final[int] = 6
+INVOICE_SUFFIXES: Final[tuple] = (".pdf", ".png", ".jpg", ".jpeg", ".webp", ".tif", ".tiff")
+
+
+def _invoke(extractor: ImageInvoiceExtractor, body: str, limiter: AdaptiveLimiter, max_attempts: int,
+            record: dict) -> str:
+    def count_attempt():
+        record["attempts"] += 1
+
+    # the client makes one attempt per call, call_with_backoff alone decides the retries
+    return call_with_backoff(lambda: extractor.invoke(body, retries=False), limiter, max_attempts, record["file"],
+                             count_attempt)
+
+
+def _extract_one(file_path: str, limiter: AdaptiveLimiter, max_attempts: int,
+                 cache: Optional[InvoiceCache], budget: Optional[PayloadBudget]) -> dict:
+    start = time.perf_counter()
+    record = {"file": file_path, "status": "ok", "result": None, "error": None, "attempts": 0, "cached": False}
+    try:
+        # invoices already run in parallel, so pdf pages are processed inline
+        extractor = create_extractor(file_path, max_workers=1, cache=cache, budget=budget)
+        cached = extractor.cached_result()
+        if cached is not None:
+            record["cached"] = True
+            record["result"] = [item.to_dict() for item in parse_invoice_records(cached)]
+            record["seconds"] = round(time.perf_counter() - start, 3)
+            return record
+
+        def invoke(body: str) -> str:
+            return _invoke(extractor, body, limiter, max_attempts, record)
+
+        # an invalid output only sends its own request again
+        results = [extractor.invoke_records(body, invoke) for body in extractor.build_requests()]
+        record["result"] = [item.to_dict() for item in extractor.merge_results(results)]
+    except Exception as err:
+        logger.error("%s failed: %s", file_path, err)
+        record["status"] = "error"
+        record["error"] = f"{type(err).__name__}: {err}"
+    record["seconds"] = round(time.perf_counter() - start, 3)
+    return record
+
+
+def extract_many(paths: Iterable[str],
+                 max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+                 output_path: Optional[str] = None,
+                 max_attempts: int = DEFAULT_MAX_ATTEMPTS,
+                 cache: Optional[InvoiceCache] = None,
+                 budget: Optional[PayloadBudget] = None) -> Iterator[dict]:
+    """
+    extract many invoices, yield one record per invoice in completion order
+
+    :param paths: invoice file paths, pdf or image
+    :param max_concurrency: max bedrock calls in flight
+    :param output_path: if set, append one json line per invoice to this file
+    :param max_attempts: max bedrock attempts per request when throttled
+    :param cache: cache for preprocessing artifacts and results
+    :param budget: image token and byte budget per bedrock request
+    :return: iterator of {"file", "status", "result", "error", "attempts", "cached", "seconds"},
+             result is the list of validated invoice dicts
+    """
+    limiter = AdaptiveLimiter(max_concurrency)
+    # extra threads keep preprocessing going while bedrock calls are in flight
+    max_workers = max_concurrency + (os.cpu_count() or 1)
+    output = open(output_path, "a", encoding="utf-8") if output_path else None
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            def extract(path):
+                return _extract_one(str(path), limiter, max_attempts, cache, budget)
+
+            for record in bounded_map(executor, extract, paths, 2 * max_workers):
+                if output:
+                    output.write(json.dumps(record, ensure_ascii=False) + "\n")
+                    output.flush()
+                yield record
+    finally:
+        if output:
+            output.close()
+
+
+def list_invoices(folder: str) -> list[str]:
+    """
+    list invoice files in a folder, sorted by name
+    """
+    return sorted(str(path) for path in Path(folder).iterdir() if path.suffix.lower() in INVOICE_SUFFIXES)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="extract all invoices in a folder into a jsonl file")
+    parser.add_argument("folder")
+    parser.add_argument("output")
+    parser.add_argument("--max-concurrency", type=int, default=DEFAULT_MAX_CONCURRENCY)
+    parser.add_argument("--no-cache", action="store_true")
+    args = parser.parse_args()
+
+    files = list_invoices(args.folder)
+    invoice_cache = None if args.no_cache else InvoiceCache()
+    started = time.perf_counter()
+    failed = 0
+    for i, item in enumerate(extract_many(files, args.max_concurrency, args.output, cache=invoice_cache), start=1):
+        failed += item["status"] != "ok"
+        print(f"[{i}/{len(files)}] {item['status']} {item['file']} {item['seconds']}s")
+    print(f"{len(files)} invoices, {failed} failed, {time.perf_counter() - started:.1f}s")
+    if invoice_cache:
+        print(f"cache: {invoice_cache.stats}")
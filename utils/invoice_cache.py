@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+content addressed on-disk cache for invoice extraction
+
+two layers are kept:
+    - preprocess: OCR text and WebP pages, keyed by file content and preprocessing parameters
+    - result: claude output, keyed by file content, preprocessing parameters, prompt and model
+so a prompt only change reuses the preprocessing artifacts.
+
+entries are evicted least recently used first once the cache grows over max_bytes.
+"""
+
+import hashlib
+import json
+import os
+import threading
+from pathlib import Path
+from typing import Final, Optional
+
+# bump when the preprocessing output changes, so old artifacts are not reused
+PREPROCESS_VERSION: Final[str] = "2"
+DEFAULT_CACHE_FOLDER: Final[str] = "./.cache/invoice"
+DEFAULT_MAX_BYTES: Final[int] = 1024 * 1024 * 1024
+LAYERS: Final[tuple] = ("preprocess", "result")
+
+
+def file_digest(file_path: str) -> str:
+    """
+    sha256 of the file content
+    """
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def make_key(*parts: str) -> str:
+    return hashlib.sha256("\0".join(parts).encode("utf-8")).hexdigest()
+
+
+class InvoiceCache:
+    """
+    Invoice Cache
+    """
+
+    def __init__(self, cache_folder: Optional[str] = None, max_bytes: int = DEFAULT_MAX_BYTES):
+        """
+        :param cache_folder: cache folder, default to env invoice_cache_folder or ./.cache/invoice
+        :param max_bytes: max total size of the cache entries
+        """
+        self._root = Path(cache_folder or os.getenv("invoice_cache_folder", DEFAULT_CACHE_FOLDER))
+        self._max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self.stats: dict[str, dict[str, int]] = {layer: {"hits": 0, "misses": 0} for layer in LAYERS}
+        for layer in LAYERS:
+            (self._root / layer).mkdir(parents=True, exist_ok=True)
+        self._size = sum(path.stat().st_size for path in self._entries())
+
+    def _entries(self) -> list[Path]:
+        return [path for layer in LAYERS for path in (self._root / layer).glob("*/*.json")]
+
+    def _path(self, layer: str, key: str) -> Path:
+        return self._root / layer / key[:2] / f"{key}.json"
+
+    def get(self, layer: str, key: str) -> Optional[dict]:
+        path = self._path(layer, key)
+        with self._lock:
+            try:
+                data = json.loads(path.read_text(encoding="utf-8"))
+                # mtime is the last access time used by eviction
+                os.utime(path)
+            except (OSError, ValueError):
+                self.stats[layer]["misses"] += 1
+                return None
+            self.stats[layer]["hits"] += 1
+            return data
+
+    def put(self, layer: str, key: str, value: dict):
+        path = self._path(layer, key)
+        data = json.dumps(value, ensure_ascii=False).encode("utf-8")
+        with self._lock:
+            path.parent.mkdir(exist_ok=True)
+            if path.exists():
+                self._size -= path.stat().st_size
+            # write to a temp file first, readers never see a partial entry
+            tmp_path = path.with_suffix(f".{threading.get_ident()}.tmp")
+            tmp_path.write_bytes(data)
+            os.replace(tmp_path, path)
+            self._size += len(data)
+            if self._size > self._max_bytes:
+                self._evict()
+
+    def _evict(self):
+        """
+        delete least recently used entries until the cache is below 90% of max_bytes
+        """
+        entries = []
+        for path in self._entries():
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        entries.sort()
+        self._size = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if self._size <= self._max_bytes * 0.9:
+                break
+            path.unlink(missing_ok=True)
+            self._size -= size
+
+    def get_preprocessed(self, key: str) -> Optional[tuple[list[str], list[str]]]:
+        data = self.get("preprocess", key)
+        return (data["texts"], data["images"]) if data else None
+
+    def put_preprocessed(self, key: str, texts: list[str], images: list[str]):
+        self.put("preprocess", key, {"texts": texts, "images": images})
+
+    def get_result(self, key: str) -> Optional[str]:
+        data = self.get("result", key)
+        return data["result"] if data else None
+
+    def put_result(self, key: str, result: str):
+        self.put("result", key, {"result": result})
@@ -11,20 +11,60 @@ ref:
 import base64
 import io
 import json
-from typing import Final
+import logging
+import os
+import time
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Callable, Final, Optional
 
-import boto3
-import numpy as np
-import pdfplumber
-import pytesseract
 from PIL import Image
-from pdf2image import convert_from_path
 
-# https://docs.anthropic.com/en/docs/build-with-claude/vision#evaluate-image-size
-# the max image height: 1568
-IMAGE_MAX_HEIGHT: Final[int] = 1568
-# the max image height: 1092
-IMAGE_MAX_WIDTH: Final[int] = 1092
+from utils.aws_clients import get_bedrock_runtime
+from utils.invoice_cache import PREPROCESS_VERSION, InvoiceCache, file_digest, make_key
+from utils.invoice_ocr import TesseractOcrEngine
+from utils.invoice_payload import PayloadBudget, fit_image_size, plan_payloads
+from utils.invoice_record import InvoiceParseError, InvoiceRecord, merge_records, parse_invoice_records, \
+    records_to_json
+
+logger = logging.getLogger(__name__)
+
+# the default dpi used to rasterize pdf pages
+PDF_DPI: Final[int] = 200
+MODEL_ID: Final[str] = "anthropic.claude-3-haiku-20240307-v1:0"
+SYSTEM_PROMPT: Final[str] = "You are a financial staff responsible for identifying and entering procurement invoices."
+# model calls per request when the output can't be parsed or validated
+MAX_PARSE_ATTEMPTS: Final[int] = 2
+REGION: Final[str] = "us-east-1"
+
+
+def _pre_process_page(text: Optional[str], image: Image) -> (str, str, dict[str, float]):
+    """
+    preprocessing a single page for claude, run in a worker process
+        1. rotate image and OCR it if necessary
+        2. keep image size in proper size
+        3. convert image to webp format
+        4. convert image to base64 encoding
+
+    :return: [page text content,page image base64 encoding,seconds spent in each stage]
+    """
+    page = TesseractOcrEngine().process(image, text)
+    image = page.image
+
+    start = time.perf_counter()
+    # keep the largest size claude uses, the payload planner downscales further if the request is over budget
+    # https://docs.anthropic.com/en/docs/build-with-claude/vision#evaluate-image-size
+    size = fit_image_size(*image.size)
+    if size != image.size:
+        image = image.resize(size)
+
+    # reformat to webp
+    buffer = io.BytesIO()
+    image.save(buffer, format="webp", quality=85)
+    image_data = buffer.getvalue()
+    page.timings["encode"] = time.perf_counter() - start
+    # base64 encode image
+    return page.text, base64.b64encode(image_data).decode("utf-8"), page.timings
 
 
 class ImageInvoiceExtractor:
@@ -32,8 +72,18 @@ class ImageInvoiceExtractor:
     Pdf Invoice Extractor
     """
 
-    def __init__(self, file_path: str):
+    def __init__(self, file_path: str, cache: Optional[InvoiceCache] = None, budget: Optional[PayloadBudget] = None):
+        """
+        :param file_path: image file path
+        :param cache: cache for preprocessing artifacts and results, no caching if None
+        :param budget: image token and byte budget per bedrock request
+        """
         self._file_path = file_path
+        self._cache = cache
+        self._budget = budget or PayloadBudget()
+        self._file_digest: Optional[str] = None
+        # seconds spent in each preprocessing stage, one dict per page
+        self.page_timings: list[dict[str, float]] = []
         self._prompts_template: str = """
                         The unformated raw text in the image is pre parsed in messages's content,text start with 'Image N:',N represents the sequence number of images.
                         Please prioritize messages's content results when responding, and keep the exact spelling of words in uppercase and lowercase letters.
@@ -75,7 +125,7 @@ class ImageInvoiceExtractor:
                         Please note that output is a JSON array according to <json_format> structure,and it's must can be directly parsed as json array.
                         """
 
-    def _pre_process_images(self, texts: list[str], images: list[str]) -> (list[str], list[str]):
+    def _pre_process_images(self, texts: list[Optional[str]], images: list[Image]) -> (list[str], list[str]):
         """
         preprocessing image for claude
             1. keep image size in proper size
@@ -91,36 +141,9 @@ class ImageInvoiceExtractor:
         images_base64: list[str] = []
 
         for i, image in enumerate(images):
-            # detect orientation and rotate
-            # https://notes-of-python.readthedocs.io/zh/latest/python/python-notes-for-ocr-with-tesseract/
-            orientation = pytesseract.image_to_osd(
-                np.array(image),
-                output_type=pytesseract.Output.DICT
-            )["orientation"]
-            # rotate images
-            if orientation != 0:
-                image = Image.fromarray(np.rot90(np.array(image), k=orientation // 90))
-                texts[i] = pytesseract.image_to_string(image, config="-l chi_sim+eng")
-
-            # get image's width,height
-            width, height = image.size
-            # get image's max long edge
-            max_size = max(width, height)
-            # if image's long edge is larger than 1568, resize max long edge to 1568
-            if max_size > IMAGE_MAX_WIDTH:
-                # resize image's with
-                width = round(width * IMAGE_MAX_WIDTH / max_size)
-                # resize image's height
-                height = round(height * IMAGE_MAX_WIDTH / max_size)
-                # resize image
-                image = image.resize((width, height))
-
-            # reformat to webp
-            buffer = io.BytesIO()
-            image.save(buffer, format="webp", quality=85)
-            image_data = buffer.getvalue()
-            # base64 encode image
-            images_base64.append(base64.b64encode(image_data).decode("utf-8"))
+            texts[i], image_base64, timings = _pre_process_page(texts[i], image)
+            images_base64.append(image_base64)
+            self._record_timings(timings)
 
         return texts, images_base64
 
@@ -138,18 +161,65 @@ class ImageInvoiceExtractor:
         """
 
         images: list[Image] = [Image.open(self._file_path)]
-        texts: list[str] = [pytesseract.image_to_string(image, config="-l chi_sim+eng") for image in images]
+        # OCR runs once, after orientation detection
+        texts: list[Optional[str]] = [None for _ in images]
 
         return self._pre_process_images(texts, images)
 
-    def extract(self) -> str:
+    def _pre_process_params(self) -> str:
+        """
+        parameters that change the preprocessing output, part of the cache key
+        """
+        return "image"
+
+    def _preprocess_key(self) -> str:
+        if self._file_digest is None:
+            self._file_digest = file_digest(self._file_path)
+        return make_key(self._file_digest, PREPROCESS_VERSION, self._pre_process_params())
+
+    def _result_key(self) -> str:
+        return make_key(self._preprocess_key(), MODEL_ID, SYSTEM_PROMPT, self._prompts_template, repr(self._budget))
+
+    def _pre_process_cached(self) -> (list[str], list[str]):
+        if self._cache is None:
+            return self._pre_process()
+        key = self._preprocess_key()
+        cached = self._cache.get_preprocessed(key)
+        if cached is not None:
+            return cached
         texts, images = self._pre_process()
+        self._cache.put_preprocessed(key, texts, images)
+        return texts, images
 
+    def cached_result(self) -> Optional[str]:
+        """
+        :return: the cached model output of this invoice, None if not cached
+        """
+        if self._cache is None:
+            return None
+        return self._cache.get_result(self._result_key())
+
+    def _record_timings(self, timings: dict[str, float]):
+        self.page_timings.append(timings)
+        logger.info("%s page %d: %s", self._file_path, len(self.page_timings),
+                    ", ".join(f"{stage}={seconds:.3f}s" for stage, seconds in timings.items()))
+
+    def build_requests(self) -> list[str]:
+        """
+        preprocess the invoice and build the bedrock request bodies,
+        pages are split into several requests when they don't fit the payload budget
+
+        :return: json request bodies
+        """
+        texts, images = self._pre_process_cached()
+        return [self._build_request(pages) for pages in plan_payloads(texts, images, self._budget)]
+
+    def _build_request(self, pages: list) -> str:
         _content = []
-        for i, val in enumerate(texts):
+        for page in pages:
             _text = {
                 "type": "text",
-                "text": f"Image {i}: {val}"
+                "text": f"Image {page.index}: {page.text}"
             }
             _content.append(_text)
 
@@ -158,7 +228,7 @@ class ImageInvoiceExtractor:
                 "source": {
                     "type": "base64",
                     "media_type": "image/webp",
-                    "data": images[i],
+                    "data": page.image_base64,
                 },
             }
             _content.append(_image)
@@ -172,7 +242,7 @@ class ImageInvoiceExtractor:
         body = json.dumps({
             "anthropic_version": "bedrock-2023-05-31",
             "max_tokens": 2048,
-            "system": "You are a financial staff responsible for identifying and entering procurement invoices.",
+            "system": SYSTEM_PROMPT,
             "messages": [
                 {
                     "role": "user",
@@ -180,23 +250,94 @@ class ImageInvoiceExtractor:
                 }
             ],
         }, ensure_ascii=False)
+        return body
+
+    def invoke(self, body: str, retries: bool = True) -> str:
+        """
+        send the request body to claude
 
-        bedrock_runtime = boto3.client(service_name='bedrock-runtime', region_name="us-east-1")
-        response = bedrock_runtime.invoke_model(
+        :param retries: False for a single attempt, when the caller retries throttled requests itself
+        :return: model output text
+        """
+        response = get_bedrock_runtime(REGION, retries).invoke_model(
             body=body,
-            modelId="anthropic.claude-3-haiku-20240307-v1:0"
+            modelId=MODEL_ID
         )
         result = json.loads(response.get('body').read())["content"][0]["text"]
         return result
 
+    def invoke_records(self, body: str, invoke: Optional[Callable[[str], str]] = None,
+                       max_attempts: int = MAX_PARSE_ATTEMPTS) -> list[InvoiceRecord]:
+        """
+        send the request body to claude and parse the output,
+        only this request is sent again if the output is invalid
+
+        :param invoke: function sending the body, default to self.invoke
+        :raise InvoiceParseError: if the output is still invalid after max_attempts
+        """
+        invoke = invoke or self.invoke
+        for attempt in range(max_attempts):
+            result = invoke(body)
+            try:
+                return parse_invoice_records(result)
+            except InvoiceParseError as err:
+                if attempt == max_attempts - 1:
+                    raise
+                logger.warning("%s invalid output, retrying: %s", self._file_path, err)
+
+    def merge_results(self, results: list[list[InvoiceRecord]]) -> list[InvoiceRecord]:
+        """
+        merge the records of all requests and cache them
+        """
+        records = merge_records(results)
+        if self._cache is not None:
+            self._cache.put_result(self._result_key(), records_to_json(records))
+        return records
+
+    def extract_records(self) -> list[InvoiceRecord]:
+        cached = self.cached_result()
+        if cached is not None:
+            return parse_invoice_records(cached)
+        return self.merge_results([self.invoke_records(body) for body in self.build_requests()])
+
+    def extract(self) -> str:
+        """
+        :return: validated invoices as a json array
+        """
+        return records_to_json(self.extract_records())
+
 
 class PdfInvoiceExtractor(ImageInvoiceExtractor):
     """
     Pdf Invoice Extractor
     """
 
-    def __init__(self, file_path: str):
-        super().__init__(file_path)
+    def __init__(self, file_path: str, max_workers: Optional[int] = None, dpi: int = PDF_DPI,
+                 cache: Optional[InvoiceCache] = None, budget: Optional[PayloadBudget] = None):
+        """
+        :param file_path: pdf file path
+        :param max_workers: number of processes used to preprocess pages, default to cpu count, 1 disables the pool
+        :param dpi: dpi used to rasterize pdf pages
+        :param cache: cache for preprocessing artifacts and results, no caching if None
+        :param budget: image token and byte budget per bedrock request
+        """
+        super().__init__(file_path, cache, budget)
+        self._max_workers = max_workers or os.cpu_count() or 1
+        self._dpi = dpi
+
+    def _pre_process_params(self) -> str:
+        return f"pdf:dpi={self._dpi}"
+
+    def _rasterize_page(self, page_number: int) -> Image:
+        """
+        rasterize a single pdf page, so only the pages in flight are held in memory
+
+        :param page_number: 1-based page number
+        """
+        # pdf libraries are imported on first use, image invoices and page cold start don't need them
+        from pdf2image import convert_from_path
+
+        return convert_from_path(self._file_path, dpi=self._dpi, first_page=page_number, last_page=page_number)[0]
 
     def _pre_process(self) -> (list[str], list[str]):
         """
@@ -206,25 +347,73 @@ class PdfInvoiceExtractor(ImageInvoiceExtractor):
             3. convert image to webp format
             4. convert image to base64 encoding
 
+        pages are rasterized one by one and fanned out to a process pool,
+        results are put back in page order.
+
         ref: https://docs.anthropic.com/en/docs/build-with-claude/vision#evaluate-image-size
 
         :return: [list of pdf page text content,list of pdf page image base64 encoding]
         """
+        import pdfplumber
+
         texts: list[str] = []
         with pdfplumber.open(self._file_path) as pdf:
             for page in pdf.pages:
                 text = page.extract_text()
                 texts.append(text)
 
-        # convert pdf to images
-        images: list[Image] = convert_from_path(self._file_path)
-        return self._pre_process_images(texts, images)
+        page_count = len(texts)
+        images_base64: list[str] = []
+        if self._max_workers <= 1 or page_count <= 1:
+            # process page by page in this process, the pool start up cost is not worth it
+            for i in range(page_count):
+                texts[i], image_base64, timings = _pre_process_page(texts[i], self._rasterize_page(i + 1))
+                images_base64.append(image_base64)
+                self._record_timings(timings)
+            return texts, images_base64
+
+        # at most 2 pages per worker are rasterized and waiting, which bounds the memory
+        max_in_flight = self._max_workers * 2
+        pending: deque[Future] = deque()
+
+        def _collect():
+            # futures are collected in submission order, so results stay in page order
+            text, image_base64, timings = pending.popleft().result()
+            texts[len(images_base64)] = text
+            images_base64.append(image_base64)
+            self._record_timings(timings)
+
+        with ProcessPoolExecutor(max_workers=min(self._max_workers, page_count)) as executor:
+            for i in range(page_count):
+                if len(pending) >= max_in_flight:
+                    _collect()
+                pending.append(executor.submit(_pre_process_page, texts[i], self._rasterize_page(i + 1)))
+            while pending:
+                _collect()
+
+        return texts, images_base64
+
+
+def create_extractor(file_path: str, max_workers: Optional[int] = None, cache: Optional[InvoiceCache] = None,
+                     budget: Optional[PayloadBudget] = None) -> ImageInvoiceExtractor:
+    """
+    create the extractor matching the invoice file type
+
+    :param max_workers: number of processes used to preprocess pdf pages
+    :param cache: cache for preprocessing artifacts and results
+    :param budget: image token and byte budget per bedrock request
+    """
+    if file_path.lower().endswith(".pdf"):
+        return PdfInvoiceExtractor(file_path, max_workers=max_workers, cache=cache, budget=budget)
+    return ImageInvoiceExtractor(file_path, cache, budget)
 
 
 if __name__ == '__main__':
-    pdf_extractor = PdfInvoiceExtractor("../data/invoice/invoice_sample_1.pdf")
+    invoice_cache = InvoiceCache()
+    pdf_extractor = PdfInvoiceExtractor("../data/invoice/invoice_sample_1.pdf", cache=invoice_cache)
     result = pdf_extractor.extract()
     print(result)
+    print(invoice_cache.stats)
     # image_extractor = ImageInvoiceExtractor("../data/invoice/invoice_sample_2.png")
     # result = image_extractor.extract()
     # print(result)
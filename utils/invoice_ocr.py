@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+OCR engine for invoice pages
+
+every page goes through orientation detection first and is OCRed at most once,
+at the corrected orientation. text already extracted from the pdf text layer is reused.
+
+ref:
+    - https://github.com/tesseract-ocr/tesseract/blob/main/doc/tesseract.1.asc
+"""
+
+import time
+from dataclasses import dataclass, field
+from typing import Final, Optional
+
+from PIL import Image
+
+# tesseract languages used for invoices
+OCR_LANG: Final[str] = "chi_sim+eng"
+
+
+@dataclass
+class OcrPage:
+    """
+    result of running a page through the ocr engine
+    """
+    text: str
+    image: Image
+    orientation: int = 0
+    ocr_skipped: bool = False
+    # seconds spent in each stage, e.g. {"osd": 0.4, "ocr": 1.2}
+    timings: dict[str, float] = field(default_factory=dict)
+
+
+class TesseractOcrEngine:
+    """
+    Tesseract OCR engine
+    """
+
+    def __init__(self, lang: str = OCR_LANG):
+        self._config = f"-l {lang}"
+
+    def detect_orientation(self, image: Image) -> int:
+        """
+        detect page orientation in degrees, 0 when tesseract can't decide (e.g. too few characters)
+        """
+        # imported on first use, so importing the extractors doesn't load the OCR stack
+        import pytesseract
+
+        try:
+            return pytesseract.image_to_osd(image, output_type=pytesseract.Output.DICT)["orientation"]
+        except pytesseract.TesseractError:
+            return 0
+
+    def ocr(self, image: Image) -> str:
+        import pytesseract
+
+        return pytesseract.image_to_string(image, config=self._config)
+
+    def process(self, image: Image, text: Optional[str] = None) -> OcrPage:
+        """
+        detect orientation, rotate the page, and OCR it exactly once
+
+        :param image: page image
+        :param text: text from the pdf text layer, OCR is skipped when it is not empty
+        """
+        timings: dict[str, float] = {}
+
+        start = time.perf_counter()
+        orientation = self.detect_orientation(image)
+        if orientation != 0:
+            image = image.rotate(orientation, expand=True)
+        timings["osd"] = time.perf_counter() - start
+
+        ocr_skipped = bool(text and text.strip())
+        if not ocr_skipped:
+            start = time.perf_counter()
+            text = self.ocr(image)
+            timings["ocr"] = time.perf_counter() - start
+
+        return OcrPage(text=text, image=image, orientation=orientation, ocr_skipped=ocr_skipped, timings=timings)
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+payload planner for claude vision requests
+
+pages are packed into as few requests as possible, each request keeps its images within
+a token and byte budget by lowering the resolution first and the webp quality second.
+
+ref:
+    - https://docs.anthropic.com/en/docs/build-with-claude/vision#evaluate-image-size
+"""
+
+import base64
+import io
+import math
+from dataclasses import dataclass
+from typing import Final
+
+from PIL import Image
+
+# claude image tokens are about width * height / 750
+PIXELS_PER_TOKEN: Final[int] = 750
+# images above 1568 long edge or 1.15 megapixels are downscaled by claude anyway
+IMAGE_MAX_LONG_EDGE: Final[int] = 1568
+IMAGE_MAX_PIXELS: Final[int] = 1_150_000
+# below this long edge small invoice print is no longer legible
+IMAGE_MIN_LONG_EDGE: Final[int] = 768
+# max images in one bedrock claude request
+MAX_IMAGES_PER_REQUEST: Final[int] = 20
+WEBP_QUALITIES: Final[tuple] = (85, 75, 60, 45)
+
+
+@dataclass
+class PayloadBudget:
+    """
+    per request budget, the image tokens and the base64 image bytes
+    """
+    max_image_tokens: int = 12000
+    max_image_bytes: int = 8 * 1024 * 1024
+    max_images: int = MAX_IMAGES_PER_REQUEST
+    min_long_edge: int = IMAGE_MIN_LONG_EDGE
+
+
+@dataclass
+class PayloadPage:
+    index: int
+    text: str
+    image_base64: str
+    width: int
+    height: int
+
+
+def estimate_image_tokens(width: int, height: int) -> int:
+    return math.ceil(width * height / PIXELS_PER_TOKEN)
+
+
+def fit_image_size(width: int, height: int) -> (int, int):
+    """
+    the largest size claude uses without downscaling
+    """
+    scale = min(1.0, IMAGE_MAX_LONG_EDGE / max(width, height), math.sqrt(IMAGE_MAX_PIXELS / (width * height)))
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def _min_scale(page: PayloadPage, budget: PayloadBudget) -> float:
+    return min(1.0, budget.min_long_edge / max(page.width, page.height))
+
+
+def _min_tokens(page: PayloadPage, budget: PayloadBudget) -> int:
+    scale = _min_scale(page, budget)
+    return estimate_image_tokens(round(page.width * scale), round(page.height * scale))
+
+
+def _encode(page: PayloadPage, scale: float, quality: int) -> PayloadPage:
+    """
+    the page with its image re-encoded, width and height are the ones of the new image
+    """
+    image = Image.open(io.BytesIO(base64.b64decode(page.image_base64)))
+    if scale < 1.0:
+        image = image.resize((max(1, round(page.width * scale)), max(1, round(page.height * scale))))
+    buffer = io.BytesIO()
+    image.save(buffer, format="webp", quality=quality)
+    image_base64 = base64.b64encode(buffer.getvalue()).decode("utf-8")
+    return PayloadPage(page.index, page.text, image_base64, image.width, image.height)
+
+
+def _group_pages(pages: list[PayloadPage], budget: PayloadBudget) -> list[list[PayloadPage]]:
+    """
+    greedily pack consecutive pages into requests, a page always fits at its minimum size
+    """
+    groups: list[list[PayloadPage]] = [[]]
+    tokens = 0
+    for page in pages:
+        page_tokens = _min_tokens(page, budget)
+        group = groups[-1]
+        if group and (tokens + page_tokens > budget.max_image_tokens or len(group) >= budget.max_images):
+            groups.append([])
+            tokens = 0
+        groups[-1].append(page)
+        tokens += page_tokens
+    return [group for group in groups if group]
+
+
+def _fit_group(group: list[PayloadPage], budget: PayloadBudget) -> list[PayloadPage]:
+    """
+    scale all pages of a request by one factor to fit the token budget, then lower the quality to fit the bytes
+    """
+    tokens = sum(estimate_image_tokens(page.width, page.height) for page in group)
+    scale = min(1.0, math.sqrt(budget.max_image_tokens / tokens))
+    size = sum(len(page.image_base64) for page in group)
+    if scale >= 1.0 and size <= budget.max_image_bytes:
+        # nothing to do, the preprocessed pages are sent as is
+        return group
+
+    fitted: list[PayloadPage] = []
+    for quality in WEBP_QUALITIES:
+        fitted = [_encode(page, max(scale, _min_scale(page, budget)), quality) for page in group]
+        if sum(len(page.image_base64) for page in fitted) <= budget.max_image_bytes:
+            break
+    return fitted
+
+
+def plan_payloads(texts: list[str], images: list[str], budget: PayloadBudget) -> list[list[PayloadPage]]:
+    """
+    split pages into requests that fit the budget
+
+    :param texts: page texts
+    :param images: page webp images in base64
+    :return: pages of each request, with images resized and re-encoded if needed
+    """
+    pages: list[PayloadPage] = []
+    for i, (text, image_base64) in enumerate(zip(texts, images)):
+        with Image.open(io.BytesIO(base64.b64decode(image_base64))) as image:
+            width, height = image.size
+        pages.append(PayloadPage(i, text, image_base64, width, height))
+
+    return [_fit_group(group, budget) for group in _group_pages(pages, budget)]
+
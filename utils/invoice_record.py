@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+typed invoice records parsed from claude output
+
+model output is parsed with json first, a cheap repair pass fixes the usual defects
+(markdown fences, surrounding text, trailing commas, python literals) before giving up.
+every record is validated against the fields asked for in the prompt.
+"""
+
+import json
+import re
+from datetime import datetime
+from typing import Final, Optional
+
+FIELDS: Final[tuple] = ("seller_company", "buyer_company", "date", "invoice_number", "currency", "total_amount")
+DATE_FORMATS: Final[tuple] = ("%Y-%m-%d", "%Y/%m/%d", "%Y.%m.%d", "%Y%m%d", "%Y年%m月%d日")
+# day first and month first dates, a date both of them parse to different days is rejected instead of guessed
+AMBIGUOUS_DATE_FORMATS: Final[tuple] = ("%d/%m/%Y", "%m/%d/%Y")
+# values the model writes for a field missing on the invoice
+EMPTY_VALUES: Final[tuple] = ("", "-", "--", "—", "n/a", "null", "none")
+CURRENCY_SYMBOLS: Final[dict] = {
+    "$": "USD", "US$": "USD", "€": "EUR", "£": "GBP", "¥": "CNY", "￥": "CNY", "RMB": "CNY", "人民币": "CNY",
+    "HK$": "HKD", "C$": "CAD", "A$": "AUD", "円": "JPY",
+}
+
+_FENCE = re.compile(r"```(?:json)?\s*(.*?)```", re.S)
+_TRAILING_COMMA = re.compile(r",\s*([\]}])")
+_PY_LITERALS = re.compile(r"\b(True|False|None)\b")
+# currency symbols and codes, spaces and apostrophes used as thousands separators
+_AMOUNT_NOISE = re.compile(r"[^\d.,\-]")
+
+
+class InvoiceParseError(ValueError):
+    """
+    model output can't be parsed into invoice records
+    """
+
+
+class InvoiceValidationError(InvoiceParseError):
+    """
+    a record doesn't match the invoice schema
+    """
+
+
+class InvoiceRecord:
+    """
+    Invoice Record
+    """
+
+    __slots__ = FIELDS
+
+    def __init__(self, seller_company: str, buyer_company: str, date: str, invoice_number: str, currency: str,
+                 total_amount: Optional[float]):
+        self.seller_company = seller_company
+        self.buyer_company = buyer_company
+        self.date = date
+        self.invoice_number = invoice_number
+        self.currency = currency
+        self.total_amount = total_amount
+
+    def __repr__(self):
+        return f"InvoiceRecord({', '.join(f'{name}={getattr(self, name)!r}' for name in FIELDS)})"
+
+    def __eq__(self, other):
+        return isinstance(other, InvoiceRecord) and self.to_dict() == other.to_dict()
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "InvoiceRecord":
+        """
+        validate and normalize a record from the model output
+
+        :raise InvoiceValidationError: if a field is missing or can't be normalized
+        """
+        if not isinstance(data, dict):
+            raise InvoiceValidationError(f"record is not an object: {data!r}")
+        missing = [name for name in FIELDS if name not in data]
+        if missing:
+            raise InvoiceValidationError(f"missing fields {missing} in {data!r}")
+        seller_company = _text(data["seller_company"])
+        if not seller_company:
+            raise InvoiceValidationError(f"empty seller_company in {data!r}")
+        return cls(
+            seller_company=seller_company,
+            buyer_company=_text(data["buyer_company"]),
+            date=_normalize_date(data["date"]),
+            invoice_number=_text(data["invoice_number"]),
+            currency=_normalize_currency(data["currency"]),
+            total_amount=_normalize_amount(data["total_amount"]),
+        )
+
+    def to_dict(self) -> dict:
+        return {name: getattr(self, name) for name in FIELDS}
+
+
+def _text(value) -> str:
+    return "" if value is None else str(value).strip()
+
+
+def _empty(value: str) -> bool:
+    return value.lower() in EMPTY_VALUES
+
+
+def _normalize_date(value) -> str:
+    value = _text(value)
+    if _empty(value):
+        return ""
+    for fmt in DATE_FORMATS:
+        try:
+            return datetime.strptime(value, fmt).date().isoformat()
+        except ValueError:
+            continue
+    dates = set()
+    for fmt in AMBIGUOUS_DATE_FORMATS:
+        try:
+            dates.add(datetime.strptime(value, fmt).date().isoformat())
+        except ValueError:
+            continue
+    if len(dates) == 1:
+        return dates.pop()
+    if dates:
+        raise InvoiceValidationError(f"ambiguous date {value!r}, day or month first")
+    raise InvoiceValidationError(f"invalid date {value!r}")
+
+
+def _normalize_currency(value) -> str:
+    value = _text(value)
+    if _empty(value):
+        return ""
+    value = CURRENCY_SYMBOLS.get(value, value).upper()
+    if len(value) != 3 or not value.isalpha():
+        raise InvoiceValidationError(f"invalid currency {value!r}")
+    return value
+
+
+def _normalize_amount(value) -> Optional[float]:
+    """
+    the amount as a float, "1,234.56", "1.234,56 €" and "1 234,56" are all 1234.56
+
+    the decimal separator is the last of "," and "." if both are used. A single separator followed by
+    three digits could be either ("1,234", "1.234"), such amounts are rejected instead of guessed.
+    """
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return float(value)
+    text = _text(value)
+    if _empty(text):
+        return None
+    digits = _AMOUNT_NOISE.sub("", text)
+    negative = digits.startswith("-")
+    digits = digits.lstrip("-")
+    if not digits or "-" in digits:
+        raise InvoiceValidationError(f"invalid total_amount {value!r}")
+
+    separators = [char for char in digits if char in ",."]
+    decimal = None
+    if len(set(separators)) == 2:
+        decimal = separators[-1]
+    elif len(separators) == 1:
+        integer, fraction = digits.split(separators[0])
+        if len(fraction) == 3 and integer not in ("", "0") and len(integer) <= 3:
+            raise InvoiceValidationError(f"ambiguous total_amount {value!r}, thousands or decimal separator")
+        decimal = separators[0]
+
+    integer, fraction = digits.rsplit(decimal, 1) if decimal else (digits, "")
+    thousands = {char for char in integer if char in ",."}
+    if len(thousands) > 1 or (decimal and not fraction.isdigit()):
+        raise InvoiceValidationError(f"invalid total_amount {value!r}")
+    if thousands and not re.fullmatch(r"\d{1,3}(?:" + re.escape(thousands.pop()) + r"\d{3})+", integer):
+        raise InvoiceValidationError(f"invalid total_amount {value!r}")
+    amount = float(re.sub(r"[,.]", "", integer or "0") + "." + (fraction or "0"))
+    return -amount if negative else amount
+
+
+def _repair_json(text: str) -> str:
+    match = _FENCE.search(text)
+    if match:
+        text = match.group(1)
+    starts = [i for i in (text.find("["), text.find("{")) if i >= 0]
+    if starts:
+        start = min(starts)
+        end = text.rfind("]" if text[start] == "[" else "}")
+        if end > start:
+            text = text[start:end + 1]
+    text = text.replace("“", '"').replace("”", '"')
+    text = _TRAILING_COMMA.sub(r"\1", text)
+    return _PY_LITERALS.sub(lambda m: {"True": "true", "False": "false", "None": "null"}[m.group(1)], text)
+
+
+def parse_invoice_records(text: str) -> list[InvoiceRecord]:
+    """
+    parse claude output into invoice records
+
+    :raise InvoiceParseError: if the output is not valid json even after repair, or a record is invalid
+    """
+    try:
+        data = json.loads(text)
+    except ValueError:
+        try:
+            data = json.loads(_repair_json(text))
+        except ValueError as err:
+            raise InvoiceParseError(f"invalid json output: {err}") from None
+    if isinstance(data, dict):
+        data = [data]
+    if not isinstance(data, list):
+        raise InvoiceParseError(f"output is not a json array: {text[:200]!r}")
+    return [InvoiceRecord.from_dict(item) for item in data]
+
+
+def merge_records(groups: list[list[InvoiceRecord]]) -> list[InvoiceRecord]:
+    """
+    merge records of several requests
+
+    an invoice split across two requests may be returned twice,
+    records with the same seller and invoice number are kept once.
+    """
+    merged: list[InvoiceRecord] = []
+    seen: set = set()
+    for records in groups:
+        for record in records:
+            key = (record.seller_company, record.invoice_number)
+            if record.invoice_number and key in seen:
+                continue
+            seen.add(key)
+            merged.append(record)
+    return merged
+
+
+def records_to_json(records: list[InvoiceRecord], indent: Optional[int] = 2) -> str:
+    return json.dumps([record.to_dict() for record in records], ensure_ascii=False, indent=indent)
@@ -0,0 +1,392 @@
+"""
+Local background jobs for long model calls.
+
+Jobs run on a worker pool of the server process, not in the Streamlit script thread. Their state is kept in a
+SQLite job table and their results in one file per job, so pages submit a job, keep its id in the session and
+poll it; a rerun or navigating away doesn't throw the work away.
+
+Several server processes may share the job table. Each one marks the jobs it runs with its worker id and
+refreshes their heartbeat every HEARTBEAT_INTERVAL seconds, a running job whose heartbeat is older than
+STALE_AFTER was interrupted with its process and is marked failed, by whichever process notices first.
+
+usage:
+    queue = get_job_queue()
+    job_id = queue.submit('voc_report', {'model_id': .., 'asin': .., 'language': 'English'}, owner=session_id)
+    queue.poll(job_id, owner=session_id)    # {'status': 'running', 'progress': 0.5, 'message': .., 'partial': ..}
+    queue.result(job_id, owner=session_id)
+    queue.cancel(job_id)
+"""
+import os
+import json
+import time
+import uuid
+import pickle
+import socket
+import sqlite3
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_DB_PATH = './data/jobs.db'
+DEFAULT_WORKERS = 4
+# partial output is written at most this often, polling pages don't need more
+PARTIAL_INTERVAL = 1.0
+HEARTBEAT_INTERVAL = 10.0
+# a running job without a heartbeat for this long lost its server process
+STALE_AFTER = 6 * HEARTBEAT_INTERVAL
+
+QUEUED, RUNNING, DONE, FAILED, CANCELLED = 'queued', 'running', 'done', 'failed', 'cancelled'
+FINISHED = (DONE, FAILED, CANCELLED)
+
+SCHEMA = '''
+create table if not exists jobs (
+    id text primary key,
+    kind text not null,
+    params text not null,
+    owner text,
+    status text not null,
+    progress real,
+    message text,
+    partial text,
+    error text,
+    cancel_requested integer not null default 0,
+    created_at real not null,
+    started_at real,
+    finished_at real,
+    worker text,
+    heartbeat_at real
+);
+create index if not exists jobs_owner on jobs (owner, created_at);
+'''
+# columns added to job tables created by earlier versions
+MIGRATIONS = {
+    'worker': 'alter table jobs add column worker text',
+    'heartbeat_at': 'alter table jobs add column heartbeat_at real',
+}
+
+# kind -> function(context, **params)
+JOB_KINDS = {}
+
+
+def job_kind(name):
+    """
+    Register a job function, it is called with a JobContext and the submitted params.
+    """
+    def register(function):
+        JOB_KINDS[name] = function
+        return function
+    return register
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class JobContext:
+    """
+    Passed to a running job to report progress and check for cancellation.
+    """
+
+    def __init__(self, queue, job_id):
+        self.queue = queue
+        self.job_id = job_id
+        self._partial_at = 0.0
+
+    @property
+    def cancelled(self):
+        return self.queue._get(self.job_id)['cancel_requested']
+
+    def check_cancelled(self):
+        if self.cancelled:
+            raise JobCancelled()
+
+    def progress(self, fraction=None, message=None, partial=None, force=False):
+        """
+        :param partial: output so far, e.g. the text streamed so far, throttled to PARTIAL_INTERVAL
+        :return: True if the job row was updated
+        """
+        now = time.time()
+        if partial is not None and not force and now - self._partial_at < PARTIAL_INTERVAL:
+            partial = None
+            if fraction is None and message is None:
+                return False
+        if partial is not None:
+            self._partial_at = now
+        self.queue._update(self.job_id, progress=fraction, message=message, partial=partial)
+        return True
+
+
+class JobQueue:
+
+    def __init__(self, path=None, results_folder=None, workers=DEFAULT_WORKERS):
+        """
+        :param path: job table file, default to env jobs_db or ./data/jobs.db
+        :param results_folder: default to env job_results_folder or ./data/job_results
+        """
+        self.path = path or os.getenv('jobs_db', DEFAULT_DB_PATH)
+        self.results_folder = results_folder or os.getenv('job_results_folder', './data/job_results')
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        os.makedirs(self.results_folder, exist_ok=True)
+        self._local = threading.local()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='job')
+        # the jobs this process runs, other processes sharing the table leave them alone while their heartbeat is fresh
+        self.worker_id = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+        with self._connect() as conn:
+            conn.executescript(SCHEMA)
+            columns = {row['name'] for row in conn.execute('pragma table_info(jobs)')}
+            for column, sql in MIGRATIONS.items():
+                if column not in columns:
+                    conn.execute(sql)
+        self._recover()
+        threading.Thread(target=self._heartbeat, name='job-heartbeat', daemon=True).start()
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.row_factory = sqlite3.Row
+            conn.execute('pragma journal_mode=wal')
+            self._local.conn = conn
+        return conn
+
+    def _get(self, job_id):
+        row = self._connect().execute('select * from jobs where id = ?', (job_id,)).fetchone()
+        return dict(row) if row else None
+
+    def _update(self, job_id, **fields):
+        fields = {key: value for key, value in fields.items() if value is not None}
+        if not fields:
+            return
+        with self._connect() as conn:
+            conn.execute(f"update jobs set {', '.join(key + ' = ?' for key in fields)} where id = ?",
+                         (*fields.values(), job_id))
+
+    def _result_path(self, job_id):
+        return os.path.join(self.results_folder, job_id + '.pkl')
+
+    def _fail_stale(self):
+        """
+        Mark the running jobs without a recent heartbeat failed, their server process is gone.
+        """
+        now = time.time()
+        with self._connect() as conn:
+            # jobs of earlier versions have no heartbeat, their start time stands in for it
+            failed = conn.execute('update jobs set status = ?, error = ?, finished_at = ? where status = ? '
+                                  'and coalesce(heartbeat_at, started_at, created_at) < ?',
+                                  (FAILED, 'interrupted by a server restart', now, RUNNING, now - STALE_AFTER)).rowcount
+        if failed:
+            logger.warning(f"{failed} interrupted jobs marked failed")
+
+    def _heartbeat(self):
+        while True:
+            time.sleep(HEARTBEAT_INTERVAL)
+            try:
+                self._update_heartbeats()
+                self._fail_stale()
+            except sqlite3.Error as e:
+                logger.warning(f"job heartbeat failed: {e}")
+
+    def _update_heartbeats(self):
+        with self._connect() as conn:
+            conn.execute('update jobs set heartbeat_at = ? where worker = ? and status = ?',
+                         (time.time(), self.worker_id, RUNNING))
+
+    def _recover(self):
+        """
+        Jobs left by a previous server process: queued jobs are run again, running jobs with a stale heartbeat
+        were interrupted. Running jobs of other live processes sharing the table are left alone.
+        """
+        self._fail_stale()
+        conn = self._connect()
+        # a queued job is claimed by one process only, see _run
+        for row in conn.execute('select id from jobs where status = ? order by created_at', (QUEUED,)).fetchall():
+            self._executor.submit(self._run, row['id'])
+
+    def _run(self, job_id):
+        job = self._get(job_id)
+        if job is None or job['status'] != QUEUED:
+            return
+        with self._connect() as conn:
+            # a job cancelled while queued is left as is
+            started = conn.execute('update jobs set status = ?, started_at = ?, worker = ?, heartbeat_at = ? '
+                                   'where id = ? and status = ? and cancel_requested = 0',
+                                   (RUNNING, time.time(), self.worker_id, time.time(), job_id, QUEUED)).rowcount
+        if not started:
+            # cancelled while queued, or claimed by another process sharing the table
+            with self._connect() as conn:
+                conn.execute('update jobs set status = ?, finished_at = ? where id = ? and status = ?',
+                             (CANCELLED, time.time(), job_id, QUEUED))
+            return
+        try:
+            function = JOB_KINDS[job['kind']]
+            result = function(JobContext(self, job_id), **json.loads(job['params']))
+            tmp_path = self._result_path(job_id) + '.tmp'
+            with open(tmp_path, 'wb') as file:
+                pickle.dump(result, file)
+            os.replace(tmp_path, self._result_path(job_id))
+            self._update(job_id, status=DONE, progress=1.0, finished_at=time.time())
+        except JobCancelled:
+            self._update(job_id, status=CANCELLED, finished_at=time.time())
+        except Exception as e:
+            logger.exception(f"job {job_id} ({job['kind']}) failed")
+            self._update(job_id, status=FAILED, error=str(e), finished_at=time.time())
+
+    def submit(self, kind, params, owner=None):
+        """
+        Queue a job of a registered kind, params must be json serializable.
+
+        :return: job id
+        """
+        if kind not in JOB_KINDS:
+            raise ValueError(f"unknown job kind {kind}")
+        job_id = uuid.uuid4().hex
+        with self._connect() as conn:
+            conn.execute('insert into jobs (id, kind, params, owner, status, progress, created_at) '
+                         'values (?, ?, ?, ?, ?, ?, ?)',
+                         (job_id, kind, json.dumps(params, ensure_ascii=False), owner, QUEUED, 0.0, time.time()))
+        self._executor.submit(self._run, job_id)
+        return job_id
+
+    def _owned(self, job_id, owner):
+        job = self._get(job_id)
+        if job is None or (owner is not None and job['owner'] != owner):
+            return None
+        return job
+
+    def poll(self, job_id, owner=None):
+        """
+        :param owner: only a job of this owner is returned, any job if None
+        :return: job state without the params, None if unknown
+        """
+        job = self._owned(job_id, owner)
+        if job:
+            job.pop('params')
+        return job
+
+    def result(self, job_id, owner=None):
+        """
+        Result of a finished job, None if it isn't done or, with owner, isn't a job of owner.
+        """
+        job = self._owned(job_id, owner)
+        if not job or job['status'] != DONE:
+            return None
+        with open(self._result_path(job_id), 'rb') as file:
+            return pickle.load(file)
+
+    def cancel(self, job_id):
+        """
+        Queued jobs are cancelled right away, running jobs stop at their next cancellation check.
+        """
+        with self._connect() as conn:
+            conn.execute('update jobs set cancel_requested = 1 where id = ?', (job_id,))
+            conn.execute('update jobs set status = ?, finished_at = ? where id = ? and status = ?',
+                         (CANCELLED, time.time(), job_id, QUEUED))
+
+    def list_jobs(self, owner=None, limit=20):
+        sql = 'select id, kind, owner, status, progress, message, error, created_at, finished_at from jobs'
+        params = []
+        if owner is not None:
+            sql += ' where owner = ?'
+            params.append(owner)
+        sql += ' order by created_at desc limit ?'
+        params.append(limit)
+        return [dict(row) for row in self._connect().execute(sql, params)]
+
+    def purge(self, older_than=7 * 24 * 3600):
+        """
+        Delete finished jobs and their results older than older_than seconds.
+        """
+        conn = self._connect()
+        rows = conn.execute(f"select id from jobs where status in ({', '.join('?' * len(FINISHED))}) "
+                            'and finished_at < ?', (*FINISHED, time.time() - older_than)).fetchall()
+        for row in rows:
+            if os.path.exists(self._result_path(row['id'])):
+                os.remove(self._result_path(row['id']))
+        with conn:
+            conn.executemany('delete from jobs where id = ?', [(row['id'],) for row in rows])
+        return len(rows)
+
+
+_job_queue = None
+_job_queue_lock = threading.Lock()
+
+
+def get_job_queue():
+    global _job_queue
+    with _job_queue_lock:
+        if _job_queue is None:
+            _job_queue = JobQueue()
+        return _job_queue
+
+
+# job kinds, their dependencies are imported when a job runs
+
+@job_kind('image_generation')
+def image_generation_job(context, model_id, **kwargs):
+    """
+    :return: (status, image bytes or error message) of image_generation.generate_or_vary_image
+    """
+    from utils.image_generation import generate_or_vary_image
+
+    context.progress(message='generating')
+    return generate_or_vary_image(model_id, **kwargs)
+
+
+def _stream_text(context, stream):
+    text = ''
+    for delta in stream:
+        text += delta
+        # cancellation is checked along with the throttled partial writes, not on every delta
+        if context.progress(partial=text):
+            context.check_cancelled()
+    context.progress(partial=text, force=True)
+    return text
+
+
+@job_kind('voc_report')
+def voc_report_job(context, model_id, asin, language, incremental=False):
+    """
+    :return: the VoC report text
+    """
+    from utils.listing_voc_prompt import bedrock_converse_stream_api
+    from utils.voc_engine import VocEngine
+    from utils.voc_state import incremental_voc_prompt
+
+    context.progress(0.1, 'analyzing reviews')
+    engine = VocEngine(model_id)
+    if incremental:
+        prompt = incremental_voc_prompt(engine, asin, language)
+    else:
+        prompt = engine.build_prompt_for_asin(asin, language)
+    context.check_cancelled()
+    context.progress(0.5, 'writing report')
+    return _stream_text(context, bedrock_converse_stream_api(model_id, prompt))
+
+
+@job_kind('listing')
+def listing_job(context, model_id, prompt, image_file=None):
+    """
+    :param image_file: an image path or a list of image paths of the product
+    :return: the listing text with its title / bullets / description tags
+    """
+    from utils.listing_voc_prompt import bedrock_converse_stream_api, bedrock_converse_stream_api_with_image
+
+    context.progress(message='writing listing')
+    if image_file:
+        stream = bedrock_converse_stream_api_with_image(model_id, image_file, prompt)
+    else:
+        stream = bedrock_converse_stream_api(model_id, prompt)
+    return _stream_text(context, stream)
+
+
+@job_kind('invoice_extraction')
+def invoice_extraction_job(context, file_path):
+    """
+    :return: the extracted invoice records as json text
+    """
+    from utils.invoice_extract import create_extractor
+
+    context.progress(message='extracting')
+    return create_extractor(file_path).extract()
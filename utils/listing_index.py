@@ -0,0 +1,182 @@
+"""
+Similarity index of the catalog listings, used to pick reference listings for the entered product.
+
+Listings are embedded as hashed TF-IDF vectors of their words and word bigrams in a NumPy matrix, a query is
+one matrix-vector product. Bedrock Titan embeddings can be used instead, they are cached on disk by text digest
+so each listing is embedded once.
+
+usage:
+    index = get_listing_index()
+    for score, asin in index.search('Owala water bottle insulated straw', k=3):
+        ...
+"""
+import os
+import re
+import json
+import zlib
+import hashlib
+import logging
+import threading
+
+import numpy as np
+
+from utils.aws_clients import get_bedrock_runtime
+from utils.catalog_store import get_catalog
+
+logger = logging.getLogger(__name__)
+
+HASH_DIM = 2 ** 12
+# characters of a listing that are indexed, titles and bullets carry most of the signal
+MAX_LISTING_CHARS = 4000
+TITAN_MODEL_ID = 'amazon.titan-embed-text-v2:0'
+
+_WORD = re.compile(r"[a-z0-9]+")
+
+
+def listing_text(title, bullet_points, description):
+    """
+    Indexed text of a listing, the title is repeated to weight it over the description.
+    """
+    text = ' '.join(str(part) for part in (title, title, bullet_points, description) if part)
+    return text[:MAX_LISTING_CHARS]
+
+
+def tokenize(text):
+    words = _WORD.findall(text.lower())
+    return words + [a + ' ' + b for a, b in zip(words, words[1:])]
+
+
+def hash_counts(tokens, dim=HASH_DIM):
+    """
+    Signed feature hashing of tokens into a dense count vector, crc32 keeps the buckets stable across processes.
+    """
+    vector = np.zeros(dim, dtype=np.float32)
+    if not tokens:
+        return vector
+    hashes = np.array([zlib.crc32(token.encode('utf-8')) for token in tokens], dtype=np.uint32)
+    signs = np.where(hashes & 0x80000000, -1.0, 1.0).astype(np.float32)
+    np.add.at(vector, hashes % dim, signs)
+    return vector
+
+
+def _normalize(matrix):
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    return matrix / np.where(norms == 0, 1, norms)
+
+
+class TitanEmbedder:
+    """
+    Bedrock Titan text embeddings, cached on disk as one .npy file per text digest.
+    """
+
+    def __init__(self, model_id=TITAN_MODEL_ID, cache_folder=None, dimensions=512):
+        self.model_id = model_id
+        self.dimensions = dimensions
+        self.cache_folder = cache_folder or os.getenv('embedding_cache_folder', './.cache/embeddings')
+        os.makedirs(self.cache_folder, exist_ok=True)
+
+    def _path(self, text):
+        digest = hashlib.sha256(f'{self.model_id}:{self.dimensions}:{text}'.encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_folder, digest + '.npy')
+
+    def embed(self, text):
+        path = self._path(text)
+        if os.path.exists(path):
+            return np.load(path)
+        response = get_bedrock_runtime('us-east-1').invoke_model(
+            modelId=self.model_id,
+            body=json.dumps({'inputText': text, 'dimensions': self.dimensions, 'normalize': True}))
+        vector = np.array(json.loads(response['body'].read())['embedding'], dtype=np.float32)
+        tmp_path = path + '.tmp.npy'
+        np.save(tmp_path, vector)
+        os.replace(tmp_path, path)
+        return vector
+
+
+class ListingIndex:
+
+    def __init__(self, embedder=None, dim=HASH_DIM):
+        """
+        :param embedder: TitanEmbedder, hashed TF-IDF if None
+        """
+        self.embedder = embedder
+        self.dim = dim
+        self.asins = []
+        self.matrix = np.zeros((0, dim), dtype=np.float32)
+        self.idf = np.ones(dim, dtype=np.float32)
+
+    def _hashed(self, text):
+        return hash_counts(tokenize(text), self.dim)
+
+    def build(self, listings):
+        """
+        :param listings: iterable of (asin, title, bullet_points, description)
+        """
+        self.asins = []
+        vectors = []
+        for asin, title, bullet_points, description in listings:
+            text = listing_text(title, bullet_points, description)
+            if not text:
+                continue
+            self.asins.append(asin)
+            vectors.append(self.embedder.embed(text) if self.embedder else self._hashed(text))
+        if not vectors:
+            return self
+        matrix = np.vstack(vectors).astype(np.float32)
+
+        if self.embedder is None:
+            # sublinear tf, idf per bucket
+            document_frequency = np.count_nonzero(matrix, axis=0)
+            self.idf = (np.log((1 + len(vectors)) / (1 + document_frequency)) + 1).astype(np.float32)
+            matrix = np.sign(matrix) * np.log1p(np.abs(matrix)) * self.idf
+        self.matrix = _normalize(matrix)
+        return self
+
+    def search(self, query, k=3, exclude=()):
+        """
+        Most similar listings of a query text.
+
+        :return: [(score, asin)] best first
+        """
+        if not self.asins or not query.strip():
+            return []
+        if self.embedder:
+            vector = self.embedder.embed(query)
+        else:
+            vector = self._hashed(query)
+            vector = np.sign(vector) * np.log1p(np.abs(vector)) * self.idf
+        scores = self.matrix @ _normalize(vector.astype(np.float32))
+
+        top = np.argsort(-scores)[:k + len(exclude)]
+        results = [(float(scores[i]), self.asins[i]) for i in top if self.asins[i] not in exclude]
+        return [result for result in results[:k] if result[0] > 0]
+
+
+_index = None
+_index_version = None
+_index_lock = threading.Lock()
+
+
+def get_listing_index():
+    """
+    Hashed TF-IDF index of the catalog products, rebuilt when products are added or updated.
+    Titan embeddings are used when env listing_index_embeddings is 'titan'.
+    """
+    global _index, _index_version
+    catalog = get_catalog()
+    with _index_lock:
+        version = catalog.products_version()
+        if _index is None or version != _index_version:
+            embedder = TitanEmbedder() if os.getenv('listing_index_embeddings') == 'titan' else None
+            _index = ListingIndex(embedder).build(catalog.iter_listings())
+            _index_version = version
+            logger.info(f"listing index built over {len(_index.asins)} products")
+        return _index
+
+
+def find_reference_listings(query, k=3):
+    """
+    Products of the k listings most similar to the query text, best first.
+    """
+    catalog = get_catalog()
+    return [catalog.get_product(asin) for _, asin in get_listing_index().search(query, k)]
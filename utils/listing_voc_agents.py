@@ -1,5 +1,4 @@
 import os
-import boto3
 import json
 from dotenv import load_dotenv
 
@@ -19,15 +18,16 @@ from langchain_community.tools.tavily_search import TavilySearchResults
 from langchain_core.messages import HumanMessage
 
 from utils.amazon_scraper import get_product, get_reviews
+from utils.aws_clients import get_bedrock_runtime
 
 os.environ["TAVILY_API_KEY"] = "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"
 
+_bedrock_llm = None
+
+
 def initialize_llm():
     """Initialize the Bedrock runtime."""
-    bedrock_runtime =  boto3.client(
-        service_name="bedrock-runtime",
-        region_name="us-east-1",
-    )
+    bedrock_runtime = get_bedrock_runtime("us-east-1")
 
     """Initialize the language model."""
     model_id = "anthropic.claude-3-sonnet-20240229-v1:0"
@@ -47,7 +47,14 @@ def initialize_llm():
 
     return llm
 
-bedrock_llm = initialize_llm()
+
+def get_llm():
+    """The language model, initialized on first use instead of at import."""
+    global _bedrock_llm
+    if _bedrock_llm is None:
+        _bedrock_llm = initialize_llm()
+    return _bedrock_llm
+
 save_folder = os.getenv("save_folder")
 
 
@@ -103,7 +110,7 @@ def create_listing(asin:str, image_name:str, brand:str, product_features:str):
 
     tools = [search, get_product_info]
 
-    agent = create_tool_calling_agent(bedrock_llm, tools, prompt)
+    agent = create_tool_calling_agent(get_llm(), tools, prompt)
     
     agent_executor = AgentExecutor(agent=agent, tools=tools, 
                                    verbose=True,
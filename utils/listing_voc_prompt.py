@@ -1,53 +1,67 @@
 import os
-import boto3
+import re
+import time
 import json
 from dotenv import load_dotenv
 from botocore.exceptions import ClientError
 
 import base64
-import io
-from PIL import Image
 
-from langchain.agents import tool 
-from langchain_community.chat_models import BedrockChat
-from langchain.llms import Bedrock
-
-from utils.amazon_scraper import get_product, get_reviews, get_bestsellers
+from utils.aws_clients import get_bedrock_runtime
+from utils.image_prep import image_block, image_blocks
+from utils.reviews import reviews_to_text
+from utils.catalog_store import get_catalog
+from utils.review_stats import compute_review_stats, format_review_stats, topic_terms
 
 # loading in variables from .env file
 load_dotenv()
 
 data_folder = os.getenv("data_folder")
 
-# instantiating the Bedrock client, and passing in the CLI profile
-# boto3.setup_default_session(profile_name=os.getenv("profile_name"))
-
-bedrock = boto3.client('bedrock-runtime', 'us-east-1')
-
-def gen_listing_prompt(asin, domain, brand, features, language):
-    # results = get_product(asin, domain)
-
-    filename = './data/' + 'asin_' + asin + '_product.json'
-    with open(filename, 'r', encoding='utf-8') as file:
-        data = file.read()
+# the Bedrock client is shared by all modules and created on first use
+REGION = 'us-east-1'
 
-    results = json.loads(data)
-
-    as_title = results['results'][0]['content']['title']
-    as_bullet = results['results'][0]['content']['bullet_points']
-    as_des = results['results'][0]['content']['description']
+example_template = '''
+    <Example>
+        <title>{title}</title>
+        <bullets>{bullet}</bullets>
+        <description>{des}</description>
+    </Example>
+'''
+
+
+def gen_listing_prompt(asin, domain, brand, features, language, live=False, references=3):
+    """
+    :param asin: reference listing, if None the most similar listings of the catalog to brand and features are used
+    :param references: number of similar listings used when asin is None
+    """
+    if asin:
+        # live pages are fetched through the TTL cache, which ingests them into the catalog
+        if live:
+            # the scraper stack is only loaded for live fetches
+            from utils.scraper_cache import get_scraper_cache
+
+            get_scraper_cache().get_product(asin, domain)
+        products = [get_catalog().get_product(asin)]
+    else:
+        # the similarity index (and numpy) is only loaded when no reference ASIN is given
+        from utils.listing_index import find_reference_listings
+
+        products = find_reference_listings(brand + ' ' + features, references)
+
+    examples = ''.join(example_template.format(title=product['title'], bullet=product['bullet_points'],
+                                               des=product['description']) for product in products)
+
+    as_title = products[0]['title'] if products else ''
+    as_bullet = products[0]['bullet_points'] if products else ''
+    as_des = products[0]['description'] if products else ''
     
     prompt_template = '''If you were an excellent Amazon product listing specialist.
     Your task is to create compelling and optimized product listings for Amazon based on the provided information.
     Please refer to the following examples and best seller products on Amazon to create a comprehensive product listing.
     
     Example of a good product listing on Amazon:
-
-    <Example>
-        <title>{title}</title>
-        <bullets>{bullet}</title>
-        <description>{des}</description>
-    </Example>
+{examples}
 
     Please refer to the above image and the following production infomation fo to create product listing.
 
@@ -61,29 +75,18 @@ def gen_listing_prompt(asin, domain, brand, features, language):
     **Respond in valid XML format with the tags as "title", "bullets", "description"**. 
     Here is one sample:
         <title>{title}</title>
-        <bullets>{bullet}</title>
+        <bullets>{bullet}</bullets>
         <description>{des}</description>
 
     please answer it in {lang}
     '''
 
-    user_prompt = prompt_template.format(title=as_title, bullet=as_bullet, des=as_des, kw=brand, ft=features,lang=language)
+    user_prompt = prompt_template.format(examples=examples, title=as_title, bullet=as_bullet, des=as_des, kw=brand, ft=features,lang=language)
 
     return user_prompt
 
 
-def gen_voc_prompt(asin, domain, language):
-
-    print('asin:' + asin, 'domain:' + domain)
-    #results = get_reviews(asin, domain)
-
-    filename = './data/' + 'asin_' + asin + '_reviews.json'
-    with open(filename, 'r', encoding='utf-8') as file:
-        reviews = file.read()
-
-    results = json.loads(reviews)
-
-    prompt_template = '''
+voc_prompt_template = '''
     You are an analyst tasked with analyzing the provided customer review examples on an e-commerce platform and summarizing them into a comprehensive Voice of Customer (VoC) report. Your job is to carefully read through the product description and reviews, identify key areas of concern, praise, and dissatisfaction regarding the product. You will then synthesize these findings into a well-structured report that highlights the main points for the product team and management to consider.
 
     The report should include the following sections:
@@ -107,36 +110,33 @@ def gen_voc_prompt(asin, domain, language):
     {product_reviews}
     <product reviews>
 
+    The review statistics below are precomputed from all reviews, use them as is for the Sentiment Analysis and Topic Categorization sections and wherever counts or shares are needed.
+    <review statistics>
+    {review_statistics}
+    <review statistics>
+
     if output is not English, Please also ouput the reuslt in {lang}
     '''
-    
-    user_prompt  = prompt_template.format(product_description='', product_reviews=results['results'], lang=language)
 
-    return user_prompt
 
-def image_base64_encoder(image_path, max_size=1568):
-    with open(image_path, "rb") as f:
-        image_bytes = f.read()
+def gen_voc_prompt(asin, domain, language, reviews=None, live=False):
 
-    img = Image.open(io.BytesIO(image_bytes))
-    width, height = img.size
-    img_format = img.format.lower()
+    print('asin:' + asin, 'domain:' + domain)
+    if live and reviews is None:
+        from utils.scraper_cache import get_scraper_cache
 
-    if width > max_size or height > max_size:
-        if width > height:
-            new_width = max_size
-            new_height = int(height * (max_size / width))
-        else:
-            new_height = max_size
-            new_width = int(width * (max_size / height))
+        get_scraper_cache().get_reviews(asin, domain)
 
-        img = img.resize((new_width, new_height), resample=Image.Resampling.LANCZOS)
+    # only the review fields needed for the report are sent, not the raw scraper response
+    if reviews is None:
+        reviews = list(get_catalog().iter_reviews(asin))
 
-    resized_bytes = io.BytesIO()
-    img.save(resized_bytes, format=img_format)
-    resized_bytes = resized_bytes.getvalue()
+    # the topics counted depend on the category of the product
+    stats = compute_review_stats(reviews, topics=topic_terms(get_catalog().get_product(asin)))
+    user_prompt  = voc_prompt_template.format(product_description='', product_reviews=reviews_to_text(reviews),
+                                              review_statistics=format_review_stats(stats), lang=language)
 
-    return resized_bytes, img_format
+    return user_prompt
 
 
 def bedrock_converse_api(model_id, input_text):
@@ -149,7 +149,7 @@ def bedrock_converse_api(model_id, input_text):
 
     try:
         # Send the message to the model, using a basic inference configuration.
-        response = bedrock.converse(
+        response = get_bedrock_runtime(REGION).converse(
             modelId=model_id,
             messages=conversation,
             inferenceConfig={"maxTokens": 2048, "temperature": 0.5, "topP": 0.9},
@@ -165,27 +165,27 @@ def bedrock_converse_api(model_id, input_text):
         print(f"ERROR: Can't invoke '{model_id}'. Reason: {e}")
 
 
+def _image_content(image_filename):
+    """
+    Image blocks of one image file or a list of them, the images of a list share one token budget.
+    """
+    if isinstance(image_filename, (str, os.PathLike)):
+        # a single image is passed through as is when it fits, without decoding and hashing it
+        return [image_block(image_filename)]
+    return image_blocks(image_filename)
+
+
 def bedrock_converse_api_with_image(model_id, image_filename, input_text):
-    image_base64, file_type = image_base64_encoder(image_filename)
     conversation = [
         {
             "role": "user",
-            "content": [
-                {"text": input_text},
-                {    "image": {
-                        "format": file_type,
-                        "source": {
-                            "bytes": image_base64
-                        }
-                    }
-                }
-            ],
+            "content": [{"text": input_text}, *_image_content(image_filename)],
         }
     ]
 
     try:
         # Send the message to the model, using a basic inference configuration.
-        response = bedrock.converse(
+        response = get_bedrock_runtime(REGION).converse(
             modelId=model_id,
             messages=conversation,
             inferenceConfig={"maxTokens": 2048, "temperature": 0.5, "topP": 0.9},
@@ -199,3 +199,85 @@ def bedrock_converse_api_with_image(model_id, image_filename, input_text):
 
     except (ClientError, Exception) as e:
         print(f"ERROR: Can't invoke '{model_id}'. Reason: {e}")
+
+
+
+def _converse_stream(model_id, conversation, metrics=None):
+    """
+    Send the conversation with converse_stream and yield the text deltas as they arrive.
+
+    metrics, if given, is filled with time_to_first_token and total_time in seconds,
+    and the token usage reported by bedrock.
+    """
+    metrics = {} if metrics is None else metrics
+    start = time.perf_counter()
+    try:
+        response = get_bedrock_runtime(REGION).converse_stream(
+            modelId=model_id,
+            messages=conversation,
+            inferenceConfig={"maxTokens": 2048, "temperature": 0.5, "topP": 0.9},
+        )
+
+        for event in response["stream"]:
+            if "contentBlockDelta" in event:
+                text = event["contentBlockDelta"]["delta"].get("text", "")
+                if text:
+                    metrics.setdefault("time_to_first_token", time.perf_counter() - start)
+                    yield text
+            elif "metadata" in event:
+                metrics.update(event["metadata"].get("usage", {}))
+
+    except (ClientError, Exception) as e:
+        print(f"ERROR: Can't invoke '{model_id}'. Reason: {e}")
+
+    metrics["total_time"] = time.perf_counter() - start
+    print(f"stream metrics of '{model_id}': {metrics}")
+
+
+def bedrock_converse_stream_api(model_id, input_text, metrics=None):
+    conversation = [
+        {
+            "role": "user",
+            "content": [{"text": input_text}],
+        }
+    ]
+
+    yield from _converse_stream(model_id, conversation, metrics)
+
+
+def bedrock_converse_stream_api_with_image(model_id, image_filename, input_text, metrics=None):
+    conversation = [
+        {
+            "role": "user",
+            "content": [{"text": input_text}, *_image_content(image_filename)],
+        }
+    ]
+
+    yield from _converse_stream(model_id, conversation, metrics)
+
+
+class ListingSectionParser:
+    """
+    Incrementally parse the streamed listing XML, a section is returned as soon as its closing tag arrives.
+    """
+
+    TAGS = ("title", "bullets", "description")
+
+    def __init__(self):
+        self.text = ""
+        self.sections = {}
+
+    def feed(self, delta):
+        """
+        Add a text delta and return the (tag, content) of sections closed by it.
+        """
+        self.text += delta
+        closed = []
+        for tag in self.TAGS:
+            if tag in self.sections:
+                continue
+            match = re.search(rf"<{tag}>(.*?)</{tag}>", self.text, re.S)
+            if match:
+                self.sections[tag] = match.group(1).strip()
+                closed.append((tag, self.sections[tag]))
+        return closed
@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+image moderation verdict cache
+
+verdicts of content_moderation_image are kept in a sqlite table keyed by the sha256 of the image, along with
+a 64 bit pHash and dHash of it. A re-uploaded image is served by its exact hash, a near duplicate (re-encoded,
+resized, slightly cropped) by the nearest stored hashes within a Hamming distance, so only new images reach
+the model. RecheckPolicy decides when a cached verdict is still sent to the model again.
+
+usage:
+    cache = get_moderation_cache()
+    content = cache.moderate("./data/upload/shoe.jpg")    # same content list as content_moderation_image
+    cache.stats                                            # {"exact": .., "near": .., "miss": .., "recheck": ..}
+"""
+
+import json
+import os
+import random
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+from typing import Callable, Final, Optional
+
+from utils.content_moderation import IMAGE_SYSTEM_PROMPT, MODEL_ID, content_moderation_image, parse_verdict
+from utils.image_prep import image_hashes
+from utils.invoice_cache import file_digest, make_key
+
+DEFAULT_DB_PATH: Final[str] = "./data/moderation_cache.db"
+MASK: Final[int] = (1 << 64) - 1
+
+SCHEMA: Final[str] = """
+create table if not exists verdicts (
+    sha256 text not null,
+    prompt_key text not null,
+    phash integer not null,
+    dhash integer not null,
+    content text not null,
+    infringement integer,
+    confidence real,
+    near_of text,
+    created_at real not null,
+    primary key (sha256, prompt_key)
+);
+"""
+
+
+@dataclass
+class RecheckPolicy:
+    """
+    when a cached verdict is reused instead of asking the model again
+    """
+    # max Hamming distances of the pHash and the dHash of a near duplicate, both must be within
+    max_phash_distance: int = 6
+    max_dhash_distance: int = 10
+    # verdicts older than this are checked again, None keeps them forever
+    max_age: Optional[float] = 30 * 24 * 3600
+    # a near duplicate only reuses a verdict the model was at least this confident about
+    near_min_confidence: float = 0.8
+    # near duplicates of an image judged infringing reuse the verdict, clean ones may hide a new logo
+    reuse_near_clean: bool = True
+    # fraction of near duplicate hits still checked by the model, to audit the thresholds
+    recheck_sample: float = 0.0
+
+
+def _to_signed(value: int) -> int:
+    # sqlite integers are signed 64 bit
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+class HashIndex:
+    """
+    nearest neighbour lookup over 64 bit hashes, a vectorized XOR and popcount over all stored hashes
+    """
+
+    def __init__(self):
+        import numpy as np
+
+        self._np = np
+        self._popcount = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+        self._keys: list[str] = []
+        self._positions: dict[str, int] = {}
+        self._phashes: list[int] = []
+        self._dhashes: list[int] = []
+        self._arrays = None
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def add(self, key: str, phash: int, dhash: int):
+        """
+        index the hashes of key, replacing the hashes it was indexed with before
+        """
+        position = self._positions.get(key)
+        if position is None:
+            self._positions[key] = len(self._keys)
+            self._keys.append(key)
+            self._phashes.append(_to_signed(phash))
+            self._dhashes.append(_to_signed(dhash))
+        else:
+            self._phashes[position] = _to_signed(phash)
+            self._dhashes[position] = _to_signed(dhash)
+        self._arrays = None
+
+    def discard(self, key: str):
+        position = self._positions.pop(key, None)
+        if position is None:
+            return
+        for values in (self._keys, self._phashes, self._dhashes):
+            del values[position]
+        self._positions = {key: i for i, key in enumerate(self._keys)}
+        self._arrays = None
+
+    def _distances(self, stored, value: int):
+        np = self._np
+        xor = np.bitwise_xor(stored, np.int64(_to_signed(value)))
+        return self._popcount[xor.view(np.uint8)].reshape(-1, 8).sum(axis=1)
+
+    def nearest(self, phash: int, dhash: int, max_phash_distance: int, max_dhash_distance: int,
+                exclude: Optional[str] = None) -> Optional[tuple[str, int]]:
+        """
+        :param exclude: key left out of the search, the image looked up itself
+        :return: (key, pHash distance) of the nearest entry within both distances, None if there is none
+        """
+        if not self._keys:
+            return None
+        np = self._np
+        if self._arrays is None:
+            self._arrays = (np.array(self._phashes, dtype=np.int64), np.array(self._dhashes, dtype=np.int64))
+        phash_distances = self._distances(self._arrays[0], phash)
+        dhash_distances = self._distances(self._arrays[1], dhash)
+        within = (phash_distances <= max_phash_distance) & (dhash_distances <= max_dhash_distance)
+        if exclude in self._positions:
+            within[self._positions[exclude]] = False
+        candidates = np.flatnonzero(within)
+        if not len(candidates):
+            return None
+        best = candidates[np.argmin(phash_distances[candidates])]
+        return self._keys[best], int(phash_distances[best])
+
+
+class ModerationCache:
+
+    def __init__(self, path: Optional[str] = None, policy: Optional[RecheckPolicy] = None,
+                 moderate: Callable[[str], list] = content_moderation_image):
+        """
+        :param path: sqlite file, default to env moderation_cache_db or ./data/moderation_cache.db
+        :param moderate: the uncached moderation, returns the model output content list
+        """
+        self.path = path or os.getenv("moderation_cache_db", DEFAULT_DB_PATH)
+        self.policy = policy or RecheckPolicy()
+        self._moderate = moderate
+        # a prompt or model change starts from an empty cache, the old verdicts stay in the table
+        self.prompt_key = make_key(MODEL_ID, IMAGE_SYSTEM_PROMPT)
+        self.stats: dict[str, int] = {"exact": 0, "near": 0, "miss": 0, "recheck": 0}
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with self._connect() as conn:
+            conn.executescript(SCHEMA)
+        self._index = HashIndex()
+        # entries reused for a near duplicate are not indexed, near duplicates of near duplicates would drift
+        for row in self._connect().execute("select sha256, phash, dhash from verdicts where prompt_key = ? "
+                                           "and near_of is null", (self.prompt_key,)):
+            self._index.add(row["sha256"], row["phash"] & MASK, row["dhash"] & MASK)
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.row_factory = sqlite3.Row
+            conn.execute("pragma journal_mode=wal")
+            self._local.conn = conn
+        return conn
+
+    def _get(self, sha256: str) -> Optional[dict]:
+        row = self._connect().execute("select * from verdicts where sha256 = ? and prompt_key = ?",
+                                      (sha256, self.prompt_key)).fetchone()
+        return dict(row) if row else None
+
+    def _fresh(self, entry: dict) -> bool:
+        return self.policy.max_age is None or time.time() - entry["created_at"] <= self.policy.max_age
+
+    def _reusable_near(self, entry: dict) -> bool:
+        policy = self.policy
+        if not self._fresh(entry) or (entry["confidence"] or 0.0) < policy.near_min_confidence:
+            return False
+        if not entry["infringement"] and not policy.reuse_near_clean:
+            return False
+        return random.random() >= policy.recheck_sample
+
+    def put(self, sha256: str, phash: int, dhash: int, content: list, near_of: Optional[str] = None,
+            created_at: Optional[float] = None):
+        """
+        store the verdict of an image, with the hashes lookup returned for it
+
+        :param created_at: when the model gave the verdict, now if None
+        """
+        infringement, confidence = None, None
+        try:
+            verdict = parse_verdict("".join(block.get("text", "") for block in content))
+            infringement = int(bool(verdict.get("infringement")))
+            confidence = float(verdict.get("confidence"))
+        except (ValueError, TypeError, AttributeError):
+            # kept for exact hits, near duplicates never reuse a verdict without a confidence
+            pass
+        with self._connect() as conn:
+            conn.execute("insert or replace into verdicts (sha256, prompt_key, phash, dhash, content, infringement, "
+                         "confidence, near_of, created_at) values (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                         (sha256, self.prompt_key, _to_signed(phash), _to_signed(dhash), json.dumps(content),
+                          infringement, confidence, near_of, created_at or time.time()))
+        with self._lock:
+            if near_of is None:
+                self._index.add(sha256, phash, dhash)
+            else:
+                self._index.discard(sha256)
+
+    def lookup(self, image_path: str) -> tuple[Optional[list], str, tuple]:
+        """
+        :return: (cached content or None, "exact" | "near" | "miss" | "recheck", (sha256, pHash, dHash))
+        """
+        sha256 = file_digest(image_path)
+        entry = self._get(sha256)
+        if entry and self._fresh(entry):
+            return json.loads(entry["content"]), "exact", (sha256, entry["phash"] & MASK, entry["dhash"] & MASK)
+
+        phash, dhash = image_hashes(image_path)
+        with self._lock:
+            # a stale verdict of the image itself is no near duplicate of it
+            nearest = self._index.nearest(phash, dhash, self.policy.max_phash_distance, self.policy.max_dhash_distance,
+                                          exclude=sha256)
+        if nearest is None:
+            return None, "miss", (sha256, phash, dhash)
+        near = self._get(nearest[0])
+        if near is None or not self._reusable_near(near):
+            return None, "recheck", (sha256, phash, dhash)
+        # the reused verdict keeps its age, it expires with the verdict it was copied from
+        self.put(sha256, phash, dhash, json.loads(near["content"]), near_of=near["sha256"],
+                 created_at=near["created_at"])
+        return json.loads(near["content"]), "near", (sha256, phash, dhash)
+
+    def moderate(self, image_path: str) -> list:
+        """
+        content_moderation_image through the cache
+        """
+        content, how, (sha256, phash, dhash) = self.lookup(image_path)
+        with self._lock:
+            self.stats[how] += 1
+        if content is not None:
+            return content
+        content = self._moderate(image_path)
+        self.put(sha256, phash, dhash, content)
+        return content
+
+
+_moderation_cache = None
+_moderation_cache_lock = threading.Lock()
+
+
+def get_moderation_cache() -> ModerationCache:
+    global _moderation_cache
+    with _moderation_cache_lock:
+        if _moderation_cache is None:
+            _moderation_cache = ModerationCache()
+        return _moderation_cache
+
+
+def cached_content_moderation_image(image_filename: str) -> list:
+    return get_moderation_cache().moderate(image_filename)
@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+local pre-filter tier of text moderation
+
+texts are first matched against compiled term patterns of the moderation categories:
+    - allow terms are masked first, e.g. "kill switch" or "die-cast" in automotive copy, "GORE-TEX"
+    - a deny term, an unambiguous phrase, flags the text locally with the category of the term
+    - a suspect term escalates the text to the model
+    - a text without any term is escalated as well, a missing term is no proof a text is clean
+      (threats and harassment often use plain words). With clear_unmatched it is cleared locally instead,
+      for sources known to be catalog copy only, set by env moderation_clear_unmatched=1
+The terms can be extended with a json file {"allow": [..], "deny": {"category": [..]}, "suspect": [..]},
+set by env moderation_terms_file.
+
+usage:
+    moderator = get_text_moderator()
+    content = moderator.moderate(text)    # same content list as content_moderation_text
+    moderator.report()                    # escalation rate and latency per tier
+"""
+
+import json
+import os
+import re
+import threading
+import time
+import unicodedata
+from dataclasses import dataclass, field
+from typing import Callable, Final, Optional
+
+from utils.content_moderation import content_moderation_text
+
+CLEAR, FLAG, ESCALATE = "clear", "flag", "escalate"
+
+CLEAR_CONFIDENCE: Final[float] = 0.9
+FLAG_CONFIDENCE: Final[float] = 0.95
+
+# terms are regular expressions, latin terms match whole words only. A deny term flags without the model, so
+# only phrases that can't be product copy are deny terms: single words like "gore" (GORE-TEX), "nude"
+# (nude lipstick) or "xxx" (XXX-Large) are suspect terms, the model decides on them
+DENY_TERMS: Final[dict] = {
+    "hate/threatening": [
+        r"(?:kill|exterminate|eradicate|gas) (?:all )?(?:the )?"
+        r"(?:jews|muslims|christians|blacks|whites|asians|gays|immigrants)",
+    ],
+    "hate": [
+        r"(?:jews|muslims|blacks|asians|gays|immigrants) are (?:vermin|animals|subhuman|parasites)",
+        r"heil hitler", r"种族灭绝",
+    ],
+    "self-harm": [
+        r"kill myself", r"end my life", r"suicide (?:method|methods|kit)",
+        r"how to (?:commit suicide|kill yourself|hang yourself)", r"自杀方法", r"我想自杀",
+    ],
+    "sexual/minors": [
+        r"child porn\w*", r"underage porn\w*", r"儿童色情",
+    ],
+    "sexual": [
+        r"porn (?:videos?|sites?|movies?)", r"sex tapes?", r"send nudes", r"nude (?:photos|pics|selfies)",
+        r"色情", r"裸照", r"成人视频",
+    ],
+    "violence": [
+        r"how to (?:make|build) a (?:bomb|pipe bomb|explosive)", r"mass shooting", r"制作炸弹",
+    ],
+    "violence/graphic": [
+        r"(?:graphic|extreme) gore", r"gore videos?", r"血腥暴力",
+    ],
+}
+SUSPECT_TERMS: Final[list] = [
+    r"hate\w*", r"kill\w*", r"murder\w*", r"die", r"dead", r"death", r"blood\w*", r"guns?", r"weapons?", r"knife",
+    r"knives", r"shoot\w*", r"bomb\w*", r"explosive\w*", r"attack\w*", r"suicid\w*", r"sex\w*", r"naked", r"drugs?",
+    r"racis\w*", r"nazi\w*", r"terror\w*", r"slave\w*", r"porn\w*", r"xxx", r"nudes?", r"blowjob", r"gore",
+    r"dismember\w*", r"decapitat\w*", r"white power", r"cut myself",
+    # harassment and threats
+    r"hurt you", r"where you live", r"watch your back", r"kys", r"threat\w*",
+    r"you(?:'|’)?(?:re| are) (?:worthless|pathetic|disgusting|trash)", r"you(?:'|’)?(?:ll| will) (?:regret|pay for)",
+    # drugs
+    r"cocaine", r"heroin", r"meth", r"methamphetamine", r"fentanyl", r"mdma", r"weed", r"cannabis",
+    r"杀", r"死", r"枪", r"刀", r"炸", r"毒品", r"性感", r"血", r"恐怖", r"幼女", r"揍你", r"你等着", r"大麻", r"冰毒",
+]
+ALLOW_TERMS: Final[list] = [
+    r"kill switch(?:es)?", r"dead (?:battery|pedal|bolt|weight)", r"die[- ]?cast\w*", r"blood pressure",
+    r"(?:heat|glue|grease|spray|nail|caulking|staple) guns?", r"(?:utility|pocket|putty) knife", r"knife edge",
+    r"shock absorbers?", r"sex pistols", r"gore[- ]?tex\w*", r"x{2,4}l", r"x{2,4}-?large",
+    r"nude[- ](?:colou?r\w*|tones?|shades?|beige|pink|heels?|pumps?|sandals?|shoes|lipsticks?|lip\w*|"
+    r"nails?|polish|makeup|palettes?|eyeshadows?|bras?|underwear|leggings|tights|stockings|patent|leather)",
+    r"杀菌", r"刀片式", r"死角",
+]
+
+
+def _alternation(terms: list[str]) -> str:
+    # word boundaries only around latin terms, chinese text has no spaces between words,
+    # the boundaries are factored out of the latin terms so they are tested once per position
+    latin = [f"(?:{term})" for term in terms if term.isascii()]
+    other = [f"(?:{term})" for term in terms if not term.isascii()]
+    return "|".join(([r"\b(?:" + "|".join(latin) + r")\b"] if latin else []) + other)
+
+
+def normalize(text: str) -> str:
+    """
+    NFKC and case folded, so full width letters and upper case spellings match the terms
+    """
+    return unicodedata.normalize("NFKC", text).casefold()
+
+
+@dataclass
+class PrefilterResult:
+    decision: str
+    category: str = ""
+    matches: list[str] = field(default_factory=list)
+    seconds: float = 0.0
+
+    def verdict(self) -> dict:
+        """
+        the verdict in the json format of the model, for the texts decided locally
+        """
+        if self.decision == FLAG:
+            reason = f"matched {self.category} terms: {', '.join(self.matches)}"
+            return {"Moderation": True, "Category": self.category, "confidence_score": FLAG_CONFIDENCE,
+                    "Reason": reason, "Tier": "local"}
+        return {"Moderation": False, "Category": "", "confidence_score": CLEAR_CONFIDENCE,
+                "Reason": "no terms of the moderation categories", "Tier": "local"}
+
+
+class TextPrefilter:
+
+    def __init__(self, deny: Optional[dict] = None, suspect: Optional[list] = None, allow: Optional[list] = None,
+                 flag_locally: bool = True, clear_unmatched: bool = False):
+        """
+        :param deny: category -> terms flagged locally, default DENY_TERMS
+        :param suspect: terms escalated to the model, default SUSPECT_TERMS
+        :param allow: terms ignored, default ALLOW_TERMS
+        :param flag_locally: False escalates deny matches as well
+        :param clear_unmatched: clear texts without any term locally instead of escalating them, only for
+            sources known to hold product copy
+        """
+        deny = DENY_TERMS if deny is None else deny
+        self.flag_locally = flag_locally
+        self.clear_unmatched = clear_unmatched
+        self._categories = list(deny)
+        # one alternation per tier, a named group per deny category tells the category of a match
+        groups = [f"(?P<c{i}>{_alternation(terms)})" for i, terms in enumerate(deny.values()) if terms]
+        self._deny = re.compile("|".join(groups)) if groups else None
+        self._suspect = re.compile(_alternation(SUSPECT_TERMS if suspect is None else suspect))
+        allow = ALLOW_TERMS if allow is None else allow
+        self._allow = re.compile(_alternation(allow)) if allow else None
+
+    @classmethod
+    def from_file(cls, path: str, **kwargs) -> "TextPrefilter":
+        """
+        the default terms extended with the terms of a json file
+        """
+        with open(path, "r", encoding="utf-8") as f:
+            extra = json.load(f)
+        deny = {category: list(terms) for category, terms in DENY_TERMS.items()}
+        for category, terms in extra.get("deny", {}).items():
+            deny.setdefault(category, []).extend(terms)
+        return cls(deny=deny, suspect=SUSPECT_TERMS + extra.get("suspect", []),
+                   allow=ALLOW_TERMS + extra.get("allow", []), **kwargs)
+
+    def check(self, text: str) -> PrefilterResult:
+        start = time.perf_counter()
+        normalized = normalize(text)
+        if self._allow:
+            normalized = self._allow.sub(" ", normalized)
+
+        deny_matches = list(self._deny.finditer(normalized)) if self._deny else []
+        if deny_matches:
+            category = self._categories[int(deny_matches[0].lastgroup[1:])]
+            result = PrefilterResult(FLAG if self.flag_locally else ESCALATE, category,
+                                     sorted({match.group() for match in deny_matches}))
+        else:
+            suspect_matches = sorted({match.group() for match in self._suspect.finditer(normalized)})
+            clear = not suspect_matches and self.clear_unmatched
+            result = PrefilterResult(CLEAR if clear else ESCALATE, matches=suspect_matches)
+        result.seconds = time.perf_counter() - start
+        return result
+
+
+class TieredTextModerator:
+    """
+    the pre-filter first, the model for escalated texts only
+    """
+
+    def __init__(self, prefilter: Optional[TextPrefilter] = None,
+                 moderate: Callable[[str], list] = content_moderation_text):
+        """
+        :param moderate: the model tier, returns the model output content list
+        """
+        self.prefilter = prefilter or TextPrefilter()
+        self._moderate = moderate
+        self._lock = threading.Lock()
+        self.stats: dict = {"texts": 0, CLEAR: 0, FLAG: 0, ESCALATE: 0, "local_seconds": 0.0, "model_seconds": 0.0}
+
+    def record(self, result: PrefilterResult, model_seconds: float = 0.0):
+        with self._lock:
+            self.stats["texts"] += 1
+            self.stats[result.decision] += 1
+            self.stats["local_seconds"] += result.seconds
+            self.stats["model_seconds"] += model_seconds
+
+    def moderate(self, text: str) -> list:
+        result = self.prefilter.check(text)
+        if result.decision != ESCALATE:
+            self.record(result)
+            return [{"text": json.dumps(result.verdict(), ensure_ascii=False)}]
+        start = time.perf_counter()
+        content = self._moderate(text)
+        self.record(result, time.perf_counter() - start)
+        return content
+
+    def report(self) -> dict:
+        """
+        escalation rate and mean latency per tier, local in microseconds, model in seconds
+        """
+        with self._lock:
+            stats = dict(self.stats)
+        texts = stats["texts"]
+        return {
+            "texts": texts,
+            "cleared": stats[CLEAR],
+            "flagged": stats[FLAG],
+            "escalated": stats[ESCALATE],
+            "escalation_rate": round(stats[ESCALATE] / texts, 4) if texts else 0.0,
+            "local_mean_us": round(stats["local_seconds"] / texts * 1e6, 1) if texts else 0.0,
+            "model_mean_s": round(stats["model_seconds"] / stats[ESCALATE], 3) if stats[ESCALATE] else 0.0,
+        }
+
+
+def create_prefilter() -> TextPrefilter:
+    """
+    default terms, extended by the file of env moderation_terms_file if set, texts without any term are
+    cleared locally only with env moderation_clear_unmatched=1
+    """
+    path = os.getenv("moderation_terms_file")
+    clear_unmatched = os.getenv("moderation_clear_unmatched", "0") == "1"
+    if path:
+        return TextPrefilter.from_file(path, clear_unmatched=clear_unmatched)
+    return TextPrefilter(clear_unmatched=clear_unmatched)
+
+
+_text_moderator = None
+_text_moderator_lock = threading.Lock()
+
+
+def get_text_moderator() -> TieredTextModerator:
+    global _text_moderator
+    with _text_moderator_lock:
+        if _text_moderator is None:
+            _text_moderator = TieredTextModerator(create_prefilter())
+        return _text_moderator
+
+
+def tiered_content_moderation_text(text: str) -> list:
+    return get_text_moderator().moderate(text)
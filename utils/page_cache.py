@@ -0,0 +1,202 @@
+"""
+Streamlit caches shared by the pages.
+
+Every widget interaction reruns a page script, these wrappers keep the work of a rerun to what changed:
+the catalog and the response cache are resources shared by all sessions (boto3 clients are already shared
+by utils.aws_clients), product data, prompts and model outputs are cached data keyed by their inputs.
+Every cache has a size and / or TTL bound so many concurrent users don't multiply memory use.
+"""
+import os
+import re
+import time
+import hashlib
+import threading
+from pathlib import Path
+
+import streamlit as st
+
+from utils.catalog_store import LruCache, get_catalog
+
+# generated listings / reports kept for reruns and other users asking the same
+RESPONSE_CACHE_SIZE = 128
+DATA_TTL = 3600
+# uploads not used for this long are deleted, checked at most once per UPLOAD_PRUNE_INTERVAL
+UPLOAD_MAX_AGE = 24 * 3600
+UPLOAD_PRUNE_INTERVAL = 600
+# names written by save_upload, other files of the save folder (generated images) are left alone
+UPLOAD_NAME = re.compile(r'[0-9a-f]{16}_.+')
+
+
+def cached_catalog():
+    # get_catalog is a process wide singleton already, called on every use so it can resync its folders
+    return get_catalog()
+
+
+@st.cache_resource
+def job_queue():
+    from utils.job_queue import get_job_queue
+
+    return get_job_queue()
+
+
+@st.cache_resource
+def response_cache():
+    """
+    Text of finished streamed responses by (model id, prompt), shared by all sessions.
+    Streams can't be cached by st.cache_data, pages put the text once the stream is done.
+    """
+    return LruCache(RESPONSE_CACHE_SIZE)
+
+
+@st.cache_data(ttl=60, max_entries=16, show_spinner=False)
+def list_asins(with_product=False, with_reviews=False):
+    return cached_catalog().list_asins(with_product=with_product, with_reviews=with_reviews)
+
+
+def scraper_cache():
+    # the scraper stack is only loaded by pages fetching live data
+    from utils.scraper_cache import get_scraper_cache
+
+    return get_scraper_cache()
+
+
+@st.cache_data(ttl=DATA_TTL, max_entries=256, show_spinner=False)
+def product(asin, live=False, domain='com'):
+    """
+    :param live: fetch the product page through the scraper cache first, it is ingested into the catalog
+    """
+    if live:
+        scraper_cache().get_product(asin, domain)
+    return cached_catalog().get_product(asin)
+
+
+@st.cache_data(ttl=600, max_entries=32, show_spinner=False)
+def reviews(asin, live=False, domain='com'):
+    if live:
+        scraper_cache().get_reviews(asin, domain)
+    return list(cached_catalog().iter_reviews(asin))
+
+
+@st.cache_data(ttl=DATA_TTL, max_entries=64, show_spinner=False)
+def listing_prompt(asin, domain, brand, features, language, live=False):
+    from utils.listing_voc_prompt import gen_listing_prompt
+
+    return gen_listing_prompt(asin, domain, brand, features, language, live=live)
+
+
+@st.cache_data(ttl=DATA_TTL, max_entries=64, show_spinner=False)
+def reference_listings(query):
+    from utils.listing_index import find_reference_listings
+
+    return find_reference_listings(query)
+
+
+@st.cache_data(ttl=DATA_TTL, max_entries=32, show_spinner=False)
+def voc_prompt(model_id, asin, language, review_count):
+    """
+    The VoC report prompt, the map step over the review chunks runs once per (model, ASIN, language).
+    A failed map step raises VocMapError, which isn't cached.
+
+    :param review_count: reviews of the ASIN in the catalog, new reviews give a new prompt
+    """
+    from utils.voc_engine import VocEngine
+
+    return VocEngine(model_id).build_prompt_for_asin(asin, language)
+
+
+def incremental_voc_prompt(model_id, asin, language):
+    """
+    The VoC report prompt from the stored VoC state, refreshed with the new reviews of the ASIN.
+    Not cached: every call updates the stored state, which is the cache of the analyzed reviews.
+    """
+    from utils.voc_engine import VocEngine
+    from utils.voc_state import incremental_voc_prompt
+
+    return incremental_voc_prompt(VocEngine(model_id), asin, language)
+
+
+@st.cache_data(ttl=DATA_TTL, max_entries=128, show_spinner=False)
+def moderate_text(text):
+    from utils.moderation_prefilter import tiered_content_moderation_text
+
+    return tiered_content_moderation_text(text)
+
+
+def text_moderation_report():
+    """
+    Escalation rate and latency per tier of the texts moderate_text sent through the tiers, not cached.
+    """
+    from utils.moderation_prefilter import get_text_moderator
+
+    return get_text_moderator().report()
+
+
+@st.cache_data(ttl=DATA_TTL, max_entries=64, show_spinner=False)
+def moderate_image(image_path, digest):
+    """
+    :param digest: content digest of the image, so a replaced file with the same path isn't served stale
+    """
+    from utils.moderation_cache import cached_content_moderation_image
+
+    return cached_content_moderation_image(str(image_path))
+
+
+@st.cache_data(ttl=DATA_TTL, max_entries=64, show_spinner=False)
+def prompt_from_image(image_path, digest, style):
+    from utils.image_generation import generate_prompt_from_image
+
+    return generate_prompt_from_image(image_path, style=style)
+
+
+_pruned_at = 0.0
+_prune_lock = threading.Lock()
+
+
+def prune_uploads(folder, max_age=UPLOAD_MAX_AGE):
+    """
+    Delete the uploads of the folder not used for max_age seconds.
+
+    :return: number of files deleted
+    """
+    cutoff = time.time() - max_age
+    removed = 0
+    for path in Path(folder).iterdir():
+        if not UPLOAD_NAME.fullmatch(path.name):
+            continue
+        try:
+            if path.stat().st_mtime < cutoff:
+                path.unlink()
+                removed += 1
+        except FileNotFoundError:
+            # pruned by another session at the same time
+            pass
+    return removed
+
+
+def save_upload(uploaded_file):
+    """
+    Write an uploaded file to the save folder once, reruns reuse it. Old uploads are pruned along the way.
+
+    :return: (path, content digest)
+    """
+    global _pruned_at
+
+    data = uploaded_file.getvalue()
+    digest = hashlib.sha256(data).hexdigest()
+    folder = os.getenv('save_folder')
+    with _prune_lock:
+        prune = time.time() - _pruned_at > UPLOAD_PRUNE_INTERVAL
+        if prune:
+            _pruned_at = time.time()
+    if prune:
+        prune_uploads(folder)
+    # the digest in the name keeps two different uploads with the same name apart
+    save_path = Path(folder, digest[:16] + '_' + uploaded_file.name)
+    if save_path.exists():
+        # reused uploads are kept, their age counts from the last use
+        os.utime(save_path)
+    else:
+        tmp_path = save_path.with_name(save_path.name + '.tmp')
+        tmp_path.write_bytes(data)
+        os.replace(tmp_path, save_path)
+    return save_path, digest
@@ -0,0 +1,80 @@
+"""
+Background jobs of the pages, see utils.job_queue.
+
+The job id is kept in the session state and in the query parameters of the page, so the job keeps running
+through reruns and page switches and its progress is shown again when the user comes back. Jobs are only shown
+to their owner, a copied url doesn't show the job to anyone else; with login configured (st.user) the owner is
+the user, so a browser reload finds the job again, otherwise it is the session.
+"""
+import uuid
+
+import streamlit as st
+
+from utils.job_queue import DONE, FINISHED, RUNNING
+from utils.page_cache import job_queue
+
+# seconds between polls while a job of the session is running
+POLL_INTERVAL = 1.0
+
+
+def session_owner():
+    user = getattr(st, 'user', None)
+    if user is not None and user.get('is_logged_in') and user.get('email'):
+        return 'user:' + user.get('email')
+    if 'job_owner' not in st.session_state:
+        st.session_state.job_owner = uuid.uuid4().hex
+    return st.session_state.job_owner
+
+
+def submit_job(state_key, kind, params):
+    """
+    Submit a job and remember it under state_key, replacing the previous one.
+    """
+    job_id = job_queue().submit(kind, params, owner=session_owner())
+    st.session_state[state_key] = job_id
+    # a reload starts a new session, the job is found again from the url if the owner is the same
+    st.query_params[state_key] = job_id
+
+
+def _forget_job(state_key):
+    st.session_state.pop(state_key, None)
+    if state_key in st.query_params:
+        del st.query_params[state_key]
+
+
+def show_job(state_key, render_result, render_partial=None):
+    """
+    Show the job remembered under state_key: progress while it runs, render_result(result) once it is done.
+    """
+    job_id = st.session_state.get(state_key) or st.query_params.get(state_key)
+    if not job_id:
+        return
+    job = job_queue().poll(job_id, owner=session_owner())
+    if job is None:
+        # unknown, purged, or the job of someone else
+        _forget_job(state_key)
+        return
+    st.session_state[state_key] = job_id
+
+    if job['status'] == DONE:
+        render_result(job_queue().result(job_id, owner=session_owner()))
+    elif job['status'] in FINISHED:
+        st.error(f"任务{'已取消' if job['status'] == 'cancelled' else '失败: ' + (job['error'] or '')}")
+    else:
+        _poll_job(state_key, job_id, render_partial)
+
+
+@st.fragment(run_every=POLL_INTERVAL)
+def _poll_job(state_key, job_id, render_partial):
+    """
+    Progress of an unfinished job, only this fragment reruns every POLL_INTERVAL seconds, not the whole page.
+    """
+    job = job_queue().poll(job_id, owner=session_owner())
+    if job is None or job['status'] in FINISHED:
+        # one rerun of the page renders the finished job and stops the polling
+        st.rerun()
+    st.progress(job['progress'] or 0.0, text=job['message'] or ('运行中...' if job['status'] == RUNNING else '排队中...'))
+    if job['partial'] and render_partial:
+        render_partial(job['partial'])
+    if st.button('取消任务', key=state_key + '_cancel'):
+        job_queue().cancel(job_id)
@@ -0,0 +1,171 @@
+"""
+Harvest all review pages of an ASIN into an append-only jsonl file.
+
+Pages are fetched concurrently by a fixed number of workers, each page is written as soon as it arrives
+and only review ids are kept in memory, so memory stays flat for tens of thousands of reviews.
+Finished pages are logged next to the reviews, an interrupted harvest resumes with the missing pages.
+
+usage:
+    python -m utils.review_harvester B0BZYCJK89 com
+"""
+import os
+import json
+import asyncio
+import logging
+
+from utils.amazon_scraper import AsyncAmazonScraperClient
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_WORKERS = 8
+
+
+class ReviewHarvester:
+
+    def __init__(self, client=None, folder=None, workers=DEFAULT_WORKERS, max_pages=None):
+        """
+        :param client: AsyncAmazonScraperClient, a new one if None
+        :param folder: output folder, default to env reviews_folder or ./data/reviews
+        :param workers: pages fetched concurrently
+        :param max_pages: stop after this many pages, all pages if None
+        """
+        # a client passed in is the caller's to close
+        self._owns_client = client is None
+        self.client = client or AsyncAmazonScraperClient(max_concurrency=workers)
+        self.folder = folder or os.getenv('reviews_folder', './data/reviews')
+        self.workers = workers
+        self.max_pages = max_pages
+        os.makedirs(self.folder, exist_ok=True)
+
+    def close(self):
+        if self._owns_client:
+            self.client.close()
+
+    def reviews_path(self, asin):
+        return os.path.join(self.folder, 'asin_' + asin + '_reviews.jsonl')
+
+    def pages_path(self, asin):
+        return os.path.join(self.folder, 'asin_' + asin + '_pages.jsonl')
+
+    def _drop_partial_line(self, path):
+        """
+        Cut a line left half written by an interrupted harvest.
+        """
+        if not os.path.exists(path):
+            return
+        with open(path, 'rb+') as file:
+            data = file.read()
+            if data and not data.endswith(b'\n'):
+                file.truncate(data.rfind(b'\n') + 1)
+
+    def _load_progress(self, asin):
+        """
+        Ids of reviews already written and {page: pages} of pages already finished.
+        """
+        self._drop_partial_line(self.reviews_path(asin))
+        self._drop_partial_line(self.pages_path(asin))
+        review_ids = set()
+        if os.path.exists(self.reviews_path(asin)):
+            with open(self.reviews_path(asin), 'r', encoding='utf-8') as file:
+                for line in file:
+                    review_ids.add(json.loads(line)['id'])
+        done_pages = {}
+        if os.path.exists(self.pages_path(asin)):
+            with open(self.pages_path(asin), 'r', encoding='utf-8') as file:
+                for line in file:
+                    item = json.loads(line)
+                    done_pages[item['page']] = item['pages']
+        return review_ids, done_pages
+
+    async def _fetch_page(self, asin, do, page):
+        response = await self.client.get_reviews(asin, do, start_page=page)
+        content = response['results'][0]['content']
+        return content.get('reviews') or [], content.get('pages') or 1
+
+    async def harvest(self, asin, do):
+        """
+        Fetch all missing review pages of an ASIN.
+
+        :return: {'pages': total pages, 'fetched_pages': n, 'new_reviews': n, 'total_reviews': n, 'failed_pages': [..]}
+        """
+        review_ids, done_pages = self._load_progress(asin)
+        stats = {'fetched_pages': 0, 'new_reviews': 0, 'failed_pages': []}
+
+        with open(self.reviews_path(asin), 'a', encoding='utf-8') as reviews_file, \
+                open(self.pages_path(asin), 'a', encoding='utf-8') as pages_file:
+
+            def write_page(page, reviews, pages):
+                # reviews first, then the page log, so a logged page is always complete on disk
+                for review in reviews:
+                    if review.get('id') and review['id'] not in review_ids:
+                        review_ids.add(review['id'])
+                        reviews_file.write(json.dumps(review, ensure_ascii=False) + '\n')
+                        stats['new_reviews'] += 1
+                reviews_file.flush()
+                pages_file.write(json.dumps({'page': page, 'pages': pages}) + '\n')
+                pages_file.flush()
+                done_pages[page] = pages
+                stats['fetched_pages'] += 1
+
+            # the first page tells the number of pages
+            if 1 in done_pages:
+                total_pages = max(done_pages.values())
+            else:
+                reviews, total_pages = await self._fetch_page(asin, do, 1)
+                write_page(1, reviews, total_pages)
+            if self.max_pages:
+                total_pages = min(total_pages, self.max_pages)
+
+            queue = asyncio.Queue()
+            for page in range(2, total_pages + 1):
+                if page not in done_pages:
+                    queue.put_nowait(page)
+
+            async def worker():
+                while not queue.empty():
+                    page = queue.get_nowait()
+                    try:
+                        reviews, pages = await self._fetch_page(asin, do, page)
+                    except Exception as e:
+                        logger.warning(f"review page {page} of {asin} failed: {e}")
+                        stats['failed_pages'].append(page)
+                        continue
+                    write_page(page, reviews, pages)
+
+            await asyncio.gather(*(worker() for _ in range(self.workers)))
+
+        stats['pages'] = total_pages
+        stats['total_reviews'] = len(review_ids)
+        logger.info(f"harvested {asin}: {stats}")
+        return stats
+
+
+def harvest_reviews(asin, do, **kwargs):
+    """
+    Blocking wrapper of ReviewHarvester.harvest.
+    """
+    harvester = ReviewHarvester(**kwargs)
+    try:
+        return asyncio.run(harvester.harvest(asin, do))
+    finally:
+        harvester.close()
+
+
+def iter_harvested_reviews(asin, folder=None):
+    """
+    Stream the harvested raw reviews of an ASIN, one at a time.
+    """
+    folder = folder or os.getenv('reviews_folder', './data/reviews')
+    path = os.path.join(folder, 'asin_' + asin + '_reviews.jsonl')
+    if not os.path.exists(path):
+        return
+    with open(path, 'r', encoding='utf-8') as file:
+        for line in file:
+            yield json.loads(line)
+
+
+if __name__ == '__main__':
+    import sys
+
+    logging.basicConfig(level=logging.INFO)
+    print(harvest_reviews(sys.argv[1], sys.argv[2] if len(sys.argv) > 2 else 'com'))
@@ -0,0 +1,160 @@
+import re
+
+# rating based sentiment, 4-5 stars positive, 3 neutral, 1-2 negative
+POSITIVE_MIN_RATING = 4
+NEGATIVE_MAX_RATING = 2
+
+# a review mentions a topic if one of its words is a topic term, a term ending with * matches as a prefix
+# topics every product has
+GENERIC_TOPICS = {
+    'quality': ['quality', 'sturdy', 'sturdier', 'cheap*', 'flimsy', 'solid'],
+    'durability': ['durab*', 'broke', 'broken', 'breaks', 'crack*', 'dent', 'dents', 'dented', 'lasted', 'lasting',
+                   'scratch*'],
+    'design': ['design*', 'color*', 'colour*', 'look', 'looks', 'style*', 'pretty', 'cute', 'sleek'],
+    'ease of use': ['easy', 'easily', 'easier', 'convenien*', 'intuitive'],
+    'price': ['price*', 'worth', 'expensive', 'value', 'money', 'overpriced', 'affordable'],
+    'shipping & packaging': ['shipping', 'shipped', 'arrived', 'packag*', 'deliver*'],
+    'customer service': ['service', 'return*', 'refund*', 'replace*', 'warranty', 'support'],
+}
+# topics of a category, picked by words of the category names or the title of the product
+CATEGORY_TOPICS = {
+    'drinkware': {
+        'match': ['bottle', 'bottles', 'thermos', 'thermoses', 'tumbler', 'tumblers', 'mug', 'mugs', 'drinkware',
+                  'beverage'],
+        'topics': {
+            'cleaning': ['clean*', 'wash*', 'dishwasher*', 'mold*', 'mould*'],
+            'leaks': ['leak*', 'spill*', 'drip*', 'seal', 'seals', 'sealed'],
+            'temperature': ['cold', 'colder', 'hot', 'ice', 'icy', 'insulat*', 'warm', 'warmer'],
+            'size': ['size', 'fits', 'cupholder*', 'holder', 'heavy', 'weight', 'oz', 'ounce*'],
+        },
+    },
+    'electronics': {
+        'match': ['phone', 'phones', 'iphone', 'laptop', 'laptops', 'macbook', 'computer', 'computers', 'tablet',
+                  'tablets', 'electronics', 'headphones'],
+        'topics': {
+            'battery': ['battery', 'batteries', 'charg*'],
+            'screen': ['screen*', 'display*', 'bright*', 'resolution'],
+            'performance': ['fast', 'faster', 'speed*', 'slow*', 'lag*', 'performance', 'responsive'],
+            'camera': ['camera*', 'photo*', 'picture*', 'video*'],
+            'sound': ['sound*', 'speaker*', 'audio', 'volume'],
+            'condition': ['renewed', 'refurbished', 'condition', 'scratch*', 'unlocked'],
+        },
+    },
+}
+
+STOPWORDS = frozenset('''
+a about after all also am an and any are as at be because been but by can could did do does
+don't for from get got had has have he her him his how i i'm if in into is it it's its just
+like me more most much my no not now of on one only or other our out over so some than that
+the their them then there these they this to too up us very was we were what when which while
+who will with would you your it’s i’ve i’m don’t
+'''.split())
+
+_WORD = re.compile(r"[a-z][a-z'’]+")
+
+
+def topic_terms(product=None):
+    """
+    Topic terms of a product, the generic topics and those of its categories.
+
+    :param product: parsed product content of the catalog, only the generic topics if None
+    """
+    topics = dict(GENERIC_TOPICS)
+    if not product:
+        return topics
+    names = [product.get('title') or '']
+    for category in product.get('category') or []:
+        names.extend(step.get('name', '') for step in category.get('ladder') or [])
+    words = set(re.findall(r"[a-z]+", ' '.join(names).lower()))
+    for category in CATEGORY_TOPICS.values():
+        if words.intersection(category['match']):
+            topics.update(category['topics'])
+    return topics
+
+
+def compute_review_stats(reviews, top_k=15, topics=None):
+    """
+    Compute the VoC statistics of slim reviews locally, without a model call.
+
+    :param topics: {topic: terms}, from topic_terms of the product, the generic topics if None
+
+    :return: dict of count, rating distribution, sentiment, verified share, topics and top keywords
+    """
+    count = len(reviews)
+    if count == 0:
+        return {'count': 0}
+
+    # numpy is imported on first use, the pages importing this module don't pay for it on cold start
+    import numpy as np
+
+    ratings = np.array([review.get('rating') or 0 for review in reviews], dtype=np.int8)
+    verified = np.array([bool(review.get('verified')) for review in reviews])
+    helpful = np.array([review.get('helpful') or 0 for review in reviews], dtype=np.int64)
+
+    distribution = np.bincount(np.clip(ratings, 0, 5), minlength=6)[1:]
+    sentiment = {
+        'positive': int((ratings >= POSITIVE_MIN_RATING).sum()),
+        'neutral': int(((ratings > NEGATIVE_MAX_RATING) & (ratings < POSITIVE_MIN_RATING)).sum()),
+        'negative': int(((ratings > 0) & (ratings <= NEGATIVE_MAX_RATING)).sum()),
+    }
+
+    # one flat array of word ids and the review index of each word, a dict is much faster than sorting strings
+    vocabulary_ids = {}
+    word_ids = []
+    review_index = []
+    for i, review in enumerate(reviews):
+        tokens = _WORD.findall((review.get('title', '') + ' ' + review.get('content', '')).lower())
+        word_ids.extend([vocabulary_ids.setdefault(token, len(vocabulary_ids)) for token in tokens])
+        review_index.extend([i] * len(tokens))
+    vocabulary = np.array(list(vocabulary_ids), dtype=str)
+    word_ids = np.array(word_ids, dtype=np.int64)
+    review_index = np.array(review_index, dtype=np.int64)
+
+    # topic and stopword masks are computed on the vocabulary only, then looked up per word
+    topic_stats = {}
+    for topic, terms in (topics or GENERIC_TOPICS).items():
+        vocabulary_mask = np.zeros(vocabulary.size, bool)
+        for term in terms:
+            if vocabulary.size:
+                vocabulary_mask |= np.char.startswith(vocabulary, term[:-1]) if term.endswith('*') \
+                    else vocabulary == term
+        mentioned = np.bincount(review_index[vocabulary_mask[word_ids]], minlength=count) > 0
+        if mentioned.any():
+            topic_stats[topic] = {
+                'reviews': int(mentioned.sum()),
+                'avg_rating': round(float(ratings[mentioned].mean()), 2),
+            }
+
+    keyword_counts = np.bincount(word_ids, minlength=vocabulary.size)
+    keyword_counts[np.isin(vocabulary, list(STOPWORDS))] = 0
+    top = np.argsort(-keyword_counts, kind='stable')[:top_k]
+
+    return {
+        'count': count,
+        'avg_rating': round(float(ratings.mean()), 2),
+        'helpful_weighted_rating': round(float(np.average(ratings, weights=helpful + 1)), 2),
+        'rating_distribution': {f'{star} star': int(n) for star, n in zip(range(1, 6), distribution)},
+        'sentiment': sentiment,
+        'verified_share': round(float(verified.mean()), 3),
+        'topics': dict(sorted(topic_stats.items(), key=lambda item: -item[1]['reviews'])),
+        'top_keywords': {str(vocabulary[i]): int(keyword_counts[i]) for i in top if keyword_counts[i]},
+    }
+
+
+def format_review_stats(stats):
+    """
+    Compact text of the review statistics for prompts.
+    """
+    if not stats.get('count'):
+        return 'no reviews'
+    count = stats['count']
+    lines = [
+        f"reviews: {count}, average rating: {stats['avg_rating']}, helpful weighted rating: {stats['helpful_weighted_rating']}",
+        'rating distribution: ' + ', '.join(f'{k}: {v}' for k, v in stats['rating_distribution'].items()),
+        'sentiment by rating: ' + ', '.join(f'{k}: {v} ({v / count:.0%})' for k, v in stats['sentiment'].items()),
+        f"verified purchases: {stats['verified_share']:.0%}",
+        'topics (reviews mentioning, avg rating): ' + ', '.join(
+            f"{topic}: {value['reviews']} ({value['avg_rating']})" for topic, value in stats['topics'].items()),
+        'top keywords: ' + ', '.join(f'{k}: {v}' for k, v in stats['top_keywords'].items()),
+    ]
+    return '\n'.join(lines)
@@ -0,0 +1,71 @@
+import os
+import re
+import json
+from datetime import datetime
+
+# loading reviews saved from amazon_scraper.get_reviews
+data_folder = './data/'
+
+# review fields sent to the model, verified share, helpfulness and dates are in the precomputed review statistics
+PROMPT_FIELDS = ('rating', 'title', 'content')
+
+_STARS_PREFIX = re.compile(r"^\d(\.\d)? out of 5 stars\s*")
+_REVIEW_DATE = re.compile(r"([A-Z][a-z]+ \d{1,2}, \d{4})\s*$")
+
+
+def load_reviews_response(asin):
+    """
+    Load the saved reviews response of an ASIN.
+    """
+    filename = os.path.join(data_folder, 'asin_' + asin + '_reviews.json')
+    with open(filename, 'r', encoding='utf-8') as file:
+        return json.load(file)
+
+
+def iter_raw_reviews(response):
+    """
+    Iterate the reviews of every result page in a reviews response.
+    """
+    for result in response.get('results', []):
+        for review in result.get('content', {}).get('reviews') or []:
+            yield review
+
+
+def parse_review_date(timestamp):
+    """
+    'Reviewed in the United States August 3, 2024' -> '2024-08-03', '' if the date is not found.
+    """
+    match = _REVIEW_DATE.search(timestamp or '')
+    if not match:
+        return ''
+    try:
+        return datetime.strptime(match.group(1), '%B %d, %Y').date().isoformat()
+    except ValueError:
+        return ''
+
+
+def slim_review(review):
+    """
+    Keep only the review fields needed for analysis, drop urls, profile ids and other metadata.
+    """
+    return {
+        'id': review.get('id'),
+        'rating': review.get('rating'),
+        'title': _STARS_PREFIX.sub('', review.get('title') or ''),
+        'content': review.get('content') or '',
+        'verified': bool(review.get('is_verified')),
+        'helpful': review.get('helpful_count') or 0,
+        'date': parse_review_date(review.get('timestamp')),
+    }
+
+
+def load_slim_reviews(asin):
+    return [slim_review(review) for review in iter_raw_reviews(load_reviews_response(asin))]
+
+
+def reviews_to_text(reviews, fields=PROMPT_FIELDS):
+    """
+    Compact json lines of slim reviews for prompts, with only the fields the model reads.
+    """
+    return '\n'.join(json.dumps({field: review.get(field) for field in fields}, ensure_ascii=False,
+                                separators=(',', ':')) for review in reviews)
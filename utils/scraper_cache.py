@@ -0,0 +1,147 @@
+"""
+TTL cache in front of the live scraper queries.
+
+Responses are cached by (source, domain, query) with a TTL per source. An expired response is still served
+while it is refreshed in the background (stale-while-revalidate), and concurrent requests of the same key
+share one upstream query (single-flight), so many users opening the same ASIN cost one billed query.
+The least recently used responses are dropped beyond max_entries.
+"""
+import time
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from utils.amazon_scraper import get_client
+from utils.catalog_store import LruCache, get_catalog
+
+logger = logging.getLogger(__name__)
+
+# seconds a response is fresh, per source
+DEFAULT_TTL = {
+    'amazon_product': 24 * 3600,
+    'amazon_reviews': 6 * 3600,
+    'amazon_bestsellers': 24 * 3600,
+}
+# seconds after expiry a response is still served while refreshing, older responses are fetched in the foreground
+DEFAULT_STALE_TTL = 7 * 24 * 3600
+DEFAULT_REFRESH_WORKERS = 4
+# responses kept in memory, product and review responses are a few hundred KB each
+DEFAULT_MAX_ENTRIES = 512
+
+
+class ScraperCache:
+
+    def __init__(self, client=None, ttl=None, stale_ttl=DEFAULT_STALE_TTL, refresh_workers=DEFAULT_REFRESH_WORKERS,
+                 on_fetch=None, max_entries=DEFAULT_MAX_ENTRIES):
+        """
+        :param client: AmazonScraperClient, the shared one if None
+        :param ttl: {source: seconds}, merged over DEFAULT_TTL
+        :param on_fetch: called with (source, domain, query, response) after each upstream query, e.g. to ingest it
+        :param max_entries: responses kept, least recently used first out
+        """
+        self.client = client or get_client()
+        self.ttl = {**DEFAULT_TTL, **(ttl or {})}
+        self.stale_ttl = stale_ttl
+        self.on_fetch = on_fetch
+        # (source, domain, query) -> (fetched_at, response)
+        self._entries = LruCache(max_entries)
+        # (source, domain, query) -> Future of the upstream query in flight
+        self._in_flight = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=refresh_workers)
+        self.stats = {'hits': 0, 'stale': 0, 'misses': 0, 'fetches': 0, 'errors': 0}
+
+    def _fetch(self, key, fetch, future):
+        source, domain, query = key
+        try:
+            response = fetch()
+            if self.on_fetch:
+                self.on_fetch(source, domain, query, response)
+        except Exception as e:
+            with self._lock:
+                self.stats['errors'] += 1
+                del self._in_flight[key]
+            logger.warning(f"scraper query {key} failed: {e}")
+            future.set_exception(e)
+            return
+        with self._lock:
+            self._entries.put(key, (time.time(), response))
+            self.stats['fetches'] += 1
+            del self._in_flight[key]
+        future.set_result(response)
+
+    def _start_fetch(self, key, fetch, background):
+        """
+        Future of the upstream query of key, joining the one in flight if any. Call with the lock held.
+        """
+        future = self._in_flight.get(key)
+        if future is None:
+            future = Future()
+            self._in_flight[key] = future
+            if background:
+                self._executor.submit(self._fetch, key, fetch, future)
+            else:
+                # the first caller runs the query itself, the others wait on its future
+                return future, True
+        return future, False
+
+    def get(self, source, domain, query, fetch):
+        """
+        Cached response of a query, fetch() is called upstream when the cache can't serve it.
+        """
+        key = (source, domain, query)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            age = now - entry[0] if entry else None
+            ttl = self.ttl.get(source, 0)
+            if entry and age < ttl:
+                self.stats['hits'] += 1
+                return entry[1]
+            if entry and age < ttl + self.stale_ttl:
+                self.stats['stale'] += 1
+                self._start_fetch(key, fetch, background=True)
+                return entry[1]
+            self.stats['misses'] += 1
+            future, owner = self._start_fetch(key, fetch, background=False)
+
+        if owner:
+            self._fetch(key, fetch, future)
+        try:
+            return future.result()
+        except Exception:
+            if entry:
+                # too old to serve normally, but better than nothing while the upstream fails
+                logger.warning(f"serving expired response of {key}")
+                return entry[1]
+            raise
+
+    def invalidate(self, source=None, domain=None, query=None):
+        self._entries.discard(lambda key: (source is None or key[0] == source) and (domain is None or key[1] == domain)
+                              and (query is None or key[2] == query))
+
+    def get_product(self, asin, do):
+        return self.get('amazon_product', do, asin, lambda: self.client.get_product(asin, do))
+
+    def get_reviews(self, asin, do):
+        return self.get('amazon_reviews', do, asin, lambda: self.client.get_reviews(asin, do))
+
+    def get_bestsellers(self, categoryid, do='com', start_page=1, department='automotive'):
+        return self.get('amazon_bestsellers', do, (department, categoryid, start_page),
+                        lambda: self.client.get_bestsellers(categoryid, do, start_page, department))
+
+
+_scraper_cache = None
+_scraper_cache_lock = threading.Lock()
+
+
+def get_scraper_cache():
+    """
+    The cache shared by the pages, fetched responses are ingested into the catalog.
+    """
+    global _scraper_cache
+    with _scraper_cache_lock:
+        if _scraper_cache is None:
+            _scraper_cache = ScraperCache(
+                on_fetch=lambda source, domain, query, response: get_catalog().ingest_response(response, domain))
+        return _scraper_cache
@@ -0,0 +1,214 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from utils.listing_voc_prompt import bedrock_converse_api, voc_prompt_template
+from utils.reviews import reviews_to_text
+from utils.catalog_store import get_catalog
+from utils.review_stats import compute_review_stats, format_review_stats, topic_terms
+
+logger = logging.getLogger(__name__)
+
+# review tokens per model call, llama3-70b has an 8k context and 2k of it is reserved for the output
+DEFAULT_CHUNK_TOKENS = 4000
+# summaries in the final report prompt, the template, the statistics and the output take the rest of the 8k
+DEFAULT_REDUCE_TOKENS = 4000
+DEFAULT_MAX_WORKERS = 4
+
+map_prompt_template = '''
+    You are an analyst preparing the input of a Voice of Customer (VoC) report. Below is one batch of customer reviews of an e-commerce product, one review per line in JSON.
+
+    Summarize this batch into concise notes under each of the following headings, keep approximate counts of reviews behind each point and quote one short review example per key point:
+    Positive Feedback
+    Areas for Improvement
+    Differentiation from Competitors
+    Unperceived Product Features
+    Core Factors for Repurchase and Recommendation
+    Ratings, sentiment and topic counts are computed separately, do not count them.
+
+    Do not disclose any personally identifiable information. Output the notes only.
+
+    <product reviews>
+    {product_reviews}
+    <product reviews>
+    '''
+
+merge_prompt_template = '''
+    Below are the analysis notes of several batches of customer reviews of the same e-commerce product.
+    Merge them into one set of notes with the same headings, combine duplicate points, add up the counts across batches and keep the most representative review examples.
+    Output the notes only.
+
+    {summaries}
+    '''
+
+reduce_note = '''Note: each item in <product reviews> below is the analysis notes of one batch of reviews, merge them and add up the counts across batches.'''
+
+
+class VocMapError(RuntimeError):
+    """
+    Some review chunks or summary groups failed, a report from the rest would cover only part of the reviews.
+    """
+
+    def __init__(self, failed, total, step='map'):
+        super().__init__(f"VoC {step} failed for {failed} of {total} chunks")
+        self.failed = failed
+        self.total = total
+        self.step = step
+
+
+def estimate_tokens(text):
+    """
+    Rough token count, about 4 characters per token for English and 1 token per CJK character.
+    """
+    # a CJK character takes 3 bytes in utf-8, 2 more than an ascii one
+    wide = (len(text.encode('utf-8')) - len(text)) // 2
+    return (len(text) - wide) // 4 + wide + 1
+
+
+def chunk_reviews(reviews, chunk_tokens=DEFAULT_CHUNK_TOKENS):
+    """
+    Split reviews into consecutive chunks of at most chunk_tokens, a longer review is a chunk on its own.
+    """
+    chunks = []
+    chunk = []
+    tokens = 0
+    for review in reviews:
+        review_tokens = estimate_tokens(reviews_to_text([review]))
+        if chunk and tokens + review_tokens > chunk_tokens:
+            chunks.append(chunk)
+            chunk = []
+            tokens = 0
+        chunk.append(review)
+        tokens += review_tokens
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+def format_summaries(summaries):
+    return '\n\n'.join(f'<batch {i}>\n{summary}\n</batch {i}>' for i, summary in enumerate(summaries, start=1))
+
+
+def group_summaries(items, group_tokens):
+    """
+    Split summary items into consecutive groups of at most group_tokens. A group holds at least two items,
+    so every merge round shrinks the list, only the last item may be left on its own.
+    """
+    groups = []
+    group = []
+    tokens = 0
+    for item in items:
+        item_tokens = estimate_tokens(item['summary'])
+        if len(group) >= 2 and tokens + item_tokens > group_tokens:
+            groups.append(group)
+            group = []
+            tokens = 0
+        group.append(item)
+        tokens += item_tokens
+    if group:
+        groups.append(group)
+    return groups
+
+
+class VocEngine:
+    """
+    Map-reduce VoC analysis, review chunks are summarized in parallel (map)
+    and the partial summaries are merged into the final report (reduce).
+
+    Summaries are passed around as items {"reviews": <number of reviews>, "summary": <analysis notes>}.
+    """
+
+    def __init__(self, model_id, chunk_tokens=DEFAULT_CHUNK_TOKENS, max_workers=DEFAULT_MAX_WORKERS,
+                 reduce_tokens=DEFAULT_REDUCE_TOKENS):
+        self.model_id = model_id
+        self.chunk_tokens = chunk_tokens
+        self.max_workers = max_workers
+        self.reduce_tokens = reduce_tokens
+
+    def summarize_chunk(self, reviews):
+        return bedrock_converse_api(self.model_id, map_prompt_template.format(product_reviews=reviews_to_text(reviews)))
+
+    def map_chunks(self, chunks):
+        """
+        Summarize review chunks in parallel, the summaries are returned in chunk order.
+
+        :raise VocMapError: if a chunk failed, nothing is returned rather than a summary of part of the reviews
+        """
+        logger.info(f"VoC map: {sum(len(chunk) for chunk in chunks)} reviews in {len(chunks)} chunks")
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            summaries = list(executor.map(self.summarize_chunk, chunks))
+        # bedrock_converse_api returns None on error
+        failed = sum(1 for summary in summaries if not summary)
+        if failed:
+            raise VocMapError(failed, len(chunks))
+        return summaries
+
+    def merge_summaries(self, summaries):
+        """
+        Merge several batch summaries into one, None on error.
+        """
+        return bedrock_converse_api(self.model_id, merge_prompt_template.format(summaries=format_summaries(summaries)))
+
+    def reduce_summaries(self, items, max_tokens=None, max_summaries=None):
+        """
+        Merge summary items in groups of at most chunk_tokens, round after round, until they fit max_tokens
+        together and there are at most max_summaries of them.
+
+        :raise VocMapError: if a merge failed
+        """
+        max_tokens = max_tokens or self.reduce_tokens
+
+        def too_large(items):
+            tokens = estimate_tokens(format_summaries([item['summary'] for item in items]))
+            return tokens > max_tokens or bool(max_summaries and len(items) > max_summaries)
+
+        def merge(group):
+            if len(group) == 1:
+                return group[0]['summary']
+            return self.merge_summaries([item['summary'] for item in group])
+
+        while len(items) > 1 and too_large(items):
+            groups = group_summaries(items, self.chunk_tokens)
+            logger.info(f"VoC reduce: merging {len(items)} summaries into {len(groups)}")
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                merged = list(executor.map(merge, groups))
+            failed = sum(1 for summary in merged if not summary)
+            if failed:
+                raise VocMapError(failed, len(groups), 'merge')
+            items = [{'reviews': sum(item['reviews'] for item in group), 'summary': summary}
+                     for group, summary in zip(groups, merged)]
+        return items
+
+    def reduce_prompt(self, items, language, stats, product_description=''):
+        """
+        :param items: summary items, merged first if they don't fit reduce_tokens
+        :param stats: statistics of all reviews from review_stats.compute_review_stats
+        """
+        items = self.reduce_summaries(items)
+        return reduce_note + '\n' + voc_prompt_template.format(
+            product_description=product_description,
+            product_reviews=format_summaries([item['summary'] for item in items]),
+            review_statistics=format_review_stats(stats), lang=language)
+
+    def build_prompt(self, reviews, language, product_description='', topics=None):
+        """
+        Build the final report prompt, reviews are sent as is when they fit in one chunk.
+
+        :param topics: topic terms of the product from review_stats.topic_terms
+        """
+        # ratings, sentiment and topics are computed locally instead of by the model
+        stats = compute_review_stats(reviews, topics=topics)
+        chunks = chunk_reviews(reviews, self.chunk_tokens)
+        if len(chunks) <= 1:
+            return voc_prompt_template.format(
+                product_description=product_description, product_reviews=reviews_to_text(reviews),
+                review_statistics=format_review_stats(stats), lang=language)
+        items = [{'reviews': len(chunk), 'summary': summary} for chunk, summary in zip(chunks, self.map_chunks(chunks))]
+        return self.reduce_prompt(items, language, stats, product_description)
+
+    def build_prompt_for_asin(self, asin, language):
+        catalog = get_catalog()
+        return self.build_prompt(list(catalog.iter_reviews(asin)), language,
+                                 topics=topic_terms(catalog.get_product(asin)))
+
+    def report(self, reviews, language):
+        return bedrock_converse_api(self.model_id, self.build_prompt(reviews, language))
@@ -0,0 +1,105 @@
+import os
+import json
+import time
+import tempfile
+import logging
+
+from utils.catalog_store import get_catalog
+from utils.voc_engine import VocMapError, chunk_reviews
+from utils.review_stats import compute_review_stats, topic_terms
+
+logger = logging.getLogger(__name__)
+
+# stored batch summaries are merged into one once there are more than this
+DEFAULT_MAX_SUMMARIES = 8
+
+
+class VocState:
+    """
+    Persistent VoC state of an ASIN, the ids of reviews already analyzed and their batch summaries.
+    """
+
+    def __init__(self, asin, review_ids=None, summaries=None, last_review_date='', updated_at=0):
+        self.asin = asin
+        self.review_ids = set(review_ids or [])
+        # [{"reviews": <number of reviews>, "summary": <analysis notes>}]
+        self.summaries = summaries or []
+        self.last_review_date = last_review_date
+        self.updated_at = updated_at
+
+    def to_dict(self):
+        return {
+            'asin': self.asin,
+            'review_ids': sorted(self.review_ids),
+            'summaries': self.summaries,
+            'last_review_date': self.last_review_date,
+            'updated_at': self.updated_at,
+        }
+
+
+class VocStateStore:
+    """
+    One json file per ASIN under the state folder.
+    """
+
+    def __init__(self, folder=None):
+        self.folder = folder or os.getenv('voc_state_folder', './data/voc_state')
+        os.makedirs(self.folder, exist_ok=True)
+
+    def _path(self, asin):
+        return os.path.join(self.folder, 'asin_' + asin + '_voc.json')
+
+    def load(self, asin):
+        try:
+            with open(self._path(asin), 'r', encoding='utf-8') as file:
+                return VocState(**json.load(file))
+        except FileNotFoundError:
+            return VocState(asin)
+
+    def save(self, state):
+        # a temp file of its own per save, concurrent sessions saving the same ASIN don't write into each other
+        with tempfile.NamedTemporaryFile('w', encoding='utf-8', dir=self.folder, suffix='.tmp', delete=False) as file:
+            json.dump(state.to_dict(), file, ensure_ascii=False)
+        os.replace(file.name, self._path(state.asin))
+
+
+def refresh_voc_state(engine, state, reviews, max_summaries=DEFAULT_MAX_SUMMARIES):
+    """
+    Analyze only the reviews not in the state yet and merge them into the stored summaries.
+
+    :return: number of new reviews analyzed
+    """
+    new_reviews = [review for review in reviews if review['id'] not in state.review_ids]
+    if new_reviews:
+        chunks = chunk_reviews(new_reviews, engine.chunk_tokens)
+        # raises VocMapError if a chunk failed, the state is kept as is so these reviews are analyzed next time
+        summaries = engine.map_chunks(chunks)
+        state.summaries.extend({'reviews': len(chunk), 'summary': summary} for chunk, summary in zip(chunks, summaries))
+        state.review_ids.update(review['id'] for review in new_reviews)
+        state.last_review_date = max([state.last_review_date] + [review['date'] for review in new_reviews])
+
+    if len(state.summaries) > max_summaries:
+        # merged in groups that fit one model call, round after round
+        try:
+            state.summaries = engine.reduce_summaries(state.summaries, max_summaries=max_summaries)
+        except VocMapError as e:
+            # the summaries are kept unmerged and merged again on the next refresh
+            logger.warning(f"merging the VoC summaries of {state.asin} failed: {e}")
+
+    state.updated_at = int(time.time())
+    logger.info(f"VoC state of {state.asin}: {len(new_reviews)} new reviews, {len(state.review_ids)} in total")
+    return len(new_reviews)
+
+
+def incremental_voc_prompt(engine, asin, language, store=None, reviews=None):
+    """
+    Refresh the stored VoC state of an ASIN with its new reviews and build the report prompt from it.
+    """
+    store = store or VocStateStore()
+    state = store.load(asin)
+    if reviews is None:
+        reviews = list(get_catalog().iter_reviews(asin))
+    refresh_voc_state(engine, state, reviews)
+    store.save(state)
+    stats = compute_review_stats(reviews, topics=topic_terms(get_catalog().get_product(asin)))
+    return engine.reduce_prompt(state.summaries, language, stats)